@@ -1,15 +1,39 @@
 # -*- coding: UTF-8 -*-
+import datetime
+
+from django.conf import settings
 from django.contrib.admin import AdminSite
 from django.contrib.auth.admin import User, UserAdmin, Group, GroupAdmin
+from django.core.cache import cache
 from djcelery.admin import IntervalSchedule, CrontabSchedule, PeriodicTaskAdmin, PeriodicTask, TaskState, TaskMonitor, \
     WorkerMonitor, WorkerState
+from django.contrib import messages
+from django.db.models import Avg, Count, Max
 from django.template.response import TemplateResponse
-from django.utils.translation import ugettext_lazy
+from django.urls import path
+from django.utils import timezone
+from django.utils.functional import Promise
+from django.utils.translation import get_language, ugettext_lazy
 from django.views.decorators.cache import never_cache
 from urllib import parse
+from BMS.celery_queues import get_queue, get_worker_stats
+from BMS.metrics import record_cache
+from BMS.roles import get_generation, get_roles
 from BMS.settings import DINGTALK_APPID
 
 
+def force_lazy_text(value):
+    """The value with its lazy translations turned into text, the lazy
+    objects can not be pickled into the cache"""
+    if isinstance(value, Promise):
+        return str(value)
+    if isinstance(value, dict):
+        return dict((key, force_lazy_text(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [force_lazy_text(item) for item in value]
+    return value
+
+
 class BMSAdminSite(AdminSite):
     site_title = "BMS网站管理"
     site_header = ugettext_lazy('后台管理')
@@ -21,11 +45,10 @@ class BMSAdminSite(AdminSite):
         Displays the main admin index page, which lists all of the installed
         apps that have been registered in this site.
         """
-        app_list = self.get_app_list(request)
-        context = dict(
-            self.each_context(request),
+        context = self.each_context(request)
+        context.update(
             title=self.index_title,
-            app_list=app_list,
+            app_list=context['available_apps'],
         )
         context.update(extra_context or {})
         request.current_app = self.name
@@ -33,16 +56,7 @@ class BMSAdminSite(AdminSite):
             request, self.index_template or 'admin/index.html', context
         )
 
-    def each_context(self, request):
-        """
-        Returns a dictionary of variables to put in the template context for
-        *every* page in the admin site.
-
-        For sites running on a subpath, use the SCRIPT_NAME value if site_url
-        hasn't been customized.
-        """
-        script_name = request.META['SCRIPT_NAME']
-        site_url = script_name if self.site_url == '/' and script_name else self.site_url
+    def get_group_context(self, request):
         # 把用户的groupID传给template
         # if Group.objects.filter(id = request.user.id):
         #     group_context = Group.objects.get(id = request.user.id).id
@@ -51,9 +65,9 @@ class BMSAdminSite(AdminSite):
         # group_context = [0, ]
         # if not isinstance(request.user,AnonymousUser):
         try:
-            groups = Group.objects.filter(user=request.user)
+            groups = get_roles(request)
             if groups:
-                group_context = [i.name for i in groups]
+                group_context = list(groups.names)
             else:
                 if request.user.is_superuser:
                     group_context = [1, ]
@@ -62,14 +76,55 @@ class BMSAdminSite(AdminSite):
                     group_context = [0, ]
         except:
             group_context = [0, ]
+        return group_context
+
+    def get_user_context(self, request):
+        """The group names and the app list of the user, both only depend on
+        the user's groups and permissions, so they are cached per user and
+        dropped when those change (see BMS.roles.invalidate)."""
+        if not request.user.is_authenticated:
+            return {
+                'group_id': self.get_group_context(request),
+                'available_apps': self.get_app_list(request),
+            }
+        key = 'bms:admin_context:%s:%s:%s:%s' % (
+            self.name, get_generation(), get_language(), request.user.pk
+        )
+        user_context = cache.get(key)
+        record_cache('admin_context', user_context is not None)
+        if user_context is None:
+            user_context = force_lazy_text({
+                'group_id': self.get_group_context(request),
+                'available_apps': self.get_app_list(request),
+            })
+            cache.set(key, user_context, getattr(
+                settings, 'BMS_ADMIN_CONTEXT_CACHE_TIMEOUT', 300
+            ))
+        return user_context
+
+    def each_context(self, request):
+        """
+        Returns a dictionary of variables to put in the template context for
+        *every* page in the admin site.
+
+        For sites running on a subpath, use the SCRIPT_NAME value if site_url
+        hasn't been customized.
+        """
+        script_name = request.META['SCRIPT_NAME']
+        site_url = script_name if self.site_url == '/' and script_name else self.site_url
+        # The context is computed once per request, even if asked twice
+        user_context = getattr(request, '_bms_user_context', None)
+        if user_context is None:
+            user_context = self.get_user_context(request)
+            request._bms_user_context = user_context
 
         return {
             'site_title': self.site_title,
             'site_header': self.site_header,
             'site_url': site_url,
             'has_permission': self.has_permission(request),
-            'group_id': group_context,
-            'available_apps': self.get_app_list(request),
+            'group_id': user_context['group_id'],
+            'available_apps': user_context['available_apps'],
         }
 
     @never_cache
@@ -93,6 +148,54 @@ class BMSAdminSite(AdminSite):
         return super().login(request, extra_context=extra_context)
 
 
+class WorkerStatsMonitor(WorkerMonitor):
+    """The worker admin of djcelery with a stats page: the queues and load
+    of the live workers and the tasks of the last hours by queue."""
+    change_list_template = "admin/djcelery/workerstate/change_list.html"
+    stats_template = "admin/djcelery/workerstate/stats.html"
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path("stats/", self.admin_site.admin_view(self.stats_view),
+                 name="%s_%s_stats" % info),
+        ] + super().get_urls()
+
+    def get_task_stats(self, since):
+        rows = TaskState.objects.filter(tstamp__gte=since).values(
+            "name", "state"
+        ).annotate(
+            count=Count("id"), avg_runtime=Avg("runtime"),
+            max_runtime=Max("runtime"),
+        ).order_by("name", "state")
+        for row in rows:
+            row["queue"] = get_queue(row["name"])
+        return sorted(rows, key=lambda row: (row["queue"], row["name"]))
+
+    def stats_view(self, request):
+        try:
+            hours = max(int(request.GET.get("hours", 24)), 1)
+        except ValueError:
+            hours = 24
+        try:
+            workers = get_worker_stats()
+        except Exception as e:
+            workers = []
+            messages.warning(request, "无法连接worker：%s" % e)
+        context = dict(
+            self.admin_site.each_context(request),
+            title="Worker统计",
+            opts=self.model._meta,
+            hours=hours,
+            workers=workers,
+            tasks=self.get_task_stats(
+                timezone.now() - datetime.timedelta(hours=hours)
+            ),
+        )
+        request.current_app = self.admin_site.name
+        return TemplateResponse(request, self.stats_template, context)
+
+
 BMS_admin_site = BMSAdminSite()
 BMS_admin_site.register(User, UserAdmin)
 BMS_admin_site.register(Group, GroupAdmin)
@@ -100,4 +203,4 @@ BMS_admin_site.register(IntervalSchedule)
 BMS_admin_site.register(CrontabSchedule)
 BMS_admin_site.register(PeriodicTask, PeriodicTaskAdmin)
 BMS_admin_site.register(TaskState, TaskMonitor)
-BMS_admin_site.register(WorkerState, WorkerMonitor)
+BMS_admin_site.register(WorkerState, WorkerStatsMonitor)
@@ -0,0 +1,7 @@
+"""Benchmarks of the admins registered on BMS_admin_site.
+
+``dataset`` fills a throwaway database with a realistic amount of contracts,
+bills, samples and projects, ``runner`` times the changelist, change view and
+export of every admin and compares the numbers with the stored baselines.
+Run it with ``manage.py bms_benchmark --settings=BMS.settings_benchmark``.
+"""
@@ -0,0 +1,226 @@
+"""Synthetic data for the admin benchmarks.
+
+The rows are built from the model fields (choices, max_length, unique,
+decimal places) so the generator keeps up with the models, and inserted
+with bulk_create. Foreign keys point to random rows of the related model,
+a small pool of those is generated first when the table is empty.
+"""
+import datetime
+import decimal
+import random
+from collections import OrderedDict
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.db import models, transaction
+from django.utils import timezone
+
+# model label -> (rows, {m2m field: links per row})
+DEFAULT_DATASET = OrderedDict([
+    ("mm.Contract", (5000, {})),
+    ("fm.Invoice", (5000, {})),
+    ("fm.Bill", (20000, {})),
+    ("sample.SampleInfoForm", (5000, {})),
+    ("sample.SampleInfo", (100000, {})),
+    ("pm.SubProject", (3000, {"sampleInfoForm": 2})),
+    ("pm.ExtSubmit", (3000, {"sample": 20})),
+    ("pm.LibSubmit", (3000, {"sample": 20})),
+    ("pm.SeqSubmit", (3000, {"sample": 20})),
+    ("lims.ExtExecute", (3000, {"ext_experimenter": 2})),
+    ("lims.LibExecute", (3000, {"lib_experimenter": 2})),
+    ("lims.SeqExecute", (3000, {"seq_experimenter": 2})),
+    ("lims.SampleInfoExt", (20000, {})),
+    ("lims.SampleInfoLib", (20000, {})),
+    ("lims.SampleInfoSeq", (20000, {})),
+])
+
+BENCHMARK_USERNAME = "benchmark"
+
+
+class DatasetGenerator(object):
+    """Fill the database described by ``dataset`` (see DEFAULT_DATASET),
+    every count is multiplied by ``scale``."""
+    batch_size = 1000
+    # rows generated for a related model which has none
+    pool_size = 50
+    users = 100
+
+    def __init__(self, dataset=None, scale=1.0, seed=0, stdout=None):
+        self.dataset = dataset or DEFAULT_DATASET
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.stdout = stdout
+        self.today = datetime.date.today()
+        self.now = timezone.now()
+        self._pks = {}
+        self._in_progress = set()
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def run(self):
+        with transaction.atomic():
+            self.create_users()
+            for label, (count, m2m) in self.dataset.items():
+                model = apps.get_model(label)
+                count = max(int(count * self.scale), 1)
+                missing = count - model._default_manager.count()
+                if missing > 0:
+                    self.log("Generating %s %s ..." % (missing, label))
+                    self.generate(model, missing, m2m)
+
+    # Users
+    def create_users(self):
+        User = get_user_model()
+        if not User.objects.filter(username=BENCHMARK_USERNAME).exists():
+            User.objects.create_superuser(
+                BENCHMARK_USERNAME, "benchmark@example.com", BENCHMARK_USERNAME
+            )
+        missing = self.users - User.objects.count()
+        if missing > 0:
+            users = []
+            for i in range(missing):
+                user = User(
+                    username="bench%s" % i, first_name="员工%s" % i,
+                    last_name="测", email="bench%s@example.com" % i,
+                    is_staff=True,
+                )
+                user.set_unusable_password()
+                users.append(user)
+            User.objects.bulk_create(users)
+        self._pks.pop(User, None)
+
+    # Rows
+    def get_pks(self, model):
+        """The pks to pick foreign keys from, generate a pool if needed"""
+        pks = self._pks.get(model)
+        if pks is None:
+            pks = list(model._default_manager.values_list("pk", flat=True))
+            if not pks and model not in self._in_progress:
+                self.generate(model, self.pool_size)
+                pks = list(model._default_manager.values_list("pk", flat=True))
+            self._pks[model] = pks
+        return pks
+
+    def generate(self, model, count, m2m=None):
+        self._in_progress.add(model)
+        try:
+            start = model._default_manager.count()
+            one_to_one = self.get_one_to_one_pks(model, count)
+            for offset in range(0, count, self.batch_size):
+                objs = [
+                    self.build(model, start + i, one_to_one)
+                    for i in range(offset, min(offset + self.batch_size, count))
+                ]
+                model._default_manager.bulk_create(objs)
+        finally:
+            self._in_progress.discard(model)
+        self._pks.pop(model, None)
+        for name, per_row in (m2m or {}).items():
+            self.link(model, name, per_row)
+
+    def get_one_to_one_pks(self, model, count):
+        """A fresh related row per generated row for every OneToOneField"""
+        pks = {}
+        for field in model._meta.concrete_fields:
+            if isinstance(field, models.OneToOneField):
+                related = field.remote_field.model
+                used = set(model._default_manager.exclude(
+                    **{"%s__isnull" % field.name: True}
+                ).values_list(field.attname, flat=True))
+                free = [pk for pk in self.get_pks(related) if pk not in used]
+                if len(free) < count and related not in self._in_progress:
+                    self.generate(related, count - len(free))
+                    free = [pk for pk in self.get_pks(related) if pk not in used]
+                pks[field.attname] = iter(free)
+        return pks
+
+    def build(self, model, index, one_to_one):
+        values = {}
+        for field in model._meta.concrete_fields:
+            if field.auto_created or isinstance(field, models.AutoField):
+                continue
+            if field.attname in one_to_one:
+                values[field.attname] = next(one_to_one[field.attname], None)
+            elif field.is_relation:
+                values[field.attname] = self.related_value(field)
+            elif field.has_default() and not field.unique:
+                continue
+            else:
+                values[field.attname] = self.value(field, index)
+        return model(**values)
+
+    def related_value(self, field):
+        related = field.remote_field.model
+        pks = [] if related in self._in_progress else self.get_pks(related)
+        if not pks:
+            return None
+        return self.random.choice(pks)
+
+    def value(self, field, index):
+        if field.choices:
+            return self.random.choice([value for value, _ in field.flatchoices])
+        if isinstance(field, models.FileField):
+            return "benchmark/%s_%s.txt" % (field.name, index)
+        if isinstance(field, models.EmailField):
+            return "user%s@example.com" % index
+        if isinstance(field, (models.CharField, models.TextField)):
+            return self.text(field, index)
+        if isinstance(field, (models.BooleanField, models.NullBooleanField)):
+            return self.random.random() < 0.5
+        if isinstance(field, models.DecimalField):
+            return self.decimal(field)
+        if isinstance(field, (models.PositiveSmallIntegerField,
+                              models.SmallIntegerField)):
+            return index % 100 if field.unique else self.random.randint(0, 100)
+        if isinstance(field, models.IntegerField):
+            return index if field.unique else self.random.randint(0, 10000)
+        if isinstance(field, models.DateTimeField):
+            return self.now - datetime.timedelta(
+                minutes=self.random.randint(0, 2 * 365 * 24 * 60))
+        if isinstance(field, models.DateField):
+            return self.today - datetime.timedelta(
+                days=self.random.randint(0, 2 * 365))
+        if type(field).__name__ == "JSONField":
+            return {}
+        return None
+
+    def text(self, field, index):
+        prefix = "".join(c for c in field.name.upper() if c.isalnum())[:4]
+        value = "%s%06d" % (prefix, index)
+        max_length = field.max_length
+        if max_length and len(value) > max_length:
+            # keep the unique part
+            value = ("%d" % index)[-max_length:]
+        return value
+
+    def decimal(self, field):
+        places = field.decimal_places or 0
+        whole_digits = min(max((field.max_digits or 10) - places, 1), 7)
+        value = self.random.uniform(0, 10 ** whole_digits - 1)
+        return decimal.Decimal(value).quantize(decimal.Decimal(10) ** -places)
+
+    def link(self, model, name, per_row):
+        field = model._meta.get_field(name)
+        through = field.remote_field.through
+        target_pks = self.get_pks(field.remote_field.model)
+        if not target_pks:
+            return
+        source = field.m2m_field_name() + "_id"
+        target = field.m2m_reverse_field_name() + "_id"
+        linked = set(through._default_manager.values_list(source, flat=True))
+        rows = []
+        for pk in model._default_manager.values_list("pk", flat=True):
+            if pk in linked:
+                continue
+            for target_pk in self.random.sample(
+                    target_pks, min(per_row, len(target_pks))):
+                rows.append(through(**{source: pk, target: target_pk}))
+        # No batch_size: django 2.1 lets it override the limits of SQLite
+        through._default_manager.bulk_create(rows)
+        self.log("Linked %s %s.%s" % (len(rows), model._meta.label, name))
+
+
+def generate_dataset(scale=1.0, seed=0, stdout=None):
+    DatasetGenerator(scale=scale, seed=seed, stdout=stdout).run()
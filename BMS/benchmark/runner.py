@@ -0,0 +1,212 @@
+"""Time and count the queries of the admin pages, compare with baselines.
+
+Every page is requested ``repeat`` times by a logged in superuser, the
+median time and the smallest query count (warm cache) are kept.
+A page fails when it runs more queries than its baseline (plus
+``query_tolerance``) or gets slower than ``threshold`` (0.25 = 25%) and
+more than ``min_ms`` over its baseline. A page without a baseline fails
+too, unless the run records the baselines.
+
+The committed baselines.json only holds the query counts, the timings depend
+on the machine: record them with --record where the suite runs, the time
+check only applies to the baselines which have one.
+"""
+import json
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.urls import NoReverseMatch, reverse
+from import_export.admin import ExportActionMixin, ExportMixin
+
+from BMS.admin_bms import BMS_admin_site
+from BMS.benchmark.dataset import BENCHMARK_USERNAME
+from BMS.instrumentation import QueryCounter
+
+DEFAULT_BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baselines.json"
+)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def load_baselines(path=DEFAULT_BASELINE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(results, path=DEFAULT_BASELINE_FILE, timings=True):
+    baselines = load_baselines(path)
+    for result in results:
+        if result.ok_status:
+            baselines[result.key] = {"queries": result.queries}
+            if timings:
+                baselines[result.key]["ms"] = round(result.ms, 2)
+    with open(path, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+class Result(object):
+
+    def __init__(self, key, url, status, ms, queries):
+        self.key = key
+        self.url = url
+        self.status = status
+        self.ms = ms
+        self.queries = queries
+        self.baseline = None
+        self.failures = []
+
+    @property
+    def ok_status(self):
+        return self.status == 200
+
+    @property
+    def passed(self):
+        return self.ok_status and not self.failures
+
+    def compare(self, baseline, threshold, query_tolerance, min_ms,
+                record=False):
+        self.baseline = baseline
+        if not self.ok_status:
+            self.failures.append("HTTP %s" % self.status)
+        if baseline is None:
+            if not record:
+                self.failures.append("no baseline, record it with --record")
+            return
+        if self.queries > baseline["queries"] + query_tolerance:
+            self.failures.append(
+                "%s queries, baseline %s" % (self.queries, baseline["queries"]))
+        if "ms" in baseline and (
+                self.ms > baseline["ms"] * (1 + threshold)
+                and self.ms - baseline["ms"] > min_ms):
+            self.failures.append(
+                "%.1f ms, baseline %.1f ms" % (self.ms, baseline["ms"]))
+
+    def __str__(self):
+        if self.baseline is None:
+            baseline = "no baseline"
+        elif "ms" not in self.baseline:
+            baseline = "baseline %s queries" % self.baseline["queries"]
+        else:
+            baseline = "baseline %.1f ms / %s queries" % (
+                self.baseline["ms"], self.baseline["queries"])
+        return "%-6s %-45s %8.1f ms %5s queries  (%s)%s" % (
+            "PASS" if self.passed else "FAIL", self.key, self.ms,
+            self.queries, baseline,
+            "".join("\n       - %s" % f for f in self.failures),
+        )
+
+
+class AdminBenchmark(object):
+
+    def __init__(self, site=BMS_admin_site, repeat=3, export_rows=500,
+                 export_format="xlsx", models=None):
+        self.site = site
+        self.repeat = repeat
+        self.export_rows = export_rows
+        self.export_format = export_format
+        self.models = set(m.lower() for m in models or ())
+        self.client = Client()
+        self.client.force_login(
+            get_user_model().objects.get(username=BENCHMARK_USERNAME)
+        )
+
+    def get_model_admins(self):
+        for model, model_admin in sorted(
+                self.site._registry.items(),
+                key=lambda item: item[0]._meta.label_lower):
+            if self.models and model._meta.label_lower not in self.models:
+                continue
+            yield model, model_admin
+
+    def url(self, model, view, *args):
+        opts = model._meta
+        return reverse("%s:%s_%s_%s" % (
+            self.site.name, opts.app_label, opts.model_name, view), args=args)
+
+    def measure(self, key, url, data=None):
+        timings = []
+        response = None
+        queries = []
+        for _ in range(self.repeat):
+            # Counted by the wrapper, connection.queries stops at 9000
+            stats = {"sql_count": 0, "sql_ms": 0}
+            with connection.execute_wrapper(QueryCounter(stats)):
+                start = time.time()
+                if data is None:
+                    response = self.client.get(url)
+                else:
+                    response = self.client.post(url, data)
+                if getattr(response, "streaming", False):
+                    b"".join(response.streaming_content)
+                timings.append((time.time() - start) * 1000)
+            # A cache entry may expire during the slow pages
+            queries.append(stats["sql_count"])
+        return Result(key, url, response.status_code, median(timings),
+                      min(queries))
+
+    def get_format_index(self, model_admin):
+        formats = model_admin.get_export_formats()
+        for index, file_format in enumerate(formats):
+            if file_format().get_title() == self.export_format:
+                return index
+        return 0
+
+    def measure_export(self, model, model_admin, key):
+        file_format = self.get_format_index(model_admin)
+        if isinstance(model_admin, ExportActionMixin):
+            # What the users do: select rows of the changelist and export them
+            pks = list(model._default_manager.order_by("-pk").values_list(
+                "pk", flat=True)[:self.export_rows])
+            if not pks:
+                # Nothing to select, the action only redirects back
+                return None
+            return self.measure(key, self.url(model, "changelist"), {
+                "action": "export_admin_action",
+                "index": 0,
+                "file_format": file_format,
+                "_selected_action": pks,
+            })
+        return self.measure(key, self.url(model, "export"),
+                            {"file_format": file_format})
+
+    def run(self):
+        results = []
+        for model, model_admin in self.get_model_admins():
+            label = model._meta.label_lower
+            results.append(self.measure(
+                "%s changelist" % label, self.url(model, "changelist")))
+            pk = model._default_manager.order_by("pk").values_list(
+                "pk", flat=True).first()
+            if pk is not None:
+                try:
+                    url = self.url(model, "change", pk)
+                except NoReverseMatch:
+                    pass
+                else:
+                    results.append(self.measure("%s change" % label, url))
+            if isinstance(model_admin, ExportMixin):
+                result = self.measure_export(model, model_admin,
+                                             "%s export" % label)
+                if result is not None:
+                    results.append(result)
+        return results
+
+
+def compare(results, baselines, threshold=0.25, query_tolerance=0, min_ms=20,
+            record=False):
+    for result in results:
+        result.compare(baselines.get(result.key), threshold, query_tolerance,
+                       min_ms, record)
+    return all(result.passed for result in results)
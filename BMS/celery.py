@@ -6,6 +6,9 @@ import os
 from celery import Celery
 from django.conf import settings
 
+from BMS.celery_queues import get_config
+from BMS.metrics import connect_celery_signals
+
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'BMS.settings')
 app = Celery('BMS')
@@ -13,7 +16,10 @@ app = Celery('BMS')
 # Using a string here means the worker will not have to
 # pickle the object when using Windows.
 app.config_from_object('django.conf:settings')
+# One queue per workload, see BMS/celery_queues.py
+app.add_defaults(get_config)
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+connect_celery_signals()
 
 
 @app.task(bind=True)
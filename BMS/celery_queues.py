@@ -0,0 +1,175 @@
+"""Queues, routing and time limits of the BMS celery tasks.
+
+Every workload gets its own queue so a long org sync or import never holds
+up the notifications. Start one worker per queue, with the concurrency of
+BMS_CELERY_QUEUE_CONCURRENCY, see ``manage.py celery_workers``. The defaults
+below can be overridden in settings.
+
+There are no message priorities: celery 3.1 on redis does not honour them,
+a queue with its own workers is what keeps the notifications ahead of the
+long jobs.
+
+The periodic tasks are in BEAT_SCHEDULE, run ``celery beat`` next to the
+workers. The outbox sweep is what delivers the notifications whose task got
+lost or whose worker died while sending.
+"""
+import datetime
+
+from django.conf import settings
+from kombu import Exchange, Queue
+
+DEFAULT_QUEUE = "celery"
+NOTIFICATIONS = "notifications"
+IMPORTS = "imports"
+SYNC = "sync"
+
+QUEUE_NAMES = (NOTIFICATIONS, IMPORTS, SYNC, DEFAULT_QUEUE)
+
+# Task name (or module prefix ending with a dot) -> queue, first match wins.
+# A task may also declare its queue itself, e.g. @shared_task(queue=IMPORTS)
+TASK_QUEUES = (
+    ("nm.tasks.", NOTIFICATIONS),
+    ("sample.tasks.run_import_job", IMPORTS),
+    ("crontab.tasks.just_print", SYNC),
+    ("notification.tasks.purge_old_notifications", SYNC),
+)
+
+QUEUE_CONCURRENCY = {
+    NOTIFICATIONS: 4,
+    IMPORTS: 2,
+    SYNC: 1,
+    DEFAULT_QUEUE: 2,
+}
+
+# (soft_time_limit, time_limit) in seconds
+TASK_TIME_LIMITS = {
+    "nm.tasks.deliver_notification": (30, 60),
+    "nm.tasks.deliver_notification_emails": (240, 300),
+    "nm.tasks.deliver_pending_notifications": (240, 300),
+    "sample.tasks.run_import_job": (1500, 1800),
+    "crontab.tasks.just_print": (1500, 1800),
+    "notification.tasks.purge_old_notifications": (1500, 1800),
+}
+
+# The celery beat entries, BMS_CELERY_BEAT_SCHEDULE adds or replaces entries
+BEAT_SCHEDULE = {
+    "deliver-pending-notifications": {
+        "task": "nm.tasks.deliver_pending_notifications",
+        "schedule": datetime.timedelta(seconds=60),
+    },
+    "expire-import-jobs": {
+        "task": "sample.tasks.expire_import_jobs",
+        "schedule": datetime.timedelta(minutes=10),
+    },
+}
+
+
+def get_task_queues():
+    return getattr(settings, "BMS_CELERY_TASK_QUEUES", TASK_QUEUES)
+
+
+def get_queue_concurrency():
+    concurrency = dict(QUEUE_CONCURRENCY)
+    concurrency.update(getattr(settings, "BMS_CELERY_QUEUE_CONCURRENCY", {}))
+    return concurrency
+
+
+def get_time_limits():
+    limits = dict(TASK_TIME_LIMITS)
+    limits.update(getattr(settings, "BMS_CELERY_TIME_LIMITS", {}))
+    return limits
+
+
+def get_beat_schedule():
+    schedule = dict(BEAT_SCHEDULE)
+    schedule.update(getattr(settings, "BMS_CELERY_BEAT_SCHEDULE", {}))
+    return schedule
+
+
+def get_queues():
+    return tuple(
+        Queue(name, Exchange(name), routing_key=name) for name in QUEUE_NAMES
+    )
+
+
+def get_annotations():
+    return dict(
+        (name, {"soft_time_limit": soft, "time_limit": hard})
+        for name, (soft, hard) in get_time_limits().items()
+    )
+
+
+class TaskRouter(object):
+    """CELERY_ROUTES router sending a task to the queue of its workload"""
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        for pattern, queue in get_task_queues():
+            if task == pattern or (pattern.endswith(".")
+                                   and task.startswith(pattern)):
+                return {"queue": queue, "routing_key": queue}
+        return None
+
+
+def get_config():
+    """The celery settings, the ones set in django settings win"""
+    defaults = {
+        "CELERY_QUEUES": get_queues(),
+        "CELERY_DEFAULT_QUEUE": DEFAULT_QUEUE,
+        "CELERY_DEFAULT_EXCHANGE": DEFAULT_QUEUE,
+        "CELERY_DEFAULT_ROUTING_KEY": DEFAULT_QUEUE,
+        "CELERY_ROUTES": ("BMS.celery_queues.TaskRouter", ),
+        "CELERY_ANNOTATIONS": get_annotations(),
+        "CELERYBEAT_SCHEDULE": get_beat_schedule(),
+        # A worker only takes what it can run, the time sensitive tasks are
+        # not stuck behind prefetched long ones
+        "CELERYD_PREFETCH_MULTIPLIER": 1,
+    }
+    return dict(
+        (name, getattr(settings, name, value))
+        for name, value in defaults.items()
+    )
+
+
+def get_worker_command(app="BMS", loglevel="info"):
+    """A ``celery multi`` command line starting one worker per queue"""
+    concurrency = get_queue_concurrency()
+    args = ["celery", "multi", "start"] + list(QUEUE_NAMES)
+    args += ["-A", app, "-l", loglevel]
+    for name in QUEUE_NAMES:
+        args += ["-Q:%s" % name, name, "-c:%s" % name,
+                 str(concurrency.get(name, 1))]
+    return " ".join(args)
+
+
+def get_beat_command(app="BMS", loglevel="info"):
+    """The command line of the one celery beat of the deployment"""
+    return "celery beat -A %s -l %s" % (app, loglevel)
+
+
+def get_queue(task_name):
+    route = TaskRouter().route_for_task(task_name)
+    return route["queue"] if route else DEFAULT_QUEUE
+
+
+def get_worker_stats(timeout=1.0):
+    """The queues and load of the live workers, asked over the broker"""
+    from celery import current_app
+
+    inspect = current_app.control.inspect(timeout=timeout)
+    stats = inspect.stats() or {}
+    queues = inspect.active_queues() or {}
+    active = inspect.active() or {}
+    reserved = inspect.reserved() or {}
+    workers = []
+    for hostname in sorted(set(stats) | set(queues)):
+        worker_stats = stats.get(hostname, {})
+        pool = worker_stats.get("pool", {})
+        workers.append({
+            "hostname": hostname,
+            "queues": [queue["name"] for queue in queues.get(hostname, [])],
+            "concurrency": pool.get("max-concurrency"),
+            "active": len(active.get(hostname, [])),
+            "reserved": len(reserved.get(hostname, [])),
+            "total": sum(worker_stats.get("total", {}).values()),
+        })
+    return workers
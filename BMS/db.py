@@ -0,0 +1,34 @@
+"""Database helpers shared by the apps."""
+from distutils.version import StrictVersion
+
+from django import get_version
+from django.db import transaction
+from django.db.models import Case, Value, When
+
+
+def bulk_update(model, objs, fields, batch_size=500):
+    """QuerySet.bulk_update() of django 2.2 for the django we are pinned to:
+    one UPDATE ... SET field = CASE pk WHEN ... per batch."""
+    objs = list(objs)
+    if not objs:
+        return 0
+    if StrictVersion(get_version()) >= StrictVersion('2.2'):
+        return model.objects.bulk_update(objs, fields, batch_size=batch_size)
+    opts = model._meta
+    updated = 0
+    with transaction.atomic():
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            values = {}
+            for name in fields:
+                field = opts.get_field(name)
+                values[field.attname] = Case(
+                    *[When(pk=obj.pk, then=Value(getattr(obj, field.attname),
+                                                 output_field=field))
+                      for obj in batch],
+                    output_field=field
+                )
+            updated += model.objects.filter(
+                pk__in=[obj.pk for obj in batch]
+            ).update(**values)
+    return updated
@@ -9,11 +9,12 @@ class TokenAuthBackend(object):
     """
     def authenticate(self, request, dingtalk_id=None):
         try:
-            employee = Employees.objects.get(dingtalk_id=dingtalk_id)
-            login_user = User.objects.get(pk=employee.user_id)
+            employee = Employees.objects.select_related("user").get(
+                dingtalk_id=dingtalk_id
+            )
         except Employees.DoesNotExist:
             return None
-        return login_user
+        return employee.user
     
     def get_user(self, user_id):
         try:
@@ -0,0 +1,129 @@
+"""Process-safe, cache backed access_token manager for dingtalk.
+
+The access_token of dingtalk is valid for 7200 seconds and the api is rate
+limited, so the token is fetched once and shared through django's cache
+(redis in production, locmem in tests) by every process and every caller.
+"""
+import time
+
+from dingtalk_sdk_gmdzy2010.authority_request import (
+    AccessTokenRequest, SnsAccessTokenRequest
+)
+from django.conf import settings
+from django.core.cache import cache
+
+from BMS.instrumentation import external_call
+from BMS.metrics import record_cache
+
+# errcodes returned by dingtalk when the token is invalid or expired
+INVALID_TOKEN_ERRCODES = (40001, 40014, 42001)
+
+
+class DingtalkTokenManager(object):
+    """Fetch, cache and refresh the access_token of an appkey/appsecret pair.
+
+    Only one process refreshes an expired token: the refresher holds a short
+    cache lock while the others wait for the new token to show up in cache.
+    """
+    request_class = AccessTokenRequest
+    key_prefix = "dingtalk:access_token"
+    expires_in = 7200
+    # refresh the token a bit earlier than dingtalk does
+    expire_margin = 300
+    lock_timeout = 10
+    lock_wait_interval = 0.1
+
+    def __init__(self, appkey, appsecret):
+        self.appkey = appkey
+        self.appsecret = appsecret
+
+    @property
+    def cache_key(self):
+        return "%s:%s" % (self.key_prefix, self.appkey)
+
+    @property
+    def lock_key(self):
+        return "%s:lock" % self.cache_key
+
+    def get_request_params(self):
+        return {"appkey": self.appkey, "appsecret": self.appsecret}
+
+    def fetch_token(self):
+        """Request a brand new token from dingtalk, return (token, expires)"""
+        request = self.request_class(params=self.get_request_params())
+        with external_call("dingtalk"):
+            json_response = request.get_json_response() or {}
+        token = json_response.get("access_token", None)
+        expires_in = json_response.get("expires_in", self.expires_in)
+        return token, expires_in
+
+    def refresh(self):
+        token, expires_in = self.fetch_token()
+        if token:
+            timeout = max(int(expires_in) - self.expire_margin, 1)
+            cache.set(self.cache_key, token, timeout)
+        return token
+
+    def get_token(self):
+        token = cache.get(self.cache_key)
+        record_cache(self.key_prefix, bool(token))
+        if token:
+            return token
+        if cache.add(self.lock_key, 1, self.lock_timeout):
+            try:
+                return self.refresh()
+            finally:
+                cache.delete(self.lock_key)
+        # Another process is refreshing, wait for its token
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(self.lock_wait_interval)
+            token = cache.get(self.cache_key)
+            if token:
+                return token
+        return self.refresh()
+
+    def invalidate(self):
+        cache.delete(self.cache_key)
+
+
+class SnsTokenManager(DingtalkTokenManager):
+    """The sns access_token of the QR login app, also valid for 7200s"""
+    request_class = SnsAccessTokenRequest
+    key_prefix = "dingtalk:sns_access_token"
+
+    def get_request_params(self):
+        return {"appid": self.appkey, "appsecret": self.appsecret}
+
+
+_managers = {}
+
+
+def get_token_manager(appkey=None, appsecret=None):
+    """Return the shared manager, defaults to the corp app in settings"""
+    appkey = appkey or settings.DINGTALK_APPKEY
+    appsecret = appsecret or settings.DINGTALK_SECRET
+    manager = _managers.get((appkey, appsecret))
+    if manager is None:
+        manager = DingtalkTokenManager(appkey, appsecret)
+        _managers[(appkey, appsecret)] = manager
+    return manager
+
+
+def get_access_token(appkey=None, appsecret=None):
+    return get_token_manager(appkey, appsecret).get_token()
+
+
+def get_sns_token_manager(appid=None, appsecret=None):
+    """Return the shared manager of the QR login app in settings"""
+    appid = appid or settings.DINGTALK_APPID
+    appsecret = appsecret or settings.DINGTALK_APPSECRET
+    manager = _managers.get(("sns", appid, appsecret))
+    if manager is None:
+        manager = SnsTokenManager(appid, appsecret)
+        _managers[("sns", appid, appsecret)] = manager
+    return manager
+
+
+def get_sns_access_token(appid=None, appsecret=None):
+    return get_sns_token_manager(appid, appsecret).get_token()
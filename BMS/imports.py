@@ -0,0 +1,423 @@
+"""Faster imports of the big sample sheets.
+
+StreamingImportMixin (admin) writes the uploaded file to disk chunk by chunk
+and parses it from there, XLSX with the read-only openpyxl reader and
+CSV/TSV line by line, instead of holding the whole upload in memory once as
+bytes and again for tablib.
+
+ImportProgressMixin (resource) reports how many rows were imported so far,
+for the background imports of sample.import_jobs.
+
+BulkImportMixin (resource) replaces the row by row import of django-import-export
+(one lookup, one INSERT or UPDATE per row) by
+
+* one pass loading what the rows refer to (prepare_bulk_import),
+* building and validating every instance in memory,
+* bulk_create/bulk_update in batches of BMS_IMPORT_BATCH_SIZE rows, in the
+  transaction of the import.
+
+The result has the same rows, diffs and per-row errors as a normal import,
+so the import templates and process_result do not change. Set
+BMS_BULK_IMPORT = False to go back to the row by row import.
+"""
+import csv
+import logging
+import shutil
+import traceback
+from copy import deepcopy
+
+import tablib
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db.transaction import savepoint, savepoint_commit, \
+    savepoint_rollback
+from django.http import HttpResponse
+from django.template.response import TemplateResponse
+from django.utils.translation import ugettext_lazy as _
+from import_export.formats.base_formats import CSV, TSV, XLSX
+from import_export.forms import ConfirmImportForm
+from import_export.results import RowResult
+from import_export.tmp_storages import TempFolderStorage
+from import_export.utils import atomic_if_using_transaction
+
+from BMS.db import bulk_update
+
+try:
+    from django.utils.encoding import force_text
+except ImportError:
+    from django.utils.encoding import force_unicode as force_text
+
+logger = logging.getLogger(__name__)
+
+
+def get_batch_size():
+    return getattr(settings, "BMS_IMPORT_BATCH_SIZE", 500)
+
+
+def get_progress_every():
+    return getattr(settings, "BMS_IMPORT_PROGRESS_EVERY", 100)
+
+
+class ImportProgressMixin(object):
+    """import_export resource mixin calling ``on_progress(rows)`` every
+    BMS_IMPORT_PROGRESS_EVERY rows of an import"""
+    on_progress = None
+    rows_done = 0
+
+    def before_import_row(self, row, **kwargs):
+        super().before_import_row(row, **kwargs)
+        self.rows_done += 1
+        if (self.on_progress is not None
+                and self.rows_done % get_progress_every() == 0):
+            self.on_progress(self.rows_done)
+
+
+class BulkImportMixin(object):
+    """import_export ModelResource mixin importing in bulk.
+
+    Subclasses implement get_bulk_instance() and import_bulk_row(), which
+    must not query the database per row, and usually prepare_bulk_import().
+    """
+    # The model fields bulk_update writes for the updated rows
+    bulk_update_fields = ()
+    # A unique field used to find the pk of the created rows when the
+    # database does not return them from bulk_create (mysql, sqlite)
+    bulk_lookup_field = None
+
+    def use_bulk_import(self):
+        return getattr(settings, "BMS_BULK_IMPORT", True)
+
+    def prepare_bulk_import(self, dataset):
+        """Load what the rows refer to, in as few queries as possible"""
+        pass
+
+    def get_bulk_instance(self, row):
+        """The (instance, new) a row imports into"""
+        raise NotImplementedError()
+
+    def import_bulk_row(self, instance, row, new):
+        """Copy the values of the row to the instance"""
+        raise NotImplementedError()
+
+    def validate_bulk_instance(self, instance):
+        # The relations are checked by the database, checking them here
+        # would query every row
+        instance.clean_fields(exclude=[
+            field.name for field in instance._meta.fields if field.is_relation
+        ])
+
+    def build_row(self, row, dry_run, **kwargs):
+        """The RowResult and the Diff of a row, nothing is saved yet"""
+        row_result = self.get_row_result_class()()
+        row_result.instance = None
+        row_result.bulk_diff = None
+        try:
+            self.before_import_row(row, **kwargs)
+            instance, new = self.get_bulk_instance(row)
+            self.after_import_instance(instance, new, **kwargs)
+            row_result.new_record = new
+            original = deepcopy(instance)
+            self.import_bulk_row(instance, row, new)
+            self.validate_bulk_instance(instance)
+            if new:
+                row_result.import_type = RowResult.IMPORT_TYPE_NEW
+            elif self.skip_row(instance, original):
+                row_result.import_type = RowResult.IMPORT_TYPE_SKIP
+            else:
+                row_result.import_type = RowResult.IMPORT_TYPE_UPDATE
+            row_result.instance = instance
+            row_result.bulk_diff = self.get_diff_class()(self, original, new)
+        except Exception as e:
+            row_result.import_type = RowResult.IMPORT_TYPE_ERROR
+            logger.exception(e)
+            row_result.errors.append(self.get_error_result_class()(
+                e, traceback.format_exc(), row))
+        return row_result
+
+    def set_created_pks(self, instances):
+        if not self.bulk_lookup_field:
+            return
+        missing = [instance for instance in instances if instance.pk is None]
+        batch_size = get_batch_size()
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            pks = dict(self._meta.model.objects.filter(**{
+                self.bulk_lookup_field + "__in": [
+                    getattr(instance, self.bulk_lookup_field)
+                    for instance in batch
+                ]
+            }).values_list(self.bulk_lookup_field, "pk"))
+            for instance in batch:
+                instance.pk = pks.get(getattr(instance,
+                                              self.bulk_lookup_field))
+
+    def save_bulk(self, created, updated):
+        model = self._meta.model
+        batch_size = get_batch_size()
+        model.objects.bulk_create(created, batch_size=batch_size)
+        self.set_created_pks(created)
+        if updated:
+            bulk_update(model, updated, self.bulk_update_fields,
+                        batch_size=batch_size)
+
+    def finish_row(self, row, row_result, dry_run, **kwargs):
+        instance = row_result.instance
+        try:
+            diff = row_result.bulk_diff
+            diff.compare_with(self, instance, dry_run)
+            row_result.diff = diff.as_html()
+            if row_result.import_type != RowResult.IMPORT_TYPE_SKIP:
+                row_result.object_id = instance.pk
+                row_result.object_repr = force_text(instance)
+            self.after_import_row(row, row_result, **kwargs)
+        except Exception as e:
+            row_result.import_type = RowResult.IMPORT_TYPE_ERROR
+            logger.exception(e)
+            row_result.errors.append(self.get_error_result_class()(
+                e, traceback.format_exc(), row))
+
+    def import_data_inner(self, dataset, dry_run, raise_errors,
+                          using_transactions, collect_failed_rows, **kwargs):
+        if not self.use_bulk_import():
+            return super().import_data_inner(
+                dataset, dry_run, raise_errors, using_transactions,
+                collect_failed_rows, **kwargs)
+        result = self.get_result_class()()
+        result.diff_headers = self.get_diff_headers()
+        result.total_rows = len(dataset)
+
+        if using_transactions:
+            sp1 = savepoint()
+
+        try:
+            with atomic_if_using_transaction(using_transactions):
+                self.before_import(dataset, using_transactions, dry_run,
+                                   **kwargs)
+                self.prepare_bulk_import(dataset)
+        except Exception as e:
+            logger.exception(e)
+            result.append_base_error(self.get_error_result_class()(
+                e, traceback.format_exc()))
+            if raise_errors:
+                raise
+
+        result.total_rows = len(dataset)
+        if collect_failed_rows:
+            result.add_dataset_headers(dataset.headers)
+
+        rows = []
+        has_row_errors = False
+        for row in dataset.dict:
+            row_result = self.build_row(row, dry_run, **kwargs)
+            if row_result.errors:
+                has_row_errors = True
+                if raise_errors:
+                    raise row_result.errors[-1].error
+            rows.append((row, row_result))
+
+        valid = [row_result for row, row_result in rows
+                 if not row_result.errors]
+        created = [row_result.instance for row_result in valid
+                   if row_result.import_type == RowResult.IMPORT_TYPE_NEW]
+        updated = [row_result.instance for row_result in valid
+                   if row_result.import_type == RowResult.IMPORT_TYPE_UPDATE]
+        # A transaction with an error is rolled back anyway
+        write = not (using_transactions and has_row_errors) and not (
+            dry_run and not using_transactions)
+        if write and not result.base_errors:
+            try:
+                with atomic_if_using_transaction(using_transactions):
+                    self.save_bulk(created, updated)
+            except Exception as e:
+                logger.exception(e)
+                result.append_base_error(self.get_error_result_class()(
+                    e, traceback.format_exc()))
+                if raise_errors:
+                    raise
+
+        for row, row_result in rows:
+            if not row_result.errors:
+                self.finish_row(row, row_result, dry_run, **kwargs)
+                if row_result.errors and raise_errors:
+                    raise row_result.errors[-1].error
+            row_result.instance = row_result.bulk_diff = None
+            if row_result.errors and collect_failed_rows:
+                result.append_failed_row(row, row_result.errors[0])
+            result.increment_row_result_total(row_result)
+            if (row_result.import_type != RowResult.IMPORT_TYPE_SKIP or
+                    self._meta.report_skipped):
+                result.append_row_result(row_result)
+
+        try:
+            with atomic_if_using_transaction(using_transactions):
+                self.after_import(dataset, result, using_transactions,
+                                  dry_run, **kwargs)
+        except Exception as e:
+            logger.exception(e)
+            result.append_base_error(self.get_error_result_class()(
+                e, traceback.format_exc()))
+            if raise_errors:
+                raise
+
+        if using_transactions:
+            if dry_run or result.has_errors():
+                savepoint_rollback(sp1)
+            else:
+                savepoint_commit(sp1)
+
+        return result
+
+
+class StreamingTempStorage(TempFolderStorage):
+    """TempFolderStorage written from the chunks of the upload"""
+
+    def save_file(self, uploaded_file):
+        with self.open(mode="wb") as file:
+            for chunk in uploaded_file.chunks():
+                file.write(chunk)
+
+    def save_stream(self, stream):
+        with self.open(mode="wb") as file:
+            shutil.copyfileobj(stream, file)
+
+
+def read_xlsx(path):
+    """The first sheet of the workbook, read row by row"""
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        dataset = tablib.Dataset()
+        rows = workbook.active.rows
+        dataset.headers = [cell.value for cell in next(rows)]
+        for row in rows:
+            dataset.append([cell.value for cell in row])
+        return dataset
+    finally:
+        # A read-only workbook keeps the file open
+        workbook.close()
+
+
+def read_csv(path, encoding, delimiter=","):
+    dataset = tablib.Dataset()
+    with open(path, encoding=encoding, newline="") as file:
+        for index, row in enumerate(csv.reader(file, delimiter=delimiter)):
+            if index == 0:
+                dataset.headers = row
+            elif row:
+                dataset.append(row)
+    return dataset
+
+
+def read_dataset(path, input_format, encoding=None):
+    """The dataset of the file, None for the formats tablib has to read"""
+    encoding = encoding or "utf-8"
+    if isinstance(input_format, XLSX):
+        return read_xlsx(path)
+    if isinstance(input_format, TSV):
+        return read_csv(path, encoding, delimiter="\t")
+    if isinstance(input_format, CSV):
+        return read_csv(path, encoding)
+    return None
+
+
+class StreamingImportMixin(object):
+    """ImportMixin (admin) mixin streaming the uploaded file to disk and
+    parsing it from there. Other tmp storages and formats keep the
+    import_export behaviour."""
+    tmp_storage_class = StreamingTempStorage
+
+    def write_to_tmp_storage(self, import_file, input_format):
+        tmp_storage = self.get_tmp_storage_class()()
+        if not isinstance(tmp_storage, StreamingTempStorage):
+            return super().write_to_tmp_storage(import_file, input_format)
+        tmp_storage.save_file(import_file)
+        return tmp_storage
+
+    def load_dataset(self, tmp_storage, input_format):
+        if isinstance(tmp_storage, TempFolderStorage):
+            dataset = read_dataset(tmp_storage.get_full_path(), input_format,
+                                   self.from_encoding)
+            if dataset is not None:
+                return dataset
+        data = tmp_storage.read(input_format.get_read_mode())
+        if not input_format.is_binary() and self.from_encoding:
+            data = force_text(data, self.from_encoding)
+        return input_format.create_dataset(data)
+
+    def import_action(self, request, *args, **kwargs):
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+
+        resource = self.get_import_resource_class()(
+            **self.get_import_resource_kwargs(request, *args, **kwargs))
+
+        context = self.get_import_context_data()
+
+        import_formats = self.get_import_formats()
+        form_type = self.get_import_form()
+        form = form_type(import_formats,
+                         request.POST or None,
+                         request.FILES or None)
+
+        if request.POST and form.is_valid():
+            input_format = import_formats[
+                int(form.cleaned_data['input_format'])
+            ]()
+            import_file = form.cleaned_data['import_file']
+            tmp_storage = self.write_to_tmp_storage(import_file, input_format)
+            try:
+                dataset = self.load_dataset(tmp_storage, input_format)
+            except UnicodeDecodeError as e:
+                return HttpResponse(
+                    _(u"<h1>Imported file has a wrong encoding: %s</h1>" % e))
+            except Exception as e:
+                return HttpResponse(
+                    _(u"<h1>%s encountered while trying to read file: "
+                      u"%s</h1>" % (type(e).__name__, import_file.name)))
+            result = resource.import_data(dataset, dry_run=True,
+                                          raise_errors=False,
+                                          file_name=import_file.name,
+                                          user=request.user)
+
+            context['result'] = result
+
+            if not result.has_errors():
+                context['confirm_form'] = ConfirmImportForm(initial={
+                    'import_file_name': tmp_storage.name,
+                    'original_file_name': import_file.name,
+                    'input_format': form.cleaned_data['input_format'],
+                })
+
+        context.update(self.admin_site.each_context(request))
+
+        context['title'] = _("Import")
+        context['form'] = form
+        context['opts'] = self.model._meta
+        context['fields'] = [f.column_name for f in
+                             resource.get_user_visible_fields()]
+
+        request.current_app = self.admin_site.name
+        return TemplateResponse(request, [self.import_template_name],
+                                context)
+
+    def process_import(self, request, *args, **kwargs):
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+
+        confirm_form = ConfirmImportForm(request.POST)
+        if confirm_form.is_valid():
+            import_formats = self.get_import_formats()
+            input_format = import_formats[
+                int(confirm_form.cleaned_data['input_format'])
+            ]()
+            tmp_storage = self.get_tmp_storage_class()(
+                name=confirm_form.cleaned_data['import_file_name'])
+            dataset = self.load_dataset(tmp_storage, input_format)
+
+            result = self.process_dataset(dataset, confirm_form, request,
+                                          *args, **kwargs)
+
+            tmp_storage.remove()
+
+            return self.process_result(result, request)
@@ -0,0 +1,134 @@
+"""Opt-in per-view instrumentation.
+
+Add "BMS.instrumentation.PerfMiddleware" to MIDDLEWARE (after the auth
+middleware) and set BMS_PERF_ENABLED = True. Every request resolved to a view
+writes one JSON line with its SQL count, SQL time, time spent calling
+external services (dingtalk, smtp) and total latency into logs/perf.log,
+see ``manage.py perf_summary`` for p50/p95 per view.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+from django.db import connection
+
+from BMS.tracing import span
+
+_local = threading.local()
+
+DEFAULT_LOG_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "logs", "perf.log"
+)
+
+
+def get_log_file():
+    return getattr(settings, "BMS_PERF_LOG_FILE", DEFAULT_LOG_FILE)
+
+
+def get_perf_logger():
+    logger = logging.getLogger("bms.perf")
+    if not logger.handlers:
+        handler = RotatingFileHandler(
+            get_log_file(),
+            maxBytes=getattr(settings, "BMS_PERF_LOG_MAX_BYTES", 10 * 1024 * 1024),
+            backupCount=getattr(settings, "BMS_PERF_LOG_BACKUP_COUNT", 5),
+            encoding="utf-8",
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of values, 0 when there are none"""
+    values = sorted(values)
+    if not values:
+        return 0
+    index = min(int(round(percent / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def get_stats():
+    """The stats of the request being handled by this thread, or None"""
+    return getattr(_local, "stats", None)
+
+
+@contextmanager
+def external_call(kind):
+    """Time a call to an external service, e.g. with external_call("smtp"),
+    the call is also a span of the current trace"""
+    start = time.time()
+    try:
+        with span("external.%s" % kind):
+            yield
+    finally:
+        stats = get_stats()
+        if stats is not None:
+            elapsed = (time.time() - start) * 1000
+            stats["external_ms"] += elapsed
+            stats["external"][kind] = stats["external"].get(kind, 0) + elapsed
+
+
+class QueryCounter(object):
+    """connection.execute_wrapper() counting and timing the queries"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.stats["sql_count"] += 1
+            self.stats["sql_ms"] += (time.time() - start) * 1000
+
+
+def get_view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return None
+    if match.url_name:
+        return ":".join(match.namespaces + [match.url_name])
+    return match._func_path
+
+
+class PerfMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, "BMS_PERF_ENABLED", False):
+            return self.get_response(request)
+        stats = {
+            "sql_count": 0, "sql_ms": 0.0, "external_ms": 0.0, "external": {}
+        }
+        _local.stats = stats
+        start = time.time()
+        try:
+            with connection.execute_wrapper(QueryCounter(stats)):
+                response = self.get_response(request)
+        finally:
+            _local.stats = None
+        view = get_view_name(request)
+        if view is not None:
+            stats.update(
+                ts=round(start, 3),
+                view=view,
+                method=request.method,
+                status=response.status_code,
+                total_ms=(time.time() - start) * 1000,
+            )
+            for key in ("sql_ms", "external_ms", "total_ms"):
+                stats[key] = round(stats[key], 2)
+            get_perf_logger().info(json.dumps(stats, sort_keys=True))
+        return response
@@ -0,0 +1,442 @@
+"""Prometheus metrics of BMS, served as text by metrics_view on /metrics.
+
+Set BMS_METRICS_ENABLED = True and add "BMS.metrics.MetricsMiddleware" to
+MIDDLEWARE (after the auth middleware). Every process (gunicorn/uwsgi
+workers, celery pool processes) keeps its samples in memory and writes them
+to BMS_METRICS_DIR/<host>-<pid>-<start time>.json at most every
+BMS_METRICS_FLUSH_INTERVAL seconds; the view adds up the files of all the
+processes, so the counters keep growing when a worker is recycled. The view
+also adds the files of the dead processes of its host to dead.json and
+removes them, the directory does not grow with every recycled worker.
+
+The view answers the staff users and the requests with the header
+"Authorization: Bearer <BMS_METRICS_TOKEN>" (for prometheus).
+"""
+import atexit
+import fcntl
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from BMS.instrumentation import QueryCounter, get_view_name
+
+DEFAULT_METRICS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "logs", "metrics"
+)
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300)
+QUERY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+DEAD_FILE = "dead.json"
+LOCK_FILE = ".lock"
+
+
+class Metric(object):
+
+    def __init__(self, name, help, kind, labelnames=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets or ())
+
+
+METRICS = {}
+
+
+def register(name, help, kind, labelnames=(), buckets=None):
+    METRICS[name] = Metric(name, help, kind, labelnames, buckets)
+    return name
+
+
+REQUEST_SECONDS = register(
+    "bms_request_duration_seconds", "Latency of the requests per view",
+    "histogram", ("view", "method"), SECONDS_BUCKETS)
+REQUEST_QUERIES = register(
+    "bms_request_queries", "SQL queries per request per view",
+    "histogram", ("view", ), QUERY_BUCKETS)
+NOTIFICATION_SECONDS = register(
+    "bms_notification_send_seconds", "Latency of sending a notification",
+    "histogram", ("channel", ), SECONDS_BUCKETS)
+NOTIFICATION_FAILURES = register(
+    "bms_notification_failures_total", "Notifications which failed to send",
+    "counter", ("channel", ))
+TASK_SECONDS = register(
+    "bms_celery_task_duration_seconds", "Duration of the celery tasks",
+    "histogram", ("task", "state"), SECONDS_BUCKETS)
+ROWS = register(
+    "bms_import_export_rows_total", "Rows imported or exported",
+    "counter", ("model", "operation"))
+ROWS_SECONDS = register(
+    "bms_import_export_seconds", "Duration of the imports and exports",
+    "histogram", ("model", "operation"), SECONDS_BUCKETS)
+CACHE_REQUESTS = register(
+    "bms_cache_requests_total", "Lookups of the cached values, by result",
+    "counter", ("cache", "result"))
+
+
+def is_enabled():
+    return getattr(settings, "BMS_METRICS_ENABLED", False)
+
+
+def get_metrics_dir():
+    return getattr(settings, "BMS_METRICS_DIR", DEFAULT_METRICS_DIR)
+
+
+def sample_key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+class ProcessStore(object):
+    """The samples of the current process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.file_name = None
+        self.samples = {}
+        self.last_flush = 0
+
+    def _check_fork(self):
+        # A forked child starts empty, its parent reports what it inherited
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            # The start time keeps a reused pid from overwriting the file
+            # of an older process
+            self.file_name = "%s-%s-%s.json" % (
+                socket.gethostname(), self.pid, int(time.time() * 1000))
+            self.samples = {}
+            self.last_flush = time.time()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self._check_fork()
+            key = sample_key(name, labels)
+            self.samples[key] = self.samples.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name].buckets
+        with self.lock:
+            self._check_fork()
+            key = sample_key(name, labels)
+            sample = self.samples.get(key)
+            if sample is None:
+                sample = self.samples[key] = {
+                    "buckets": [0] * len(buckets), "sum": 0, "count": 0,
+                }
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    sample["buckets"][index] += 1
+                    break
+            sample["sum"] += value
+            sample["count"] += 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        interval = getattr(settings, "BMS_METRICS_FLUSH_INTERVAL", 5)
+        if time.time() - self.last_flush >= interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self._check_fork()
+            if not self.samples:
+                return
+            data = json.dumps(self.samples)
+            self.last_flush = time.time()
+            file_name = self.file_name
+        directory = get_metrics_dir()
+        os.makedirs(directory, exist_ok=True)
+        write_file(os.path.join(directory, file_name), data)
+
+
+def write_file(path, data):
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+store = ProcessStore()
+
+
+def _flush_at_exit():
+    if is_enabled():
+        try:
+            store.flush()
+        except Exception:
+            pass
+
+
+atexit.register(_flush_at_exit)
+
+
+def inc(name, value=1, **labels):
+    if is_enabled():
+        store.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    if is_enabled():
+        store.observe(name, value, **labels)
+
+
+def record_cache(cache_name, hit):
+    inc(CACHE_REQUESTS, cache=cache_name, result="hit" if hit else "miss")
+
+
+@contextmanager
+def track_notification(channel):
+    """Time sending a notification, count it as failed if it raises"""
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        inc(NOTIFICATION_FAILURES, channel=channel)
+        raise
+    finally:
+        observe(NOTIFICATION_SECONDS, time.time() - start, channel=channel)
+
+
+def record_rows(model, operation, rows, seconds):
+    label = model._meta.label_lower
+    inc(ROWS, rows, model=label, operation=operation)
+    observe(ROWS_SECONDS, seconds, model=label, operation=operation)
+
+
+class ResourceMetricsMixin(object):
+    """import_export resource mixin counting the imported/exported rows"""
+
+    def import_data(self, dataset, dry_run=False, *args, **kwargs):
+        start = time.time()
+        result = super().import_data(dataset, dry_run, *args, **kwargs)
+        record_rows(self._meta.model,
+                    "import_dry_run" if dry_run else "import",
+                    len(dataset), time.time() - start)
+        return result
+
+    def export(self, queryset=None, *args, **kwargs):
+        start = time.time()
+        data = super().export(queryset, *args, **kwargs)
+        record_rows(self._meta.model, "export", len(data), time.time() - start)
+        return data
+
+
+# Celery
+_task_starts = {}
+
+
+def task_prerun_handler(task_id=None, **kwargs):
+    _task_starts[task_id] = time.time()
+
+
+def task_postrun_handler(task_id=None, task=None, state=None, **kwargs):
+    start = _task_starts.pop(task_id, None)
+    if start is not None and task is not None:
+        observe(TASK_SECONDS, time.time() - start, task=task.name,
+                state=state or "UNKNOWN")
+
+
+def connect_celery_signals():
+    from celery.signals import task_postrun, task_prerun
+    task_prerun.connect(task_prerun_handler, weak=False,
+                        dispatch_uid="bms_metrics_prerun")
+    task_postrun.connect(task_postrun_handler, weak=False,
+                         dispatch_uid="bms_metrics_postrun")
+
+
+# Requests
+class MetricsMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_enabled():
+            return self.get_response(request)
+        stats = {"sql_count": 0, "sql_ms": 0.0}
+        start = time.time()
+        with connection.execute_wrapper(QueryCounter(stats)):
+            response = self.get_response(request)
+        view = get_view_name(request) or "unresolved"
+        observe(REQUEST_SECONDS, time.time() - start, view=view,
+                method=request.method)
+        observe(REQUEST_QUERIES, stats["sql_count"], view=view)
+        return response
+
+
+# Exposition
+def read_samples(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def merge_samples(merged, samples):
+    for key, value in samples.items():
+        if isinstance(value, dict):
+            total = merged.setdefault(key, {
+                "buckets": [0] * len(value["buckets"]), "sum": 0,
+                "count": 0,
+            })
+            total["buckets"] = [
+                a + b for a, b in zip(total["buckets"], value["buckets"])
+            ]
+            total["sum"] += value["sum"]
+            total["count"] += value["count"]
+        else:
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def is_dead_process_file(path, hostname):
+    """The file of a process of this host which is gone"""
+    parts = os.path.basename(path)[:-len(".json")].rsplit("-", 2)
+    if len(parts) != 3 or parts[0] != hostname or not parts[1].isdigit():
+        return False
+    try:
+        os.kill(int(parts[1]), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def compact_dead_files(directory):
+    """Add the samples of the dead processes of this host to dead.json"""
+    os.makedirs(directory, exist_ok=True)
+    hostname = socket.gethostname()
+    with open(os.path.join(directory, LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead = [path for path in glob.glob(os.path.join(directory, "*.json"))
+                if is_dead_process_file(path, hostname)]
+        if not dead:
+            return
+        dead_path = os.path.join(directory, DEAD_FILE)
+        merged = read_samples(dead_path) or {}
+        for path in dead:
+            merge_samples(merged, read_samples(path) or {})
+        write_file(dead_path, json.dumps(merged))
+        for path in dead:
+            os.remove(path)
+
+
+def collect():
+    """The samples of all the processes added up"""
+    if is_enabled():
+        store.flush()
+    directory = get_metrics_dir()
+    compact_dead_files(directory)
+    merged = {}
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        samples = read_samples(path)
+        if samples is not None:
+            merge_samples(merged, samples)
+    return merged
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+
+
+def format_number(value):
+    if isinstance(value, float) and value != int(value):
+        return repr(value)
+    return str(int(value))
+
+
+def render_samples(samples):
+    by_name = {}
+    for key, value in samples.items():
+        name, labels = json.loads(key)
+        by_name.setdefault(name, []).append(([tuple(l) for l in labels],
+                                             value))
+    lines = []
+    for name in sorted(by_name):
+        metric = METRICS.get(name)
+        if metric is None:
+            continue
+        lines.append("# HELP %s %s" % (name, metric.help))
+        lines.append("# TYPE %s %s" % (name, metric.kind))
+        for labels, value in sorted(by_name[name]):
+            if metric.kind == "histogram":
+                cumulative = 0
+                for bound, count in zip(metric.buckets, value["buckets"]):
+                    cumulative += count
+                    lines.append("%s_bucket%s %s" % (
+                        name, format_labels(labels + [("le", bound)]),
+                        cumulative))
+                lines.append("%s_bucket%s %s" % (
+                    name, format_labels(labels + [("le", "+Inf")]),
+                    value["count"]))
+                lines.append("%s_sum%s %s" % (
+                    name, format_labels(labels), format_number(value["sum"])))
+                lines.append("%s_count%s %s" % (
+                    name, format_labels(labels), value["count"]))
+            else:
+                lines.append("%s%s %s" % (name, format_labels(labels),
+                                          format_number(value)))
+    return lines
+
+
+def render_outbox():
+    """The outbox counters live in the cache and the database"""
+    from nm.models import NotificationOutbox
+    from nm.outbox import get_coalesce_stats
+
+    stats = get_coalesce_stats()
+    pending = NotificationOutbox.objects.filter(
+        status=NotificationOutbox.STATUS_PENDING).count()
+    failed = NotificationOutbox.objects.filter(
+        status=NotificationOutbox.STATUS_FAILED).count()
+    return [
+        "# HELP bms_notification_coalesced_messages_total Group messages "
+        "handed to the outbox coalescer",
+        "# TYPE bms_notification_coalesced_messages_total counter",
+        "bms_notification_coalesced_messages_total %s" % stats["messages"],
+        "# HELP bms_notification_coalesced_sent_total Group messages sent "
+        "after coalescing",
+        "# TYPE bms_notification_coalesced_sent_total counter",
+        "bms_notification_coalesced_sent_total %s" % stats["sent"],
+        "# HELP bms_notification_outbox_rows Outbox rows by status",
+        "# TYPE bms_notification_outbox_rows gauge",
+        'bms_notification_outbox_rows{status="pending"} %s' % pending,
+        'bms_notification_outbox_rows{status="failed"} %s' % failed,
+    ]
+
+
+def is_metrics_request_allowed(request):
+    user = getattr(request, "user", None)
+    if user is not None and user.is_active and user.is_staff:
+        return True
+    token = getattr(settings, "BMS_METRICS_TOKEN", None)
+    header = request.META.get("HTTP_AUTHORIZATION", "")
+    return bool(token) and header.startswith("Bearer ") and \
+        constant_time_compare(header[len("Bearer "):], token)
+
+
+def metrics_view(request):
+    if not is_metrics_request_allowed(request):
+        return HttpResponseForbidden()
+    lines = render_samples(collect()) + render_outbox()
+    return HttpResponse("\n".join(lines) + "\n",
+                        content_type="text/plain; version=0.0.4")
@@ -0,0 +1,188 @@
+"""Delivery backends used by the notification mixin and the outbox worker.
+
+Set ``DINGTALK_BACKEND`` in settings to choose the dingtalk backend, the
+locmem one keeps the messages in memory for tests. Emails are delivered
+through django's own ``EMAIL_BACKEND`` which already has a locmem backend,
+each thread keeps one email connection open and reuses it.
+"""
+import smtplib
+import threading
+import time
+
+from dingtalk_sdk_gmdzy2010.message_request import (
+    SendGroupChatRequest, WorkNoticeRequest
+)
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.utils.module_loading import import_string
+
+from BMS.dingtalk_token import INVALID_TOKEN_ERRCODES, get_token_manager
+from BMS.instrumentation import external_call
+from BMS.metrics import (
+    NOTIFICATION_FAILURES, NOTIFICATION_SECONDS, inc, observe,
+    track_notification
+)
+
+
+class DingtalkSendError(Exception):
+    pass
+
+
+class BaseDingtalkBackend(object):
+    """Interface of dingtalk backends, failures raise DingtalkSendError"""
+    def __init__(self, appkey=None, appsecret=None):
+        self.appkey = appkey
+        self.appsecret = appsecret
+
+    def send_work_notice(self, content, sender, recipient_list):
+        raise NotImplementedError
+
+    def send_group_message(self, content, chat_id):
+        raise NotImplementedError
+
+
+class DingtalkBackend(BaseDingtalkBackend):
+    """Call the dingtalk api with the cached access_token"""
+    def post(self, request_class, data):
+        manager = get_token_manager(self.appkey, self.appsecret)
+        json_response = {}
+        for _ in range(2):
+            params = {"access_token": manager.get_token()}
+            request = request_class(params=params, json=data)
+            request.request_method = "post"
+            with external_call("dingtalk"):
+                json_response = request.get_json_response() or {}
+            if request.call_status:
+                return json_response
+            if json_response.get("errcode") not in INVALID_TOKEN_ERRCODES:
+                break
+            manager.invalidate()
+        raise DingtalkSendError(
+            "%s: %s" % (json_response.get("errcode"),
+                        json_response.get("errmsg"))
+        )
+
+    def send_work_notice(self, content, sender, recipient_list):
+        data = {
+            "agent_id": sender,
+            "userid_list": recipient_list,
+            "msg": {"msgtype": "text", "text": {"content": content}}
+        }
+        with track_notification("work_notice"):
+            return self.post(WorkNoticeRequest, data)
+
+    def send_group_message(self, content, chat_id):
+        data = {
+            "chatid": chat_id,
+            "msg": {"msgtype": "text", "text": {"content": content}}
+        }
+        with track_notification("group_message"):
+            return self.post(SendGroupChatRequest, data)
+
+
+class LocmemDingtalkBackend(BaseDingtalkBackend):
+    """Keep the sent messages in ``LocmemDingtalkBackend.outbox``"""
+    outbox = []
+
+    def send_work_notice(self, content, sender, recipient_list):
+        self.outbox.append({
+            "type": "work_notice", "content": content, "sender": sender,
+            "recipient_list": recipient_list,
+        })
+
+    def send_group_message(self, content, chat_id):
+        self.outbox.append({
+            "type": "group_message", "content": content, "chat_id": chat_id,
+        })
+
+
+def get_dingtalk_backend(appkey=None, appsecret=None):
+    backend = getattr(
+        settings, "DINGTALK_BACKEND", "BMS.notice_backends.DingtalkBackend"
+    )
+    return import_string(backend)(appkey=appkey, appsecret=appsecret)
+
+
+def build_email_message(subject, content, sender, recipient_list,
+                        html_message=None, connection=None):
+    message = EmailMultiAlternatives(
+        subject, content, sender, recipient_list, connection=connection
+    )
+    if html_message:
+        message.attach_alternative(html_message, "text/html")
+    return message
+
+
+_local = threading.local()
+
+
+def get_pooled_connection():
+    """The email connection of the current thread, opened on first use and
+    reopened when it has been idle longer than EMAIL_POOL_MAX_IDLE."""
+    max_idle = getattr(settings, "EMAIL_POOL_MAX_IDLE", 60)
+    connection = getattr(_local, "email_connection", None)
+    if connection is not None and time.time() - _local.last_used > max_idle:
+        close_pooled_connection()
+        connection = None
+    if connection is None:
+        connection = get_connection(fail_silently=False)
+        with external_call("smtp"):
+            connection.open()
+        _local.email_connection = connection
+    _local.last_used = time.time()
+    return connection
+
+
+def close_pooled_connection():
+    connection = getattr(_local, "email_connection", None)
+    _local.email_connection = None
+    if connection is not None:
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+def send_email_messages(messages):
+    """Send the messages over the pooled connection, return a list of
+    (message, error) where error is None for the delivered ones."""
+    results = []
+    for message in messages:
+        error = None
+        start = time.time()
+        for _ in range(2):
+            try:
+                connection = get_pooled_connection()
+                message.connection = connection
+                with external_call("smtp"):
+                    sent = connection.send_messages([message])
+                if not sent:
+                    raise smtplib.SMTPException("The message was not sent")
+                error = None
+                break
+            except smtplib.SMTPServerDisconnected as e:
+                # The server dropped the idle connection, reconnect once
+                close_pooled_connection()
+                error = e
+            except Exception as e:
+                # Do not reuse a connection in an unknown state
+                close_pooled_connection()
+                error = e
+                break
+        observe(NOTIFICATION_SECONDS, time.time() - start, channel="email")
+        if error is not None:
+            inc(NOTIFICATION_FAILURES, channel="email")
+        results.append((message, error))
+    return results
+
+
+def send_email_message(subject, content, sender, recipient_list,
+                       html_message=None):
+    """The same as django send_mail() but always raises on failure"""
+    message = build_email_message(
+        subject, content, sender, recipient_list, html_message
+    )
+    message, error = send_email_messages([message])[0]
+    if error is not None:
+        raise error
+    return 1
@@ -1,15 +1,33 @@
-from dingtalk_sdk_gmdzy2010.authority_request import AccessTokenRequest
-from dingtalk_sdk_gmdzy2010.message_request import (
-    SendGroupChatRequest, WorkNoticeRequest
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from BMS.dingtalk_token import get_token_manager
+from BMS.notice_backends import (
+    build_email_message, get_dingtalk_backend, send_email_messages
 )
-from django.core.mail import send_mail
+from BMS.tracing import traced
 
 
 class NotificationMixinBase(object):
     """The base class for notifications including email, short message or
     dingtalk notice.
+
+    When settings.NOTIFICATION_USE_OUTBOX is on (default), notifications are
+    saved into nm.models.NotificationOutbox and delivered by celery after the
+    transaction commits, the send_*_result then means "queued". The send_*
+    methods take a dedup_key naming the event, e.g. "pm.subproject:12:start":
+    the outbox delivers a notification of an event only once.
     """
-    pass
+
+    def enqueue_notification(self, channel, payload, dedup_key=None,
+                             schedule=True):
+        """The outbox row, None when the outbox is off"""
+        from nm.outbox import enqueue, use_outbox
+        if not use_outbox():
+            return None
+        return enqueue(channel, payload, dedup_key=dedup_key,
+                       schedule=schedule)
 
 
 class DingtalkNotificationMixin(NotificationMixinBase):
@@ -17,51 +35,136 @@ class DingtalkNotificationMixin(NotificationMixinBase):
     appkey = None
     appsecret = None
     send_dingtalk_result = False
-    
+
     def get_dingtalk_token(self):
-        params = {"appkey": self.appkey, "appsecret": self.appsecret}
-        request = AccessTokenRequest(params=params)
-        request.get_json_response()
-        return request.get_access_token()
-    
-    def send_work_notice(self, content, sender, recipient_list):
-        params = {"access_token": self.get_dingtalk_token()}
-        data = {
-            "agent_id": sender,
-            "userid_list": recipient_list,
-            "msg": {"msgtype": "text", "text": {"content": content}}
-        }
-        request = WorkNoticeRequest(params=params, json=data)
-        request.request_method = "post"
-        request.get_json_response()
-        self.send_dingtalk_result = request.call_status
-    
-    def send_group_message(self, content, chat_id):
-        params = {"access_token": self.get_dingtalk_token()}
-        data = {
-            "chatid": chat_id,
-            "msg": {"msgtype": "text", "text": {"content": content}}
+        """The token is cached and shared, see BMS.dingtalk_token"""
+        return get_token_manager(self.appkey, self.appsecret).get_token()
+
+    def get_dingtalk_backend(self):
+        return get_dingtalk_backend(self.appkey, self.appsecret)
+
+    @traced("notify.work_notice")
+    def send_work_notice(self, content, sender, recipient_list,
+                         dedup_key=None):
+        payload = {
+            "content": content, "sender": sender,
+            "recipient_list": recipient_list,
         }
-        request = SendGroupChatRequest(params=params, json=data)
-        request.request_method = "post"
-        request.get_json_response()
-        self.send_dingtalk_result = request.call_status
+        try:
+            if not self.enqueue_notification("work_notice", payload,
+                                             dedup_key):
+                self.get_dingtalk_backend().send_work_notice(
+                    content, sender, recipient_list
+                )
+            self.send_dingtalk_result = True
+        except Exception:
+            self.send_dingtalk_result = False
+
+    @traced("notify.group_message")
+    def send_group_message(self, content, chat_id, dedup_key=None):
+        payload = {"content": content, "chat_id": chat_id}
+        try:
+            if not self.enqueue_notification("group_message", payload,
+                                             dedup_key):
+                self.get_dingtalk_backend().send_group_message(
+                    content, chat_id
+                )
+            self.send_dingtalk_result = True
+        except Exception:
+            self.send_dingtalk_result = False
+
+
+class EmailBatch(object):
+    """The emails of an email_batch() block, sent when the block ends"""
+
+    def __init__(self):
+        self.messages = []
+        # The outbox rows, delivered by one task after the block
+        self.outbox_pks = []
+        # [(recipient_list, error), ...] once sent
+        self.results = []
+
+    @property
+    def sent(self):
+        return all(error is None for recipients, error in self.results)
+
+
+# The admins are shared by the requests, the batch belongs to the thread
+_local = threading.local()
+
+
+def get_email_batch():
+    return getattr(_local, "email_batch", None)
 
 
 class EmailNotificationMixin(NotificationMixinBase):
     """Mixin that supply email functions to admin"""
-    send_email_result = False
-    
+
+    @traced("notify.email")
     def send_email(self, content, sender, recipient_list, **kwargs):
-        """This method is totally a copy of django send_mail()"""
+        """The same arguments as django send_mail(), returns whether the
+        email was sent (queued in the outbox or in the current batch)"""
         subject = kwargs.get("subject", "【BMS系统通知】")
+        payload = {
+            "subject": subject, "content": content, "sender": sender,
+            "recipient_list": list(recipient_list),
+            "html_message": kwargs.get("html_message"),
+        }
+        batch = get_email_batch()
         try:
-            send_mail(subject, content, sender, recipient_list, **kwargs)
-            self.send_email_result = True
+            outbox = self.enqueue_notification(
+                "email", payload, kwargs.get("dedup_key"),
+                schedule=batch is None
+            )
         except:
-            self.send_email_result = False
+            return False
+        if outbox is not None:
+            if batch is not None:
+                batch.outbox_pks.append(outbox.pk)
+            return True
+        message = build_email_message(
+            subject, content, sender, recipient_list,
+            kwargs.get("html_message")
+        )
+        if batch is not None:
+            # Sent with the other messages of the batch, see email_batch()
+            batch.messages.append(message)
+            return True
+        results = self.send_email_messages([message])
+        return all(error is None for recipients, error in results)
+
+    def send_email_messages(self, messages):
+        """[(recipient_list, error), ...] of the messages"""
+        return [(m.to, error) for m, error in send_email_messages(messages)]
+
+    @contextmanager
+    def email_batch(self):
+        """Send the emails of the block at the end over one connection, the
+        yielded EmailBatch has the results after the block. With the outbox
+        the emails are queued, one task delivers them after the commit."""
+        batch = EmailBatch()
+        previous = get_email_batch()
+        _local.email_batch = batch
+        try:
+            yield batch
+        finally:
+            _local.email_batch = previous
+            if batch.messages:
+                batch.results = self.send_email_messages(batch.messages)
+            if batch.outbox_pks:
+                from nm.outbox import schedule_emails
+                schedule_emails(batch.outbox_pks)
+
+
+def batch_emails(action):
+    """Decorator for admin actions sending an email per selected object"""
+    @wraps(action)
+    def wrapper(self, request, queryset):
+        with self.email_batch():
+            return action(self, request, queryset)
+    return wrapper
+
 
-    
 class NotificationMixin(EmailNotificationMixin, DingtalkNotificationMixin):
     """Mixin that both contain email and dingtalk"""
     pass
@@ -0,0 +1,111 @@
+"""Cheap counts for the changelists of the big tables.
+
+The admin counts the filtered queryset for the paginator and, unless
+show_full_result_count is disabled, the whole table again on every page.
+ApproximateCountMixin disables the second count and paginates with
+ApproximateCountPaginator:
+
+* an unfiltered table uses the row estimate of the database statistics
+  (postgresql, mysql) once it is big enough, otherwise an exact count
+  cached for BMS_APPROX_COUNT_TIMEOUT seconds;
+* a filtered queryset is counted exactly as long as it has at most
+  BMS_APPROX_COUNT_EXACT_LIMIT rows, a bigger one gets a cached count.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.utils.functional import cached_property
+
+from BMS.metrics import record_cache
+
+
+def get_timeout():
+    return getattr(settings, "BMS_APPROX_COUNT_TIMEOUT", 300)
+
+
+def get_exact_limit():
+    return getattr(settings, "BMS_APPROX_COUNT_EXACT_LIMIT", 1000)
+
+
+def get_min_estimate():
+    """The statistics of small tables are too rough, count those"""
+    return getattr(settings, "BMS_APPROX_COUNT_MIN_ROWS", 10000)
+
+
+def get_table_estimate(model, using="default"):
+    """The number of rows of the table according to the statistics of the
+    database, None when the database has none."""
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == "postgresql":
+        sql = "SELECT reltuples FROM pg_class WHERE oid = %s::regclass"
+        params = [connection.ops.quote_name(table)]
+    elif connection.vendor == "mysql":
+        sql = ("SELECT TABLE_ROWS FROM information_schema.TABLES "
+               "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s")
+        params = [table]
+    else:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+def is_unfiltered(queryset):
+    query = queryset.query
+    return (not query.where and not query.distinct
+            and query.low_mark == 0 and query.high_mark is None)
+
+
+def get_cached_count(queryset):
+    """An exact count, computed at most every BMS_APPROX_COUNT_TIMEOUT"""
+    sql = str(queryset.order_by().query)
+    key = "bms:approx_count:%s:%s" % (
+        queryset.model._meta.label_lower,
+        hashlib.md5(sql.encode("utf-8")).hexdigest(),
+    )
+    count = cache.get(key)
+    record_cache("approx_count", count is not None)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, get_timeout())
+    return count
+
+
+class ApproximateCountPaginator(Paginator):
+    """``is_approximate`` tells whether ``count`` may be off"""
+    is_approximate = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not hasattr(queryset, "query"):
+            return super(ApproximateCountPaginator, self).count
+        if is_unfiltered(queryset):
+            estimate = get_table_estimate(queryset.model, queryset.db)
+            if estimate is not None and estimate >= get_min_estimate():
+                self.is_approximate = True
+                return estimate
+            return get_cached_count(queryset)
+        # Stop counting a filtered queryset after the limit
+        limit = get_exact_limit()
+        count = queryset.order_by()[:limit + 1].count()
+        if count <= limit:
+            return count
+        self.is_approximate = True
+        return get_cached_count(queryset)
+
+
+class ApproximateCountMixin(object):
+    """ModelAdmin mixin for the changelists of the big tables"""
+    show_full_result_count = False
+    paginator = ApproximateCountPaginator
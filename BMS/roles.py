@@ -0,0 +1,131 @@
+"""The groups (roles) of the current user, resolved once per request.
+
+RoleMiddleware sets ``request.bms_roles`` lazily, the admins call
+get_roles(request) which also works without the middleware. The groups are
+cached for BMS_ROLES_CACHE_TIMEOUT seconds and the cache is dropped as soon
+as group membership or permissions change.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.utils.functional import SimpleLazyObject
+
+from BMS.metrics import record_cache
+
+# The ids of the groups in the database
+EXP = 1  # 实验部
+PM = 2  # 项目管理
+SALES = 3  # 业务员（销售）
+MARKET = 4  # 市场部
+FINANCE = 5  # 财务部
+COMPANY = 6  # 公司
+SALES_DIRECTOR = 7  # 销售总监
+COOPERATION = 8  # 合作伙伴
+ANALYST = 9  # 分析员
+ANALYST_MANAGER = 10  # 项目部门总监（分析）
+MARKET_PRODUCT = 11  # 市场产品组
+MARKET_DIRECTOR = 12  # 市场部总监
+SEQ_EXPERIMENTER = 13  # 测序实验员
+FINANCE_DIRECTOR = 14  # 财务总监
+MARKET_PROJECT = 15  # 市场部项目组
+
+GroupInfo = namedtuple("GroupInfo", ("id", "name"))
+
+GENERATION_KEY = "bms:roles:generation"
+
+
+class Roles(object):
+    """The groups of a user in the order the database returns them, the
+    admins often only look at the first one."""
+
+    def __init__(self, groups=()):
+        self.groups = [GroupInfo(*group) for group in groups]
+        self.ids = set(group.id for group in self.groups)
+        self.names = [group.name for group in self.groups]
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __getitem__(self, index):
+        return self.groups[index]
+
+    @property
+    def first_name(self):
+        return self.names[0] if self.names else None
+
+    def has_id(self, *ids):
+        return not self.ids.isdisjoint(ids)
+
+    def has_name(self, *names):
+        return any(name in self.names for name in names)
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 1, None)
+        generation = cache.get(GENERATION_KEY, 1)
+    return generation
+
+
+def resolve_roles(user):
+    if not user.is_authenticated:
+        return Roles()
+    key = "bms:roles:%s:%s" % (get_generation(), user.pk)
+    groups = cache.get(key)
+    record_cache("roles", groups is not None)
+    if groups is None:
+        groups = list(Group.objects.filter(user=user).values_list("id", "name"))
+        cache.set(key, groups, getattr(settings, "BMS_ROLES_CACHE_TIMEOUT", 60))
+    return Roles(groups)
+
+
+def get_roles(request):
+    roles = getattr(request, "bms_roles", None)
+    if roles is None:
+        roles = resolve_roles(request.user)
+        request.bms_roles = roles
+    return roles
+
+
+class RoleMiddleware(object):
+    """Add "BMS.roles.RoleMiddleware" after AuthenticationMiddleware"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.bms_roles = SimpleLazyObject(
+            lambda: resolve_roles(request.user)
+        )
+        return self.get_response(request)
+
+
+def invalidate(**kwargs):
+    """Groups and permissions are shared by many users, drop everything
+    cached for them by moving to a new generation."""
+    update_fields = kwargs.get("update_fields")
+    if update_fields and set(update_fields) <= {"last_login"}:
+        # Saved by every login, nothing the roles depend on
+        return
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, 1, None)
+
+
+for through in (User.groups.through, User.user_permissions.through,
+                Group.permissions.through):
+    m2m_changed.connect(invalidate, sender=through,
+                        dispatch_uid="bms_roles_%s" % through.__name__)
+for model in (User, Group, Permission):
+    post_save.connect(invalidate, sender=model,
+                      dispatch_uid="bms_roles_save_%s" % model.__name__)
+    post_delete.connect(invalidate, sender=model,
+                        dispatch_uid="bms_roles_delete_%s" % model.__name__)
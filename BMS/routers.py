@@ -0,0 +1,153 @@
+"""Send the reporting reads to a read replica.
+
+Only the code run inside ``with use_replica():`` (exports, changelist totals,
+dashboards) reads from the replica, everything else and every write stays on
+the primary. The router is active when settings has
+
+    DATABASES["replica"] = {... the replica ..., "TEST": {"MIRROR": "default"}}
+    DATABASE_ROUTERS = ["BMS.routers.ReplicaRouter"]
+
+and "BMS.routers.ReplicaPinMiddleware" is in MIDDLEWARE after the session
+middleware. Reads go back to the primary
+
+* for BMS_REPLICA_PIN_SECONDS after the session wrote something, so a user
+  always sees their own saves (read-your-writes);
+* while the replica lags more than BMS_REPLICA_MAX_LAG seconds (mysql),
+  checked at most every BMS_REPLICA_LAG_CHECK_INTERVAL seconds; a mysql
+  replica whose status cannot be read or which does not replicate counts
+  as lagging.
+
+Two SQLite databases are enough to try it out.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+REPLICA = "replica"
+PIN_SESSION_KEY = "_bms_primary_until"
+UNKNOWN_LAG = float("inf")
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_lag = {"checked_at": 0, "lag": None}
+
+
+def has_replica():
+    return REPLICA in connections.databases
+
+
+@contextmanager
+def use_replica():
+    """Read from the replica in this block, unless pinned to the primary"""
+    _local.replica = getattr(_local, "replica", 0) + 1
+    try:
+        yield
+    finally:
+        _local.replica -= 1
+
+
+def pin_to_primary():
+    """Read from the primary for the rest of the request"""
+    _local.pinned = True
+
+
+def get_replica_lag():
+    """Seconds the replica is behind, UNKNOWN_LAG when it is not replicating
+    or its status cannot be read, None for the databases without a lag
+    (sqlite)"""
+    connection = connections[REPLICA]
+    if connection.vendor != "mysql":
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW SLAVE STATUS")
+            row = cursor.fetchone()
+            if row is None:
+                # Not a replica at all
+                return UNKNOWN_LAG
+            columns = [column[0] for column in cursor.description]
+    except DatabaseError:
+        logger.exception("Could not read the replica status")
+        return UNKNOWN_LAG
+    lag = dict(zip(columns, row)).get("Seconds_Behind_Master")
+    if lag is None:
+        # NULL while the replication is stopped or broken
+        return UNKNOWN_LAG
+    return lag
+
+
+def is_replica_lagging():
+    max_lag = getattr(settings, "BMS_REPLICA_MAX_LAG", 30)
+    interval = getattr(settings, "BMS_REPLICA_LAG_CHECK_INTERVAL", 10)
+    now = time.time()
+    if now - _lag["checked_at"] >= interval:
+        _lag["lag"] = get_replica_lag()
+        _lag["checked_at"] = now
+    return _lag["lag"] is not None and _lag["lag"] > max_lag
+
+
+def should_use_replica():
+    return (getattr(_local, "replica", 0) > 0
+            and not getattr(_local, "pinned", False)
+            and not getattr(_local, "wrote", False)
+            and has_replica()
+            and not is_replica_lagging())
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        if should_use_replica():
+            return REPLICA
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # The reads after a write in this request see the write
+        _local.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both databases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA
+
+
+class ReplicaPinMiddleware(object):
+    """Pin the reads of a session to the primary after it wrote"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        session = getattr(request, "session", None)
+        _local.wrote = False
+        _local.pinned = bool(
+            session is not None
+            and session.get(PIN_SESSION_KEY, 0) > time.time()
+        )
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = getattr(_local, "wrote", False)
+            _local.wrote = False
+            _local.pinned = False
+        if wrote and session is not None:
+            session[PIN_SESSION_KEY] = time.time() + getattr(
+                settings, "BMS_REPLICA_PIN_SECONDS", 10
+            )
+        return response
+
+
+class ReplicaExportMixin(object):
+    """import_export resource mixin exporting from the replica"""
+
+    def export(self, queryset=None, *args, **kwargs):
+        with use_replica():
+            return super().export(queryset, *args, **kwargs)
@@ -0,0 +1,54 @@
+"""Settings of ``manage.py bms_benchmark``.
+
+The usual settings on a throwaway SQLite database with in-memory cache,
+dingtalk and email backends: nothing is sent and the production database
+is never touched. The tests run with them too:
+
+    python manage.py test --settings=BMS.settings_benchmark
+"""
+import os
+import tempfile
+
+from BMS.settings import *  # noqa
+
+# Out of the source tree, BMS_BENCHMARK_DB to keep it elsewhere
+BENCHMARK_DB = os.environ.get(
+    "BMS_BENCHMARK_DB",
+    os.path.join(tempfile.gettempdir(), "bms_benchmark.sqlite3")
+)
+
+DEBUG = False
+# the requests come from django.test.Client
+ALLOWED_HOSTS = ["*"]
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BENCHMARK_DB,
+    },
+    # A second alias of the same file, for the tests of BMS.routers. The
+    # router is only active where DATABASE_ROUTERS lists it.
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BENCHMARK_DB,
+        "TEST": {"MIRROR": "default"},
+    },
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "bms-benchmark",
+    }
+}
+
+PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+
+EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+DINGTALK_BACKEND = "BMS.notice_backends.LocmemDingtalkBackend"
+NOTIFICATION_USE_OUTBOX = False
+
+CELERY_ALWAYS_EAGER = True
+BROKER_URL = "memory://"
+
+BMS_PERF_ENABLED = False
@@ -0,0 +1,116 @@
+"""Import-time profile of the project, run in a fresh interpreter by
+``manage.py bms_startup_profile`` as ``python -X importtime <this file>``.
+
+Network I/O is refused while django is set up and the modules of the apps
+are imported: every attempt is recorded with the project frames that made
+it, then fails with NetworkAtImportError. The report is printed as one JSON
+line prefixed with REPORT_MARKER.
+"""
+import importlib
+import importlib.util
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPORT_MARKER = "BMS_STARTUP_PROFILE:"
+SUBMODULES = ("models", "admin", "forms", "resources", "views", "urls",
+              "tasks", "signals", "templatetags")
+
+network_calls = []
+
+
+class NetworkAtImportError(OSError):
+    pass
+
+
+def _project_stack():
+    frames = traceback.extract_stack()[:-3]
+    stack = [
+        "%s:%s in %s" % (os.path.relpath(frame.filename, PROJECT_DIR),
+                         frame.lineno, frame.name)
+        for frame in frames
+        if frame.filename.startswith(PROJECT_DIR)
+        and os.path.abspath(frame.filename) != os.path.abspath(__file__)
+    ]
+    return stack or ["%s:%s in %s" % (frame.filename, frame.lineno, frame.name)
+                     for frame in frames[-5:]]
+
+
+def _refuse(kind, address):
+    network_calls.append({
+        "kind": kind, "address": repr(address), "stack": _project_stack(),
+    })
+    raise NetworkAtImportError("network I/O at import: %s %r" % (kind, address))
+
+
+def install_network_guard():
+    inet = (socket.AF_INET, socket.AF_INET6)
+    connect = socket.socket.connect
+    connect_ex = socket.socket.connect_ex
+
+    def guarded_connect(self, address):
+        if self.family in inet:
+            _refuse("connect", address)
+        return connect(self, address)
+
+    def guarded_connect_ex(self, address):
+        if self.family in inet:
+            _refuse("connect", address)
+        return connect_ex(self, address)
+
+    def guarded_getaddrinfo(host, *args, **kwargs):
+        _refuse("getaddrinfo", host)
+
+    socket.socket.connect = guarded_connect
+    socket.socket.connect_ex = guarded_connect_ex
+    socket.getaddrinfo = guarded_getaddrinfo
+
+
+def elapsed_ms(start):
+    return round((time.time() - start) * 1000, 2)
+
+
+def profile():
+    report = {"setup_ms": None, "apps": {}, "urlconf_ms": None,
+              "network": network_calls, "error": None}
+    try:
+        start = time.time()
+        import django
+        django.setup()
+        report["setup_ms"] = elapsed_ms(start)
+
+        from django.apps import apps
+        from django.conf import settings
+        for app_config in apps.get_app_configs():
+            if not app_config.path.startswith(PROJECT_DIR):
+                continue
+            start = time.time()
+            for name in SUBMODULES:
+                module = "%s.%s" % (app_config.name, name)
+                if importlib.util.find_spec(module) is not None:
+                    importlib.import_module(module)
+            report["apps"][app_config.name] = elapsed_ms(start)
+
+        start = time.time()
+        importlib.import_module(settings.ROOT_URLCONF)
+        report["urlconf_ms"] = elapsed_ms(start)
+    except Exception:
+        report["error"] = traceback.format_exc()
+    return report
+
+
+def main():
+    # Not BMS/, its celery.py would shadow the celery package
+    sys.path[0] = PROJECT_DIR
+    install_network_guard()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "BMS.settings")
+    report = profile()
+    sys.stdout.write(REPORT_MARKER + json.dumps(report) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.test import (
+    RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+    override_settings
+)
+
+from django.utils import timezone
+
+from BMS import metrics, routers
+from BMS.admin_bms import BMS_admin_site
+from BMS.db import bulk_update
+
+
+class FakeRequest(object):
+
+    def __init__(self, session=None):
+        self.session = session
+
+
+class RouterTestMixin(object):
+
+    def setUp(self):
+        super().setUp()
+        routers._local.__dict__.clear()
+        routers._lag.update(checked_at=0, lag=None)
+        self.router = routers.ReplicaRouter()
+        patcher = mock.patch("BMS.routers.has_replica", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read_db(self):
+        return self.router.db_for_read(User)
+
+
+@override_settings(BMS_REPLICA_MAX_LAG=30,
+                   BMS_REPLICA_LAG_CHECK_INTERVAL=0)
+class ReplicaRouterTest(RouterTestMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("BMS.routers.get_replica_lag",
+                             return_value=None)
+        self.get_replica_lag = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_primary_by_default(self):
+        self.assertEqual(self.read_db(), "default")
+
+    def test_use_replica(self):
+        with routers.use_replica():
+            self.assertEqual(self.read_db(), "replica")
+            with routers.use_replica():
+                self.assertEqual(self.read_db(), "replica")
+            self.assertEqual(self.read_db(), "replica")
+        self.assertEqual(self.read_db(), "default")
+
+    def test_writes_go_to_primary(self):
+        with routers.use_replica():
+            self.assertEqual(self.router.db_for_write(User), "default")
+
+    def test_reads_after_write_go_to_primary(self):
+        with routers.use_replica():
+            self.assertEqual(self.read_db(), "replica")
+            self.router.db_for_write(User)
+            self.assertEqual(self.read_db(), "default")
+
+    def test_pin_to_primary(self):
+        routers.pin_to_primary()
+        with routers.use_replica():
+            self.assertEqual(self.read_db(), "default")
+
+    def test_no_replica(self):
+        with mock.patch("BMS.routers.has_replica", return_value=False):
+            with routers.use_replica():
+                self.assertEqual(self.read_db(), "default")
+
+    def test_lag_fallback(self):
+        for lag, db in ((None, "replica"), (5, "replica"), (60, "default"),
+                        (routers.UNKNOWN_LAG, "default")):
+            self.get_replica_lag.return_value = lag
+            with routers.use_replica():
+                self.assertEqual(self.read_db(), db, lag)
+
+    @override_settings(BMS_REPLICA_LAG_CHECK_INTERVAL=60)
+    def test_lag_is_cached(self):
+        self.get_replica_lag.return_value = routers.UNKNOWN_LAG
+        with routers.use_replica():
+            self.assertEqual(self.read_db(), "default")
+            self.get_replica_lag.return_value = 0
+            self.assertEqual(self.read_db(), "default")
+        self.assertEqual(self.get_replica_lag.call_count, 1)
+
+
+class ReplicaLagTest(SimpleTestCase):
+
+    def get_lag(self, row, columns=("Seconds_Behind_Master", ),
+                error=None):
+        connection = mock.MagicMock(vendor="mysql")
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = row
+        cursor.description = [(column, ) for column in columns]
+        if error is not None:
+            cursor.execute.side_effect = error
+        with mock.patch("BMS.routers.connections",
+                        {routers.REPLICA: connection}):
+            return routers.get_replica_lag()
+
+    def test_lag(self):
+        self.assertEqual(self.get_lag((3, )), 3)
+
+    def test_not_replicating(self):
+        # Seconds_Behind_Master is NULL while the replication is stopped
+        self.assertEqual(self.get_lag((None, )), routers.UNKNOWN_LAG)
+
+    def test_not_a_replica(self):
+        self.assertEqual(self.get_lag(None), routers.UNKNOWN_LAG)
+
+    def test_status_error(self):
+        from django.db import DatabaseError
+        with self.assertLogs("BMS.routers", "ERROR"):
+            lag = self.get_lag(None, error=DatabaseError("denied"))
+        self.assertEqual(lag, routers.UNKNOWN_LAG)
+
+    def test_sqlite(self):
+        connection = mock.MagicMock(vendor="sqlite")
+        with mock.patch("BMS.routers.connections",
+                        {routers.REPLICA: connection}):
+            self.assertIsNone(routers.get_replica_lag())
+
+
+@override_settings(BMS_REPLICA_PIN_SECONDS=10)
+class ReplicaPinMiddlewareTest(RouterTestMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("BMS.routers.get_replica_lag",
+                             return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_response(self, write):
+        def view(request):
+            if write:
+                self.router.db_for_write(User)
+            with routers.use_replica():
+                return self.read_db()
+        return routers.ReplicaPinMiddleware(view)
+
+    def test_read_only_session(self):
+        session = {}
+        self.assertEqual(self.get_response(False)(FakeRequest(session)),
+                         "replica")
+        self.assertNotIn(routers.PIN_SESSION_KEY, session)
+
+    def test_pins_session_after_write(self):
+        session = {}
+        self.assertEqual(self.get_response(True)(FakeRequest(session)),
+                         "default")
+        self.assertIn(routers.PIN_SESSION_KEY, session)
+        # The next request of the session reads its own write
+        self.assertEqual(self.get_response(False)(FakeRequest(session)),
+                         "default")
+        # Other sessions are not pinned
+        self.assertEqual(self.get_response(False)(FakeRequest({})),
+                         "replica")
+
+    def test_pin_expires(self):
+        session = {}
+        self.get_response(True)(FakeRequest(session))
+        with mock.patch("BMS.routers.time.time",
+                        return_value=session[routers.PIN_SESSION_KEY] + 1):
+            self.assertEqual(self.get_response(False)(FakeRequest(session)),
+                             "replica")
+
+    def test_no_session(self):
+        self.assertEqual(self.get_response(True)(FakeRequest()), "default")
+        self.assertEqual(self.get_response(False)(FakeRequest()), "replica")
+
+
+@skipUnless(routers.REPLICA in settings.DATABASES,
+            "needs the replica database of BMS.settings_benchmark")
+@override_settings(DATABASE_ROUTERS=["BMS.routers.ReplicaRouter"])
+class ReplicaDatabaseTest(TransactionTestCase):
+    # In the open transaction of a TestCase the SQLite mirror finds the
+    # tables locked
+    multi_db = True
+
+    def setUp(self):
+        routers._local.__dict__.clear()
+        routers._lag.update(checked_at=0, lag=None)
+
+    def test_querysets(self):
+        User.objects.create(username="replica")
+        routers._local.wrote = False
+        self.assertEqual(User.objects.all().db, "default")
+        with routers.use_replica():
+            self.assertEqual(User.objects.all().db, "replica")
+            # The mirror sees the rows of the primary
+            self.assertTrue(User.objects.filter(username="replica").exists())
+            User.objects.create(username="primary")
+            self.assertEqual(User.objects.all().db, "default")
+
+
+class MetricsFilesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, samples):
+        metrics.write_file(os.path.join(self.directory, name),
+                           json.dumps(samples))
+
+    def test_compact_dead_files(self):
+        host = "web1"
+        self.write("web1-100-1.json", {"a": 1})
+        self.write("web1-200-1.json", {"a": 2})
+        self.write("web2-100-1.json", {"a": 4})
+        self.write(metrics.DEAD_FILE, {"a": 8})
+
+        def kill(pid, signal):
+            if pid == 100:
+                raise ProcessLookupError
+
+        with mock.patch("BMS.metrics.socket.gethostname", return_value=host), \
+                mock.patch("BMS.metrics.os.kill", side_effect=kill):
+            metrics.compact_dead_files(self.directory)
+            with override_settings(BMS_METRICS_DIR=self.directory,
+                                   BMS_METRICS_ENABLED=False):
+                self.assertEqual(metrics.collect(), {"a": 15})
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.directory)
+                   if name.endswith(".json")),
+            ["dead.json", "web1-200-1.json", "web2-100-1.json"])
+        self.assertEqual(
+            metrics.read_samples(
+                os.path.join(self.directory, metrics.DEAD_FILE)), {"a": 9})
+
+
+@override_settings(BMS_METRICS_TOKEN="secret", BMS_METRICS_ENABLED=False)
+class MetricsViewTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch("BMS.metrics.render_outbox", return_value=[])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def get(self, user=None, **headers):
+        request = RequestFactory().get("/metrics", **headers)
+        request.user = user or AnonymousUser()
+        with override_settings(BMS_METRICS_DIR=self.directory):
+            return metrics.metrics_view(request)
+
+    def test_anonymous(self):
+        self.assertEqual(self.get().status_code, 403)
+
+    def test_token(self):
+        self.assertEqual(
+            self.get(HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+        self.assertEqual(
+            self.get(HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+
+    @override_settings(BMS_METRICS_TOKEN=None)
+    def test_no_token_configured(self):
+        self.assertEqual(
+            self.get(HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+
+    def test_staff(self):
+        self.assertEqual(self.get(User(is_staff=True)).status_code, 200)
+        self.assertEqual(self.get(User(is_staff=False)).status_code, 403)
+
+
+class AdminContextTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_per_user(self):
+        request = RequestFactory().get("/")
+        request.user = User.objects.create_superuser(
+            "admin", "admin@example.com", "admin")
+        context = BMS_admin_site.get_user_context(request)
+        self.assertTrue(context["available_apps"])
+        # The app list holds lazy translations, they have to be pickled
+        with self.assertNumQueries(0):
+            self.assertEqual(BMS_admin_site.get_user_context(request),
+                             context)
+
+
+class BulkUpdateTest(TestCase):
+    """bulk_update writes what a save() per row writes"""
+
+    fields = ("first_name", "is_staff", "last_login")
+
+    def change(self, prefix):
+        users = User.objects.filter(
+            username__startswith=prefix).order_by("username")
+        for i, user in enumerate(users):
+            user.first_name = "名'%s" % i if i % 3 else ""
+            user.is_staff = bool(i % 2)
+            user.last_login = None if i % 4 == 0 else self.now
+        return users
+
+    def rows(self, prefix):
+        return [
+            (username[len(prefix):],) + tuple(values)
+            for username, *values in User.objects.filter(
+                username__startswith=prefix
+            ).order_by("username").values_list("username", *self.fields)
+        ]
+
+    def test_same_as_save(self):
+        self.now = timezone.now().replace(microsecond=0)
+        for prefix in ("save", "bulk"):
+            User.objects.bulk_create([
+                User(username="%s%02d" % (prefix, i), first_name="x",
+                     last_login=timezone.now())
+                for i in range(10)
+            ])
+        for user in self.change("save"):
+            user.save(update_fields=self.fields)
+        updated = bulk_update(
+            User, self.change("bulk"), self.fields, batch_size=3
+        )
+        self.assertEqual(updated, 10)
+        self.assertEqual(self.rows("bulk"), self.rows("save"))
@@ -0,0 +1,221 @@
+"""Lightweight span tracing of the slow code paths.
+
+    with span("lims.ext.update_samples", samples=len(qs)):
+        ...
+
+    @traced()
+    def save_model(self, request, obj, form, change):
+        ...
+
+Spans nest per thread. The outermost one starts a trace, which is kept with
+the probability BMS_TRACING_SAMPLE_RATE when BMS_TRACING_ENABLED is on;
+otherwise every span is a no-op. The queries run inside a span are counted
+and timed on it, calls to dingtalk and smtp show up as child spans (see
+BMS.instrumentation.external_call). A finished trace is handed to the
+exporter of BMS_TRACING_EXPORTER, by default one JSON line per trace in
+logs/traces.log.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+_local = threading.local()
+
+DEFAULT_TRACE_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "logs", "traces.log"
+)
+
+
+class Span(object):
+
+    def __init__(self, name, attributes=None, parent=None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.children = []
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.start = time.time()
+        self.end = None
+        self.db_count = 0
+        self.db_ms = 0.0
+        self.error = None
+        if parent is not None:
+            parent.children.append(self)
+
+    @property
+    def duration_ms(self):
+        return ((self.end or time.time()) - self.start) * 1000
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self):
+        self.end = time.time()
+
+    def as_dict(self):
+        data = {
+            "name": self.name,
+            "start": round(self.start, 6),
+            "ms": round(self.duration_ms, 2),
+            "db_count": self.db_count,
+            "db_ms": round(self.db_ms, 2),
+        }
+        if self.attributes:
+            data["attributes"] = self.attributes
+        if self.error:
+            data["error"] = self.error
+        if self.children:
+            data["children"] = [child.as_dict() for child in self.children]
+        return data
+
+
+class NoopSpan(object):
+    """What span() yields when nothing is traced"""
+
+    def set_attribute(self, key, value):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class JsonLinesExporter(object):
+    """Append every trace as one JSON line to BMS_TRACING_FILE"""
+
+    def __init__(self):
+        self.logger = logging.getLogger("bms.tracing")
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(
+                getattr(settings, "BMS_TRACING_FILE", DEFAULT_TRACE_FILE),
+                maxBytes=getattr(settings, "BMS_TRACING_MAX_BYTES",
+                                 10 * 1024 * 1024),
+                backupCount=getattr(settings, "BMS_TRACING_BACKUP_COUNT", 5),
+                encoding="utf-8",
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    def export(self, root):
+        trace = root.as_dict()
+        trace["trace_id"] = root.trace_id
+        self.logger.info(json.dumps(trace, sort_keys=True, default=str))
+
+
+class MemoryExporter(object):
+    """Keeps the traces in memory, for tests"""
+    traces = []
+
+    def export(self, root):
+        self.traces.append(root)
+
+
+_exporter = {}
+
+
+def get_exporter():
+    path = getattr(settings, "BMS_TRACING_EXPORTER",
+                   "BMS.tracing.JsonLinesExporter")
+    exporter = _exporter.get(path)
+    if exporter is None:
+        exporter = _exporter[path] = import_string(path)()
+    return exporter
+
+
+def is_sampled():
+    if not getattr(settings, "BMS_TRACING_ENABLED", False):
+        return False
+    return random.random() < getattr(settings, "BMS_TRACING_SAMPLE_RATE", 1.0)
+
+
+def get_current_span():
+    return getattr(_local, "span", None)
+
+
+def set_attribute(key, value):
+    """Set an attribute on the innermost span, if any"""
+    current = get_current_span()
+    if current is not None:
+        current.set_attribute(key, value)
+
+
+def _count_query(execute, sql, params, many, context):
+    start = time.time()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        current = get_current_span()
+        if current is not None:
+            current.db_count += 1
+            current.db_ms += (time.time() - start) * 1000
+
+
+@contextmanager
+def _run(current):
+    _local.span = current
+    try:
+        yield current
+    except Exception as e:
+        current.error = "%s: %s" % (type(e).__name__, e)
+        raise
+    finally:
+        current.finish()
+        _local.span = current.parent
+
+
+@contextmanager
+def span(name, **attributes):
+    parent = get_current_span()
+    if parent is not None:
+        with _run(Span(name, attributes, parent)) as current:
+            yield current
+        return
+    if getattr(_local, "unsampled", False) or not is_sampled():
+        # Inside an unsampled trace, or a trace which is not sampled
+        outermost = not getattr(_local, "unsampled", False)
+        _local.unsampled = True
+        try:
+            yield NOOP_SPAN
+        finally:
+            if outermost:
+                _local.unsampled = False
+        return
+    root = Span(name, attributes)
+    try:
+        with connection.execute_wrapper(_count_query):
+            with _run(root):
+                yield root
+    finally:
+        if root.duration_ms >= getattr(settings, "BMS_TRACING_MIN_MS", 0):
+            try:
+                get_exporter().export(root)
+            except Exception:
+                logging.getLogger("bms.tracing").exception(
+                    "Could not export the trace %s", root.trace_id)
+
+
+def traced(name=None, **attributes):
+    """Decorator running the function in a span, named after the function
+    by default"""
+    def decorator(func):
+        span_name = name or "%s.%s" % (func.__module__, func.__qualname__)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attributes):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
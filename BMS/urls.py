@@ -20,10 +20,12 @@ from django.conf.urls.static import static
 from django.urls import path
 from lims.views import getData
 from BMS.admin_bms import BMS_admin_site
+from BMS.metrics import metrics_view
 from BMS.views import dingtalk_auth
 
 
 urlpatterns = [
+    path('metrics', metrics_view),
     path(r'', BMS_admin_site.urls),
     path(r'dingtalk_auth/', dingtalk_auth),
     path(r'notification/inbox/', include('notification.urls', namespace='notifications')),
@@ -1,33 +1,64 @@
+from django.conf import settings
 from django.contrib.auth import authenticate, login
+from django.core.cache import cache
 from django.http import HttpResponseRedirect
 from dingtalk_sdk_gmdzy2010.authority_request import (
-    AccessTokenRequest, SnsAccessTokenRequest, PersistentCodeRequest,
-    SnsTokenRequest, UserInfoRequest,
+    PersistentCodeRequest, SnsTokenRequest, UserInfoRequest,
 )
 from dingtalk_sdk_gmdzy2010.user_request import UseridByUnionidRequest
+from BMS.dingtalk_token import (
+    INVALID_TOKEN_ERRCODES, get_access_token, get_sns_token_manager
+)
+from BMS.metrics import record_cache
 from BMS.settings import (
     DINGTALK_APPKEY, DINGTALK_SECRET, DINGTALK_APPID, DINGTALK_APPSECRET
 )
 
 
+def get_persistent_ticket(tmp_auth_code):
+    """STEP 1-2. Exchange the tmp_auth_code with the cached sns access_token,
+    refresh the token once if dingtalk says it is invalid."""
+    manager = get_sns_token_manager(DINGTALK_APPID, DINGTALK_APPSECRET)
+    for _ in range(2):
+        sns_access_token = manager.get_token()
+        params_2 = {"access_token": sns_access_token}
+        data = {"tmp_auth_code": tmp_auth_code}
+        req_persistent_code = PersistentCodeRequest(params=params_2, json=data)
+        req_persistent_code.request_method = "post"
+        json_response = req_persistent_code.get_json_response() or {}
+        if json_response.get("errcode") not in INVALID_TOKEN_ERRCODES:
+            break
+        manager.invalidate()
+    return sns_access_token, req_persistent_code.get_ticket_for_sns_token()
+
+
+def get_userid_by_unionid(unionid):
+    """STEP 5. The userid of a unionid never changes, cache it"""
+    key = "dingtalk:userid:%s" % unionid
+    userid = cache.get(key)
+    record_cache("dingtalk_userid", userid is not None)
+    if userid is None:
+        params_6 = {
+            "access_token": get_access_token(DINGTALK_APPKEY, DINGTALK_SECRET),
+            "unionid": unionid
+        }
+        req_userid = UseridByUnionidRequest(params=params_6)
+        req_userid.get_json_response()
+        userid = req_userid.get_userid()
+        if userid:
+            timeout = getattr(settings, "DINGTALK_USERID_CACHE_TIMEOUT", 86400)
+            cache.set(key, userid, timeout)
+    return userid
+
+
 def dingtalk_auth(request):
     """This view is responsible for the dingtalk authentication, as these users
     recorded within the user-model coupled with model "Employees" scan the
     qrcode, who exists in that table AND matches the dingtalk_id could be
-    logged in."""
-    # STEP 1. Get sns access_token
-    params_1 = {"appid": DINGTALK_APPID, "appsecret": DINGTALK_APPSECRET}
-    req_sns_access_token = SnsAccessTokenRequest(params=params_1)
-    req_sns_access_token.get_json_response()
-    sns_access_token = req_sns_access_token.get_sns_access_token()
-    
-    # STEP 2. Get persistent code
-    params_2 = {"access_token": sns_access_token}
-    data = {"tmp_auth_code": request.GET["code"]}
-    req_persistent_code = PersistentCodeRequest(params=params_2, json=data)
-    req_persistent_code.request_method = "post"
-    req_persistent_code.get_json_response()
-    ticket = req_persistent_code.get_ticket_for_sns_token()
+    logged in. The app level tokens and the userid are cached, so only
+    steps 2-4 call dingtalk on every login."""
+    # STEP 1-2. Get the persistent code with the cached sns access_token
+    sns_access_token, ticket = get_persistent_ticket(request.GET["code"])
     
     # STEP 3. Get sns token
     params_3 = {"access_token": sns_access_token}
@@ -43,18 +74,10 @@ def dingtalk_auth(request):
     user_info = req_user_info.get_user_info()
     
     # STEP 5. Get userid
-    params_5 = {"appkey": DINGTALK_APPKEY, "appsecret": DINGTALK_SECRET}
-    req_access_token = AccessTokenRequest(params=params_5)
-    req_access_token.get_json_response()
-    params_6 = {
-        "access_token": req_access_token.get_access_token(),
-        "unionid": user_info["unionid"]
-    }
-    req_userid = UseridByUnionidRequest(params=params_6)
-    req_userid.get_json_response()
+    userid = get_userid_by_unionid(user_info["unionid"])
     
     # STEP 6. Authenticate the specified django-user
-    user_check = authenticate(request, dingtalk_id=req_userid.get_userid())
+    user_check = authenticate(request, dingtalk_id=userid)
     if user_check is not None:
         login(request, user_check)
     return HttpResponseRedirect("/")
@@ -13,11 +13,13 @@ from django.utils import timezone
 from django.utils.html import format_html
 from import_export.admin import ImportExportModelAdmin,\
     ImportExportActionModelAdmin
+from BMS import roles
 from BMS.admin_bms import BMS_admin_site
 from BMS.notice_mixin import NotificationMixin
+from BMS.routers import use_replica
 from BMS.settings import DINGTALK_APPKEY, DINGTALK_SECRET, DINGTALK_AGENT_ID
 from em.models import Employees
-from nm.models import DingtalkChat
+from nm.chats import get_chat_id
 from rangefilter.filter import DateRangeFilter
 
 
@@ -95,7 +97,7 @@ class AnaExecuteAdmin(ImportExportModelAdmin, NotificationMixin):
     
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
-        manager_qs = User.objects.filter(groups__id=10)
+        manager_qs = User.objects.filter(groups__id=roles.ANALYST_MANAGER)
         current_qs = User.objects.filter(pk=request.user.pk)
         if not request.user.is_superuser and not current_qs & manager_qs:
             condition = Q(analyst=request.user) | Q(analyst=None)
@@ -154,8 +156,9 @@ class AnaExecuteAdmin(ImportExportModelAdmin, NotificationMixin):
     def changelist_view(self, request, extra_context=None):
         extra_context = extra_context or {}
         queryset = self.get_queryset(request)
-        last_30_days_submit = self.get_last_30_days_submit(queryset=queryset)
-        last_30_days_end = self.get_last_30_days_end(queryset=queryset)
+        with use_replica():
+            last_30_days_submit = self.get_last_30_days_submit(queryset=queryset)
+            last_30_days_end = self.get_last_30_days_end(queryset=queryset)
         extra_context["last_30_days_submit"] = last_30_days_submit
         extra_context["last_30_days_end"] = last_30_days_end
         extra_context["figure_label"] = self.get_figure_label()
@@ -168,8 +171,8 @@ class AnaExecuteAdmin(ImportExportModelAdmin, NotificationMixin):
             all_sub_project.update(is_status=13, time_ana=obj.end_date)
             name_list = set([n.sub_project for n in all_sub_project])
             content = "项目【%s】状态已变更为【完成】" % "，".join(name_list)
-            dingdingid = DingtalkChat.objects.get(chat_name="项目管理钉钉群-BMS").chat_id
-            dingdingid_ = DingtalkChat.objects.get(chat_name="生信分析钉钉群-BMS").chat_id
+            dingdingid = get_chat_id("pm")
+            dingdingid_ = get_chat_id("bioinfo")
             send_to = [dingdingid, dingdingid_]
             self.send_work_notice(content, DINGTALK_AGENT_ID, send_to)
             call_back = self.send_dingtalk_result
@@ -220,7 +223,7 @@ class WeeklyReportAdmin(ImportExportModelAdmin, NotificationMixin):
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
-        manager_qs = User.objects.filter(groups__id=10)
+        manager_qs = User.objects.filter(groups__id=roles.ANALYST_MANAGER)
         current_qs = User.objects.filter(pk=request.user.pk)
         if not request.user.is_superuser and not current_qs & manager_qs:
             queryset = queryset.filter(reporter=request.user)
@@ -268,7 +271,7 @@ class AnalystListFilter(admin.SimpleListFilter):
     def lookups(self, request, model_admin):
         analysts = []
         analysts_id = []
-        for i in User.objects.filter(groups__id=9):
+        for i in User.objects.filter(groups__id=roles.ANALYST):
             analysts.append(i.username)
             analysts_id.append(i.id)
         return zip(analysts_id, analysts)
@@ -297,7 +300,7 @@ class ProjectTaskAdmin(ImportExportActionModelAdmin, NotificationMixin):
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
-        manager_qs = User.objects.filter(groups__id=10)
+        manager_qs = User.objects.filter(groups__id=roles.ANALYST_MANAGER)
         current_qs = User.objects.filter(pk=request.user.pk)
         if not request.user.is_superuser and not current_qs & manager_qs:
             queryset = queryset.filter(analyst=request.user)
@@ -323,7 +326,7 @@ class WriterListFilter(admin.SimpleListFilter):
     def lookups(self, request, model_admin):
         analysts = []
         analysts_id = []
-        for i in User.objects.filter(groups__id=9):
+        for i in User.objects.filter(groups__id=roles.ANALYST):
             analysts.append(i.username)
             analysts_id.append(i.id)
         return zip(analysts_id, analysts)
@@ -350,7 +353,7 @@ class DevelopmentTaskAdmin(ImportExportActionModelAdmin, NotificationMixin):
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
-        manager_qs = User.objects.filter(groups__id=10)
+        manager_qs = User.objects.filter(groups__id=roles.ANALYST_MANAGER)
         current_qs = User.objects.filter(pk=request.user.pk)
         if not request.user.is_superuser and not current_qs & manager_qs:
             queryset = queryset.filter(writer=request.user)
@@ -385,7 +388,7 @@ class OtherTaskAdmin(ImportExportActionModelAdmin, NotificationMixin):
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
-        manager_qs = User.objects.filter(groups__id=10)
+        manager_qs = User.objects.filter(groups__id=roles.ANALYST_MANAGER)
         current_qs = User.objects.filter(pk=request.user.pk)
         if not request.user.is_superuser and not current_qs & manager_qs:
             queryset = queryset.filter(writer=request.user)
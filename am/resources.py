@@ -1,9 +1,10 @@
 from am.models import AnaExecute, WeeklyReport, ProjectTask, DevelopmentTask, \
     OtherTask
 from import_export import resources, fields
+from BMS.metrics import ResourceMetricsMixin
 
 
-class AnaExecuteResource(resources.ModelResource):
+class AnaExecuteResource(ResourceMetricsMixin, resources.ModelResource):
     """The import_export resource class for model AnaSubmit"""
 
     class Meta:
@@ -25,7 +26,7 @@ class AnaExecuteResource(resources.ModelResource):
         ]
 
 
-class WeeklyReportResource(resources.ModelResource):
+class WeeklyReportResource(ResourceMetricsMixin, resources.ModelResource):
     """The import_export resource class for model WeeklyReport"""
     id = fields.Field(attribute="id", column_name="样品编号", default=None)
     reporter = fields.Field(attribute="reporter_id", column_name="汇报人")
@@ -43,7 +44,7 @@ class WeeklyReportResource(resources.ModelResource):
         return ["样品编号", "汇报人", "起始日期", "截止日期", "汇报内容"]
 
 
-class ProjectTaskResource(resources.ModelResource):
+class ProjectTaskResource(ResourceMetricsMixin, resources.ModelResource):
     """The import_export resource class for model ProjectTask"""
     id = fields.Field(attribute="id", column_name="项目任务编号", default=None)
     contract = fields.Field(
@@ -122,7 +123,7 @@ class ProjectTaskResource(resources.ModelResource):
                         )
 
 
-class DevelopmentTaskResource(resources.ModelResource):
+class DevelopmentTaskResource(ResourceMetricsMixin, resources.ModelResource):
     """The import_export resource class for model DevelopmentTask"""
     id = fields.Field(attribute="id", column_name="开发任务编号", default=None)
     product_name = fields.Field(
@@ -166,7 +167,7 @@ class DevelopmentTaskResource(resources.ModelResource):
                         )
 
 
-class OtherTaskResource(resources.ModelResource):
+class OtherTaskResource(ResourceMetricsMixin, resources.ModelResource):
     """The import_export resource class for model OtherTask"""
     id = fields.Field(attribute="id", column_name="开发任务编号", default=None)
     task_detail = fields.Field(
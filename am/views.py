@@ -2,6 +2,8 @@ from django.contrib.admin.views.autocomplete import AutocompleteJsonView
 from django.contrib.auth.models import User
 from django.db.models import Q
 
+from BMS import roles
+
 
 class AnaAutocompleteJsonView(AutocompleteJsonView):
     """The autocomplete json view for mapping user queryset with respect to the
@@ -15,28 +17,33 @@ class AnaAutocompleteJsonView(AutocompleteJsonView):
         return users_qs.distinct()
     
     def get_queryset(self):
-        # Attention: the hard code of group should be removed in the future,
-        # These may cause some problems when the database are going to be
-        # regenerated, last edited by liy, 11/16/2018, 10:41:03.
-        ana_users = self.get_group_users(Q(groups__id=9) | Q(groups__id=10))
-        sal_users = self.get_group_users(Q(groups__id=3) | Q(groups__id=7))
-        exp_users = self.get_group_users(Q(groups__id=1) | Q(groups__id=11))
-        mar_users = self.get_group_users(Q(groups__id=4) | Q(groups__id=12))
-        fin_users = self.get_group_users(Q(groups__id=5) | Q(groups__id=14))
-        cop_users = self.get_group_users(Q(groups__id=8))
+        # The groups are the ids of BMS.roles, they change if the database
+        # is regenerated.
+        ana_users = self.get_group_users(
+            Q(groups__id=roles.ANALYST) | Q(groups__id=roles.ANALYST_MANAGER))
+        sal_users = self.get_group_users(
+            Q(groups__id=roles.SALES) | Q(groups__id=roles.SALES_DIRECTOR))
+        # 市场产品组 has always been listed with 实验部 here
+        exp_users = self.get_group_users(
+            Q(groups__id=roles.EXP) | Q(groups__id=roles.MARKET_PRODUCT))
+        mar_users = self.get_group_users(
+            Q(groups__id=roles.MARKET) | Q(groups__id=roles.MARKET_DIRECTOR))
+        fin_users = self.get_group_users(
+            Q(groups__id=roles.FINANCE) | Q(groups__id=roles.FINANCE_DIRECTOR))
+        cop_users = self.get_group_users(Q(groups__id=roles.COOPERATION))
         if self.request.user in ana_users:
             current = self.get_group_users(Q(pk=self.request.user.pk))
-            manager = self.get_group_users(Q(groups__id=10))
+            manager = self.get_group_users(Q(groups__id=roles.ANALYST_MANAGER))
             users_queryset = ana_users if current & manager else current
         elif self.request.user in mar_users:
             users_queryset = sal_users
         elif self.request.user in sal_users:
             current = self.get_group_users(Q(pk=self.request.user.pk))
-            manager = self.get_group_users(Q(groups__id=7))
+            manager = self.get_group_users(Q(groups__id=roles.SALES_DIRECTOR))
             users_queryset = sal_users if current & manager else current
         elif self.request.user in exp_users:
             current = self.get_group_users(Q(pk=self.request.user.pk))
-            manager = self.get_group_users(Q(groups__id=11))
+            manager = self.get_group_users(Q(groups__id=roles.MARKET_PRODUCT))
             users_queryset = exp_users if current & manager else current
         elif self.request.user in fin_users:
             users_queryset = fin_users
@@ -5,6 +5,7 @@ from django.contrib.auth.models import User
 from docx_parsing_gmdzy2010.renderer import DocxProduce, ContextFields
 from datetime import date
 
+from BMS import roles
 from BMS.admin_bms import BMS_admin_site
 from BMS.settings import TEMPLATE_FROM_PATH, TEMPLATE_TO_PATH, TABLE_CONTEXT
 from crm.models import Customer, Intention, IntentionRecord, Analyses, \
@@ -204,7 +205,7 @@ class ContractApplicationsAdmin(admin.ModelAdmin):
     contract_download.short_description = '合同下载'
     
     def get_readonly_fields(self, request, obj=None):
-        users_qs = User.objects.filter(groups__id=3).order_by("id")
+        users_qs = User.objects.filter(groups__id=roles.SALES).order_by("id")
         self.readonly_fields = (
             'start_delay_sample_counts', 'databasing_upper_limit',
             'delivery_upper_limit',
@@ -237,7 +238,7 @@ class ContractApplicationsAdmin(admin.ModelAdmin):
     
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
-        manager_qs = User.objects.filter(groups__id=7)
+        manager_qs = User.objects.filter(groups__id=roles.SALES_DIRECTOR)
         current_qs = User.objects.filter(pk=request.user.pk)
         if not request.user.is_superuser and not current_qs & manager_qs:
             queryset = queryset.filter(second_party_contact=request.user)
@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from BMS.benchmark.dataset import generate_dataset
+from BMS.benchmark.runner import (
+    DEFAULT_BASELINE_FILE, AdminBenchmark, compare, load_baselines,
+    save_baselines
+)
+
+
+class Command(BaseCommand):
+    help = ("Time the changelist, change view and export of every admin of "
+            "BMS_admin_site on a synthetic dataset and compare them with the "
+            "stored baselines. Run it with --settings=BMS.settings_benchmark, "
+            "it exits with 1 when a page got slower, runs more queries or has "
+            "no baseline. --record stores the results as the baselines.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help="Multiply the size of the dataset")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--skip-setup', action='store_true',
+                            help="Reuse the database as it is")
+        parser.add_argument('--model', action='append', dest='models',
+                            help="Only these admins, e.g. mm.contract")
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--export-rows', type=int, default=500)
+        parser.add_argument('--export-format', default='xlsx')
+        parser.add_argument('--baseline', default=DEFAULT_BASELINE_FILE)
+        parser.add_argument('--record', '--save-baseline', action='store_true',
+                            dest='record',
+                            help="Store the results as the new baselines")
+        parser.add_argument('--no-timings', action='store_false',
+                            dest='timings',
+                            help="Only record the query counts, the timings "
+                                 "depend on the machine")
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help="Allowed slowdown, 0.25 is 25%%")
+        parser.add_argument('--min-ms', type=float, default=20,
+                            help="Ignore slowdowns smaller than this")
+        parser.add_argument('--query-tolerance', type=int, default=0)
+        parser.add_argument('--force', action='store_true',
+                            help="Run on a database which is not SQLite")
+
+    def handle(self, *args, **options):
+        engine = settings.DATABASES['default']['ENGINE']
+        if 'sqlite3' not in engine and not options['force']:
+            raise CommandError(
+                "The benchmark fills the database with synthetic rows, run it "
+                "with --settings=BMS.settings_benchmark (or use --force)")
+        if not options['skip_setup']:
+            call_command('migrate', run_syncdb=True, verbosity=0)
+            generate_dataset(scale=options['scale'], seed=options['seed'],
+                             stdout=self.stdout)
+
+        benchmark = AdminBenchmark(
+            repeat=options['repeat'], export_rows=options['export_rows'],
+            export_format=options['export_format'], models=options['models'],
+        )
+        results = benchmark.run()
+        passed = compare(results, load_baselines(options['baseline']),
+                         threshold=options['threshold'],
+                         query_tolerance=options['query_tolerance'],
+                         min_ms=options['min_ms'],
+                         record=options['record'])
+        for result in results:
+            self.stdout.write(str(result))
+
+        if options['record']:
+            save_baselines(results, options['baseline'],
+                           timings=options['timings'])
+            self.stdout.write("Baselines saved to %s" % options['baseline'])
+        elif not passed:
+            raise CommandError("%s of %s pages failed" % (
+                len([r for r in results if not r.passed]), len(results)))
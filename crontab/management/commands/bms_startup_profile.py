@@ -0,0 +1,126 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import BMS.startup_profile
+from BMS.startup_profile import PROJECT_DIR, REPORT_MARKER
+
+IMPORTTIME_RE = re.compile(
+    r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$"
+)
+
+
+def parse_importtime(lines):
+    """(module, self us, cumulative us, depth) of the -X importtime lines"""
+    modules = []
+    for line in lines:
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            modules.append((module, int(self_us), int(cumulative_us),
+                            (len(indent) - 1) // 2))
+    return modules
+
+
+def is_project_package(package):
+    return os.path.isdir(os.path.join(PROJECT_DIR, package))
+
+
+class Command(BaseCommand):
+    help = ("Profile the cold start of a fresh interpreter: django.setup(), "
+            "the import of every app and the packages taking the most import "
+            "time. Fails when a module performs network I/O at import.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=15,
+                            help="Show the N slowest packages and modules")
+        parser.add_argument('--max-setup-ms', type=float, default=None,
+                            help="Also fail when django.setup() is slower")
+        parser.add_argument('--timeout', type=int, default=120)
+
+    def handle(self, *args, **options):
+        env = dict(os.environ)
+        env['DJANGO_SETTINGS_MODULE'] = settings.SETTINGS_MODULE
+        script = os.path.splitext(BMS.startup_profile.__file__)[0] + '.py'
+        command = [sys.executable, '-X', 'importtime', script]
+
+        start = time.time()
+        try:
+            process = subprocess.run(
+                command, cwd=PROJECT_DIR, env=env, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True,
+                timeout=options['timeout'],
+            )
+        except subprocess.TimeoutExpired:
+            raise CommandError("The interpreter did not start within %ss"
+                               % options['timeout'])
+        wall_ms = (time.time() - start) * 1000
+
+        report = None
+        for line in process.stdout.splitlines():
+            if line.startswith(REPORT_MARKER):
+                report = json.loads(line[len(REPORT_MARKER):])
+        if report is None:
+            raise CommandError("No report from the profiled interpreter:\n%s"
+                               % process.stderr[-3000:])
+        modules = parse_importtime(process.stderr.splitlines())
+
+        self.write_report(report, modules, wall_ms, options['limit'])
+
+        errors = []
+        if report['network']:
+            errors.append("%s network calls at import"
+                          % len(report['network']))
+        if report['error']:
+            errors.append("the startup failed")
+        if (options['max_setup_ms'] is not None
+                and report['setup_ms'] is not None
+                and report['setup_ms'] > options['max_setup_ms']):
+            errors.append("django.setup() took %.0f ms, more than %.0f ms"
+                          % (report['setup_ms'], options['max_setup_ms']))
+        if errors:
+            raise CommandError(", ".join(errors))
+
+    def write_report(self, report, modules, wall_ms, limit):
+        write = self.stdout.write
+        write("Interpreter start to report: %.0f ms" % wall_ms)
+        if report['setup_ms'] is not None:
+            write("django.setup(): %.0f ms" % report['setup_ms'])
+        if report['urlconf_ms'] is not None:
+            write("URLconf: %.0f ms" % report['urlconf_ms'])
+
+        write("\nRemaining modules of the apps after setup (ms):")
+        for app, ms in sorted(report['apps'].items(), key=lambda i: -i[1]):
+            write("  %-20s %8.1f" % (app, ms))
+
+        packages = {}
+        for module, self_us, _, _ in modules:
+            package = module.split('.')[0]
+            packages[package] = packages.get(package, 0) + self_us
+        write("\nSlowest packages, own import time (ms):")
+        for package, us in sorted(packages.items(),
+                                  key=lambda i: -i[1])[:limit]:
+            write("  %-30s %8.1f%s" % (
+                package, us / 1000.0,
+                "  (project)" if is_project_package(package) else ""))
+
+        write("\nSlowest project modules, cumulative (ms):")
+        project_modules = [m for m in modules
+                           if is_project_package(m[0].split('.')[0])]
+        for module, _, cumulative_us, _ in sorted(
+                project_modules, key=lambda m: -m[2])[:limit]:
+            write("  %-40s %8.1f" % (module, cumulative_us / 1000.0))
+
+        for call in report['network']:
+            self.stderr.write("\nNetwork I/O at import: %s %s" % (
+                call['kind'], call['address']))
+            for frame in call['stack']:
+                self.stderr.write("    %s" % frame)
+        if report['error']:
+            self.stderr.write("\n" + report['error'])
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from BMS.celery_queues import (
+    QUEUE_NAMES, get_beat_command, get_beat_schedule, get_queue_concurrency,
+    get_task_queues, get_time_limits, get_worker_command
+)
+
+
+class Command(BaseCommand):
+    help = ("Print the celery multi command starting one worker per queue "
+            "with its concurrency, the celery beat command, and the routing "
+            "of the tasks.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--app', default='BMS')
+        parser.add_argument('--loglevel', default='info')
+        parser.add_argument('--routes', action='store_true',
+                            help="Also print the queue and time limits of "
+                                 "the tasks")
+
+    def handle(self, *args, **options):
+        self.stdout.write(get_worker_command(options['app'],
+                                             options['loglevel']))
+        self.stdout.write(get_beat_command(options['app'],
+                                           options['loglevel']))
+        if not options['routes']:
+            return
+        concurrency = get_queue_concurrency()
+        limits = get_time_limits()
+        for queue in QUEUE_NAMES:
+            self.stdout.write("\n%s (concurrency %s)" % (
+                queue, concurrency.get(queue, 1)))
+            for pattern, task_queue in get_task_queues():
+                if task_queue != queue:
+                    continue
+                soft, hard = limits.get(pattern, (None, None))
+                self.stdout.write("  %s  soft %s s, hard %s s" % (
+                    pattern, soft or '-', hard or '-'))
+        self.stdout.write("\nbeat")
+        for name, entry in sorted(get_beat_schedule().items()):
+            self.stdout.write("  %s  %s every %s" % (
+                name, entry["task"], entry["schedule"]))
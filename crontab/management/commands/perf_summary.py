@@ -0,0 +1,72 @@
+import glob
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from BMS.instrumentation import get_log_file, percentile
+
+
+class Command(BaseCommand):
+    help = "Summarise logs/perf.log (BMS.instrumentation) with p50/p95 per view"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', default=None,
+                            help="Default: BMS_PERF_LOG_FILE or logs/perf.log")
+        parser.add_argument('--hours', type=float, default=None,
+                            help="Only the requests of the last N hours")
+        parser.add_argument('--view', default=None,
+                            help="Only the views containing this text, e.g. admin:")
+        parser.add_argument('--sort', default='p95_ms',
+                            choices=['p95_ms', 'p50_ms', 'p95_sql', 'count'])
+        parser.add_argument('--limit', type=int, default=30)
+
+    def read_records(self, log_file, since, view_filter):
+        # perf.log and its rotated backups perf.log.1, perf.log.2 ...
+        for path in sorted(glob.glob(log_file + '*')):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if since and record.get('ts', 0) < since:
+                        continue
+                    if view_filter and view_filter not in record.get('view', ''):
+                        continue
+                    yield record
+
+    def handle(self, *args, **options):
+        log_file = options['log'] or get_log_file()
+        since = time.time() - options['hours'] * 3600 if options['hours'] else None
+        views = {}
+        for record in self.read_records(log_file, since, options['view']):
+            views.setdefault(record['view'], []).append(record)
+
+        rows = []
+        for view, records in views.items():
+            total = [r['total_ms'] for r in records]
+            sql_count = [r['sql_count'] for r in records]
+            rows.append({
+                'view': view,
+                'count': len(records),
+                'p50_ms': percentile(total, 50),
+                'p95_ms': percentile(total, 95),
+                'p50_sql': percentile(sql_count, 50),
+                'p95_sql': percentile(sql_count, 95),
+                'p50_sql_ms': percentile([r['sql_ms'] for r in records], 50),
+                'p95_ext_ms': percentile([r['external_ms'] for r in records], 95),
+            })
+        rows.sort(key=lambda row: row[options['sort']], reverse=True)
+
+        header = ('%-55s %7s %10s %10s %8s %8s %10s %10s'
+                  % ('view', 'count', 'p50 ms', 'p95 ms', 'p50 sql',
+                     'p95 sql', 'p50 sql ms', 'p95 ext ms'))
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for row in rows[:options['limit']]:
+            self.stdout.write(
+                '%-55s %7d %10.1f %10.1f %8d %8d %10.1f %10.1f' % (
+                    row['view'][:55], row['count'], row['p50_ms'],
+                    row['p95_ms'], row['p50_sql'], row['p95_sql'],
+                    row['p50_sql_ms'], row['p95_ext_ms']))
@@ -0,0 +1,185 @@
+"""Incremental synchronization of the dingtalk organization into Employees.
+
+The department tree and the users of every department are fetched with a
+bounded thread pool, then diffed against Employees in memory and written
+with bulk_create/bulk_update in one transaction. Nothing is requested at
+import time, a token is only fetched when a sync runs.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from dingtalk_sdk_gmdzy2010.department_request import (
+    DeptsRequest, SubDeptIdsRequest
+)
+from dingtalk_sdk_gmdzy2010.user_request import DeptUsersSimpleRequest
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from BMS.db import bulk_update
+from BMS.dingtalk_token import get_access_token
+from em.models import Employees
+
+SYNC_FIELDS = ("dingtalk_id", "dingtalk_name", "is_on_job")
+
+
+class SyncReport(object):
+    """What a sync did, or would do in dry-run mode"""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.dingtalk_users = 0
+        self.created = []
+        self.updated = []
+        self.unchanged = 0
+        self.unmatched = []
+        self.ambiguous = []
+
+    def as_dict(self):
+        return {
+            "dry_run": self.dry_run,
+            "dingtalk_users": self.dingtalk_users,
+            "created": len(self.created),
+            "updated": len(self.updated),
+            "unchanged": self.unchanged,
+            "unmatched": len(self.unmatched),
+            "ambiguous": len(self.ambiguous),
+        }
+
+    def __str__(self):
+        return (
+            "%s总共%s个员工，添加成功的%s个员工，不成功的%s个员工，"
+            "修改成功的%s个员工，未变化的%s个员工，重名的%s个员工" % (
+                "【试运行】" if self.dry_run else "", self.dingtalk_users,
+                len(self.created), len(self.unmatched), len(self.updated),
+                self.unchanged, len(self.ambiguous),
+            )
+        )
+
+
+class OrgSync(object):
+    """Sync the users under the department ``dept_name`` (a direct child of
+    ``root_dept_id``) into Employees."""
+
+    def __init__(self, dept_name="科技服务事业部", root_dept_id=1,
+                 max_workers=None, access_token=None, dry_run=False):
+        self.dept_name = dept_name
+        self.root_dept_id = root_dept_id
+        self.max_workers = max_workers or getattr(
+            settings, "DINGTALK_SYNC_MAX_WORKERS", 8
+        )
+        self.access_token = access_token
+        self.dry_run = dry_run
+
+    def get_access_token(self):
+        if self.access_token is None:
+            self.access_token = get_access_token(
+                settings.DINGTALK_APPKEY, settings.DINGTALK_SECRET
+            )
+        return self.access_token
+
+    # Fetching
+    def fetch_top_dept_id(self):
+        params = {
+            "access_token": self.get_access_token(),
+            "id": self.root_dept_id,
+            "fetch_child": False,
+        }
+        request = DeptsRequest(params=params)
+        request.get_json_response()
+        return request.get_depts(dept_name=self.dept_name)["id"]
+
+    def fetch_sub_dept_ids(self, dept_id):
+        params = {"access_token": self.get_access_token(), "id": dept_id}
+        request = SubDeptIdsRequest(params=params)
+        request.get_json_response()
+        return request.get_sub_dept_ids() or []
+
+    def fetch_dept_users(self, dept_id):
+        params = {
+            "access_token": self.get_access_token(), "department_id": dept_id
+        }
+        request = DeptUsersSimpleRequest(params=params)
+        request.get_json_response()
+        return request.get_dept_users_brief() or []
+
+    def fetch_dept_ids(self, executor, top_dept_id):
+        """Walk the tree level by level, a level is fetched concurrently"""
+        dept_ids = [top_dept_id]
+        level = [top_dept_id]
+        while level:
+            level = [
+                sub_id
+                for sub_ids in executor.map(self.fetch_sub_dept_ids, level)
+                for sub_id in sub_ids
+            ]
+            dept_ids.extend(level)
+        return dept_ids
+
+    def fetch_users(self):
+        """The users of the whole department tree, unique by userid"""
+        self.get_access_token()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            dept_ids = self.fetch_dept_ids(executor, self.fetch_top_dept_id())
+            users = {}
+            for dept_users in executor.map(self.fetch_dept_users, dept_ids):
+                for user in dept_users:
+                    users.setdefault(user["userid"], user)
+        return list(users.values())
+
+    # Diffing
+    def diff(self, dingtalk_users, report):
+        users_by_name = {}
+        for user in User.objects.only(
+                "id", "first_name", "last_name", "is_staff"):
+            key = (user.last_name, user.first_name)
+            users_by_name.setdefault(key, []).append(user)
+        employees = dict(
+            (e.user_id, e) for e in Employees.objects.all()
+        )
+
+        for dingtalk_user in dingtalk_users:
+            name = dingtalk_user["name"]
+            matched = users_by_name.get((name[:1], name[1:]), [])
+            if not matched:
+                report.unmatched.append(dingtalk_user)
+                continue
+            if len(matched) > 1:
+                report.ambiguous.append(dingtalk_user)
+                continue
+            user = matched[0]
+            values = {
+                "dingtalk_id": dingtalk_user["userid"],
+                "dingtalk_name": name,
+                "is_on_job": user.is_staff,
+            }
+            employee = employees.get(user.pk)
+            if employee is None:
+                employee = Employees(user=user, **values)
+                employees[user.pk] = employee
+                report.created.append(employee)
+            elif any(getattr(employee, f) != v for f, v in values.items()):
+                for field, value in values.items():
+                    setattr(employee, field, value)
+                report.updated.append(employee)
+            else:
+                report.unchanged += 1
+        return report
+
+    def apply(self, report):
+        with transaction.atomic():
+            Employees.objects.bulk_create(report.created, batch_size=500)
+            bulk_update(Employees, report.updated, SYNC_FIELDS)
+
+    def run(self, dingtalk_users=None):
+        report = SyncReport(dry_run=self.dry_run)
+        if dingtalk_users is None:
+            dingtalk_users = self.fetch_users()
+        report.dingtalk_users = len(dingtalk_users)
+        self.diff(dingtalk_users, report)
+        if not self.dry_run:
+            self.apply(report)
+        return report
+
+
+def sync_employees(dry_run=False, **kwargs):
+    return OrgSync(dry_run=dry_run, **kwargs).run()
@@ -55,7 +55,7 @@ class Employees(models.Model):
         on_delete=models.CASCADE
     )
     dingtalk_id = models.CharField(
-        verbose_name="钉钉编号", max_length=32,
+        verbose_name="钉钉编号", max_length=32, db_index=True,
     )
     dingtalk_name = models.CharField(
         verbose_name="钉钉姓名", max_length=32,
@@ -0,0 +1,83 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from em.dingtalk_sync import OrgSync
+from em.models import Employees
+
+
+class OrgSyncTest(TestCase):
+    """OrgSync fed with dingtalk users instead of the api"""
+
+    def setUp(self):
+        self.zhang = User.objects.create(
+            username="zhangsan", last_name="张", first_name="三",
+            is_staff=True,
+        )
+        self.li = User.objects.create(
+            username="lisi", last_name="李", first_name="四", is_staff=True,
+        )
+
+    def sync(self, dingtalk_users, dry_run=False):
+        return OrgSync(access_token="token", dry_run=dry_run).run(
+            dingtalk_users=dingtalk_users
+        )
+
+    def employee_values(self):
+        return sorted(Employees.objects.values_list(
+            "user__username", "dingtalk_id", "dingtalk_name", "is_on_job"
+        ))
+
+    def test_create(self):
+        report = self.sync([
+            {"userid": "u1", "name": "张三"},
+            {"userid": "u2", "name": "李四"},
+        ])
+        self.assertEqual(report.as_dict(), {
+            "dry_run": False, "dingtalk_users": 2, "created": 2,
+            "updated": 0, "unchanged": 0, "unmatched": 0, "ambiguous": 0,
+        })
+        self.assertEqual(self.employee_values(), [
+            ("lisi", "u2", "李四", True), ("zhangsan", "u1", "张三", True),
+        ])
+
+    def test_update_and_unchanged(self):
+        self.sync([
+            {"userid": "u1", "name": "张三"}, {"userid": "u2", "name": "李四"},
+        ])
+        report = self.sync([
+            {"userid": "u1", "name": "张三"}, {"userid": "u9", "name": "李四"},
+        ])
+        self.assertEqual(len(report.created), 0)
+        self.assertEqual(len(report.updated), 1)
+        self.assertEqual(report.unchanged, 1)
+        self.assertEqual(self.employee_values(), [
+            ("lisi", "u9", "李四", True), ("zhangsan", "u1", "张三", True),
+        ])
+
+    def test_leave(self):
+        self.sync([{"userid": "u1", "name": "张三"}])
+        User.objects.filter(pk=self.zhang.pk).update(is_staff=False)
+        report = self.sync([{"userid": "u1", "name": "张三"}])
+        self.assertEqual(len(report.updated), 1)
+        self.assertFalse(Employees.objects.get(user=self.zhang).is_on_job)
+
+    def test_unmatched_and_ambiguous(self):
+        User.objects.create(username="lisi2", last_name="李", first_name="四")
+        report = self.sync([
+            {"userid": "u2", "name": "李四"}, {"userid": "u3", "name": "王五"},
+        ])
+        self.assertEqual(report.ambiguous, [{"userid": "u2", "name": "李四"}])
+        self.assertEqual(report.unmatched, [{"userid": "u3", "name": "王五"}])
+        self.assertFalse(Employees.objects.exists())
+
+    def test_dry_run(self):
+        self.sync([{"userid": "u1", "name": "张三"}])
+        User.objects.filter(pk=self.zhang.pk).update(is_staff=False)
+        before = self.employee_values()
+        report = self.sync([
+            {"userid": "u1", "name": "张三"}, {"userid": "u2", "name": "李四"},
+        ], dry_run=True)
+        self.assertTrue(report.dry_run)
+        self.assertEqual(len(report.created), 1)
+        self.assertEqual(len(report.updated), 1)
+        self.assertEqual(self.employee_values(), before)
@@ -1,6 +1,9 @@
 from django.contrib import admin
 from BMS.notice_mixin import NotificationMixin
 from BMS.admin_bms import BMS_admin_site
+from BMS import roles
+from BMS.roles import get_roles
+from BMS.tracing import traced
 from .models import Bill, Invoice
 from .models import Invoice as fm_Invoice
 from datetime import datetime
@@ -11,6 +14,8 @@ from django.forms.models import BaseInlineFormSet
 from daterange_filter.filter import DateRangeFilter
 from django.contrib.auth.models import User
 from import_export import resources
+from BMS.metrics import ResourceMetricsMixin
+from BMS.routers import ReplicaExportMixin, use_replica
 from import_export.admin import ExportActionModelAdmin
 from import_export import fields
 from import_export.widgets import ForeignKeyWidget
@@ -20,7 +25,7 @@ from pm.models import SubProject
 from django import forms
 from BMS.settings import DINGTALK_APPKEY, DINGTALK_SECRET, DINGTALK_AGENT_ID
 from em.models import Employees
-from nm.models import DingtalkChat
+from nm.chats import get_chat_id
 
 class InvoiceForm(forms.ModelForm):
     '''
@@ -41,8 +46,9 @@ class InvoiceChangeList(ChangeList):
     def get_results(self, *args, **kwargs):
         super(InvoiceChangeList, self).get_results(*args, **kwargs)
         self.sum = []
-        q_income = self.result_list.aggregate(income_sum=Sum('bill__income'))
-        q_amount = self.result_list.aggregate(amount_sum=Sum('invoice__amount'))
+        with use_replica():
+            q_income = self.result_list.aggregate(income_sum=Sum('bill__income'))
+            q_amount = self.result_list.aggregate(amount_sum=Sum('invoice__amount'))
         try:
             receivable_sum = (q_amount['amount_sum'] or 0) - (q_income['income_sum'] or 0)
             self.sum = [q_amount['amount_sum'],receivable_sum, q_income['income_sum']]
@@ -50,7 +56,8 @@ class InvoiceChangeList(ChangeList):
             self.sum = ['','', '']
 
 
-class InvoiceInfoResource(resources.ModelResource):
+class InvoiceInfoResource(ReplicaExportMixin, ResourceMetricsMixin,
+                          resources.ModelResource):
     '''
     财务发票的导出
     '''
@@ -147,8 +154,8 @@ class SaleListFilter(admin.SimpleListFilter):
     parameter_name = 'Sale'
 
     def lookups(self, request, model_admin):
-        qs_sale = User.objects.filter(groups__id=3)
-        qs_company = User.objects.filter(groups__id=6)
+        qs_sale = User.objects.filter(groups__id=roles.SALES)
+        qs_company = User.objects.filter(groups__id=roles.COMPANY)
         value = ['sale'] + list(qs_sale.values_list('username', flat=True)) + \
                 ['company'] + list(qs_company.values_list('username', flat=True))
         label = ['销售'] + ['——' + i.last_name + i.first_name for i in qs_sale] + \
@@ -157,10 +164,10 @@ class SaleListFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() == 'sale':
-            return queryset.filter(invoice__contract__salesman__in=list(User.objects.filter(groups__id=3)))
+            return queryset.filter(invoice__contract__salesman__in=list(User.objects.filter(groups__id=roles.SALES)))
         if self.value() == 'company':
-            return queryset.filter(invoice__contract__salesman__in=list(User.objects.filter(groups__id=6)))
-        qs = User.objects.filter(groups__in=[3, 6])
+            return queryset.filter(invoice__contract__salesman__in=list(User.objects.filter(groups__id=roles.COMPANY)))
+        qs = User.objects.filter(groups__in=[roles.SALES, roles.COMPANY])
         for i in qs:
             if self.value() == i.username:
                 return queryset.filter(invoice__contract__salesman=i)
@@ -270,6 +277,7 @@ class InvoiceAdmin(ExportActionModelAdmin, NotificationMixin):
             queryset, use_distinct = super().get_search_results(request, queryset, search_term)
         return queryset, use_distinct
 
+    @traced()
     def save_model(self, request, obj, form, change):
         user_id = False
         if obj.invoice_code and not obj.date:
@@ -293,7 +301,7 @@ class InvoiceAdmin(ExportActionModelAdmin, NotificationMixin):
                         self.send_work_notice(content, DINGTALK_AGENT_ID, user_id)
                     # 通知市场人员，内容：抬头，金额，
                     # TODO 需要添加创建合同的人员，这些的消息反馈给新建合同的人，暂时发给项目管理
-                    self.send_group_message(content, DingtalkChat.objects.get(chat_name="项目管理钉钉群-BMS").chat_id)
+                    self.send_group_message(content, get_chat_id("pm"))
         else:
             if obj.invoice_code and obj.date:
                 content = "【上海锐翌生物科技有限公司-BMS系统通知】开出发票，发票号码：%s 开票金额：%s"%(obj.invoice_code,obj.invoice.amount)
@@ -303,11 +311,12 @@ class InvoiceAdmin(ExportActionModelAdmin, NotificationMixin):
                     self.send_work_notice(content, DINGTALK_AGENT_ID, user_id)
                 # 通知市场人员，内容：抬头，金额，
                 # TODO 需要添加创建合同的人员，这些的消息反馈给新建合同的人，暂时发给项目管理
-                self.send_group_message(content, DingtalkChat.objects.get(chat_name="项目管理钉钉群-BMS").chat_id)
+                self.send_group_message(content, get_chat_id("pm"))
                 # notify.send(request.user, recipient=obj.invoice.contract.salesman, verb='开出发票',description="发票号码：%s 开票金额：%s"%(obj.invoice_code,obj.invoice.amount))
             #通知市场人员，内容：抬头，金额，对应销售员。
         obj.save()
 
+    @traced()
     def save_formset(self, request, form, formset, change):
         instances = formset.save(commit=False)
         for obj in formset.deleted_objects:
@@ -356,7 +365,7 @@ class InvoiceAdmin(ExportActionModelAdmin, NotificationMixin):
                 # if user_id:
                 #     self.send_work_notice(content, DINGTALK_AGENT_ID, user_id)
                 # TODO 需要添加创建合同的人员，这些的消息反馈给新建合同的人，暂时发给项目管理
-                self.send_group_message(content, DingtalkChat.objects.get(chat_name="项目管理钉钉群-BMS").chat_id)
+                self.send_group_message(content, get_chat_id("pm"))
             else:
                 messages.set_level(request, messages.ERROR)
                 self.message_user(request, '进账总额 %.2f 超过开票金额 %.2f' % (sum_income, invoice_amount),
@@ -387,10 +396,10 @@ class InvoiceAdmin(ExportActionModelAdmin, NotificationMixin):
 
     def get_queryset(self, request):
         # 只允许管理员和拥有该模型删除权限的人员，销售总监才能查看所有
-        haved_perm = False
-        for group in request.user.groups.all():
-            if (group.id == 7) or (group.id == 14) or (group.id == 5) or (group.id == 4) or (group.id == 12) or (group.id == 15):  #销售总监、财务总监,财务部、市场部、市场总监、市场部项目组
-                haved_perm=True
+        #销售总监、财务总监,财务部、市场部、市场总监、市场部项目组
+        haved_perm = get_roles(request).has_id(
+            roles.SALES_DIRECTOR, roles.FINANCE_DIRECTOR, roles.FINANCE,
+            roles.MARKET, roles.MARKET_DIRECTOR, roles.MARKET_PROJECT)
         qs = super().get_queryset(request)
         if request.user.is_superuser or haved_perm:
             return qs
@@ -410,10 +419,12 @@ class InvoiceAdmin(ExportActionModelAdmin, NotificationMixin):
 
     def get_list_filter(self, request):
         #销售总监，admin，有删除权限的人可以看到salelistFilter
-        haved_perm = False
-        for group in request.user.groups.all():
-            if (group.id == 7) or (group.id == 5) or (group.id == 14) or (group.id == 4) or (group.id==12)  or (group.id == 15) or (request.user.id == 47) or (request.user.id == 11):#销售总监、财务总监,财务部、市场部、市场总监、市场部项目组,刘强，战飞翔
-                haved_perm=True
+        #销售总监、财务总监,财务部、市场部、市场总监、市场部项目组,刘强，战飞翔
+        user_roles = get_roles(request)
+        haved_perm = user_roles.has_id(
+            roles.SALES_DIRECTOR, roles.FINANCE, roles.FINANCE_DIRECTOR,
+            roles.MARKET, roles.MARKET_DIRECTOR, roles.MARKET_PROJECT
+        ) or (len(user_roles) > 0 and request.user.id in (47, 11))
         if request.user.is_superuser or haved_perm:
             return [
                 SaleListFilter,
@@ -450,7 +461,8 @@ class BillChangeList(ChangeList):
     '''
     def get_results(self, *args, **kwargs):
         super(BillChangeList, self).get_results(*args, **kwargs)
-        q = self.result_list.aggregate(Sum('income'))
+        with use_replica():
+            q = self.result_list.aggregate(Sum('income'))
         self.income_count = q['income__sum']
 
 
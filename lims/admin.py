@@ -1,15 +1,21 @@
 import datetime
 import time
 from django.contrib import admin
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User
 from django import forms
 from django.utils.html import format_html
 from hashlib import md5
-from nm.models import DingtalkChat
+from nm.chats import get_chat_id
 from import_export import resources, fields
+from BMS import roles
+from BMS.imports import ImportProgressMixin, StreamingImportMixin
+from BMS.metrics import ResourceMetricsMixin
 from import_export.admin import ImportExportActionModelAdmin
 from BMS import settings
 from BMS.admin_bms import BMS_admin_site
+from BMS.paginator import ApproximateCountMixin
+from BMS.tracing import span, traced
+from BMS.roles import get_roles
 from BMS.notice_mixin import NotificationMixin
 from BMS.settings import DINGTALK_SECRET, DINGTALK_APPKEY
 from lims.models import SampleInfoExt, ExtExecute, LibExecute, SampleInfoLib, \
@@ -21,6 +27,7 @@ try:
     from django.utils.encoding import force_text
 except ImportError:
     from django.utils.encoding import force_unicode as force_text
+from sample.import_jobs import ImportJobMixin
 from sample.models import SampleInfoForm, SampleInfo
 
 
@@ -156,7 +163,8 @@ class TestmothodAdmin(admin.ModelAdmin):
 
 
 # 抽提的导入
-class SampleInfoExtResource(resources.ModelResource):
+class SampleInfoExtResource(ResourceMetricsMixin, ImportProgressMixin,
+                            resources.ModelResource):
     class Meta:
         model = SampleInfoExt
         skip_unchanged = True
@@ -212,7 +220,9 @@ class SampleInfoExtResource(resources.ModelResource):
             # return (self.init_instance(row), True)
 
 
-class ExtExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
+class ExtExecuteAdmin(ApproximateCountMixin, ImportJobMixin,
+                      StreamingImportMixin, ImportExportActionModelAdmin,
+                      NotificationMixin):
     form = ExtExecuteForm
 
     filter_horizontal = ("ext_experimenter",)
@@ -366,10 +376,10 @@ class ExtExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
 
     is_fanyang.short_description = '样品是否要求返样'
 
+    @traced()
     def save_model(self, request, obj, form, change):
 
-        Dinggroupid = DingtalkChat.objects.filter(
-            chat_name="实验钉钉群-BMS").first().chat_id
+        Dinggroupid = get_chat_id("lab")
 
         sub_number = obj.extSubmit.subProject.sub_number
 
@@ -408,10 +418,11 @@ class ExtExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
 
             msg_dingding = "项目{0}的抽提执行{1}结果已上传{2}".format(
                 project.sub_project, obj.extSubmit, data_url)
-            for i in qs.filter(is_rebuild=0):
-                SampleInfo.objects.filter(
-                    unique_code=i.unique_code).update(
-                    color_code="__{}__已抽提".format(sub_number))
+            with span("lims.ext.mark_samples"):
+                for i in qs.filter(is_rebuild=0):
+                    SampleInfo.objects.filter(
+                        unique_code=i.unique_code).update(
+                        color_code="__{}__已抽提".format(sub_number))
             # 建立重抽提任务单
             if qs.filter(is_rebuild=1).count() > 0:
                 ext = ExtSubmit()
@@ -508,16 +519,18 @@ class ExtExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
                                     fail_silently=False)
                 except:
                     self.message_user(request, "邮箱发送失败")
-            dingdingid = DingtalkChat.objects.get(chat_name="项目管理钉钉群-BMS")
-            self.send_group_message(msg_dingding, dingdingid.chat_id)
+            dingdingid = get_chat_id("pm")
+            self.send_group_message(msg_dingding, dingdingid)
             self.message_user(request, "抽提实验结果导入成功")
         else:
             pass
-        super().save_model(request, obj, form, change)
+        with span("super.save_model"):
+            super().save_model(request, obj, form, change)
 
 
 # 建库操作
-class SampleInfoLibResource(resources.ModelResource, ):
+class SampleInfoLibResource(ResourceMetricsMixin, ImportProgressMixin,
+                            resources.ModelResource):
     class Meta:
         model = SampleInfoLib
         skip_unchanged = True
@@ -568,7 +581,8 @@ class SampleInfoLibResource(resources.ModelResource, ):
 
 
 #
-class LibExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
+class LibExecuteAdmin(ImportJobMixin, StreamingImportMixin,
+                      ImportExportActionModelAdmin, NotificationMixin):
     resource_class = SampleInfoLibResource
 
     list_per_page = 50
@@ -720,10 +734,10 @@ class LibExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
             kwargs["queryset"] = User.objects.filter(groups__name="实验部")
         return super().formfield_for_manytomany(db_field, request, **kwargs)
 
+    @traced()
     def save_model(self, request, obj, form, change):
 
-        Dinggroupid = DingtalkChat.objects.filter(
-            chat_name="实验钉钉群-BMS").first().chat_id
+        Dinggroupid = get_chat_id("lab")
 
         sub_number = obj.libSubmit.subProject.sub_number
 
@@ -769,13 +783,14 @@ class LibExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
             #              "</th><th>浓度ng/uL(文库)</th><th>总量ng(文库)</th><th>结论(文库)</th><th>备注(文库)</th><th>选择是否重建库</th>"
             #              "</tr>".format(msg_dingding), ]
 
-            for i in qs.filter(is_rebuild=0):
-                # msg_email.append(("<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td><td>{5}</td><td>{6}</td><td>{7}</td><td>{8}</td><td>{9}</td>"
-                #                   .format(i.sample_number,i.sample_name,i.lib_code,i.index,i.lib_volume,i.lib_concentration,
-                #                           i.lib_total,i.Lib_result[i.lib_result-1][1],i.lib_note,i.Rebulid[i.is_rebuild][1])))
-                SampleInfo.objects.filter(
-                    unique_code=i.unique_code).update(
-                    color_code="__{}__已建库".format(sub_number))
+            with span("lims.lib.mark_samples"):
+                for i in qs.filter(is_rebuild=0):
+                    # msg_email.append(("<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td><td>{5}</td><td>{6}</td><td>{7}</td><td>{8}</td><td>{9}</td>"
+                    #                   .format(i.sample_number,i.sample_name,i.lib_code,i.index,i.lib_volume,i.lib_concentration,
+                    #                           i.lib_total,i.Lib_result[i.lib_result-1][1],i.lib_note,i.Rebulid[i.is_rebuild][1])))
+                    SampleInfo.objects.filter(
+                        unique_code=i.unique_code).update(
+                        color_code="__{}__已建库".format(sub_number))
             # 建立重建库任务单
             if qs.filter(is_rebuild=1).count() > 0:
                 lib = LibSubmit()
@@ -869,16 +884,18 @@ class LibExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
                                     fail_silently=False)
                 except:
                     self.message_user(request, "邮箱发送失败")
-            dingdingid = DingtalkChat.objects.get(chat_name="项目管理钉钉群-BMS")
-            self.send_group_message(msg_dingding, dingdingid.chat_id)
+            dingdingid = get_chat_id("pm")
+            self.send_group_message(msg_dingding, dingdingid)
             self.message_user(request, "建库实验结果导入成功")
         else:
             pass
-        super().save_model(request, obj, form, change)
+        with span("super.save_model"):
+            super().save_model(request, obj, form, change)
 
 
 # 测序操作
-class SampleInfoSeqResource(resources.ModelResource):
+class SampleInfoSeqResource(ResourceMetricsMixin, ImportProgressMixin,
+                            resources.ModelResource):
     class Meta:
         model = SampleInfoSeq
         skip_unchanged = True
@@ -932,7 +949,8 @@ class SampleInfoSeqResource(resources.ModelResource):
             # return (self.init_instance(row), True)
 
 
-class SeqExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
+class SeqExecuteAdmin(ImportJobMixin, StreamingImportMixin,
+                      ImportExportActionModelAdmin, NotificationMixin):
     resource_class = SampleInfoSeqResource
 
     list_per_page = 50
@@ -1048,7 +1066,7 @@ class SeqExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
 
     def get_actions(self, request):
         actions = super().get_actions(request)
-        current_group_set = Group.objects.filter(user=request.user)
+        current_group_set = get_roles(request).groups
         names = [i.name for i in current_group_set]
         if "项目管理" in names:
             del actions["processing_experiment"]
@@ -1075,7 +1093,8 @@ class SeqExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
         for obj in queryset:
             if obj.seq_experimenter.count() == 0:
                 i += 1
-                for j in User.objects.filter(groups__id=13).all():
+                for j in User.objects.filter(
+                        groups__id=roles.SEQ_EXPERIMENTER).all():
                     obj.seq_experimenter.add(j)
                 obj.save()
         self.message_user(request, "{}个测序执行成功分配实验员".format(i))
@@ -1104,7 +1123,7 @@ class SeqExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
     pooling.short_description = "Pooling表下载"
 
     def get_readonly_fields(self, request, obj=None):
-        current_group_set = Group.objects.filter(user=request.user)
+        current_group_set = get_roles(request).groups
         names = [i.name for i in current_group_set]
         try:
             if obj.is_submit:
@@ -1140,10 +1159,10 @@ class SeqExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
             kwargs["queryset"] = User.objects.filter(groups__name="实验部")
         return super().formfield_for_manytomany(db_field, request, **kwargs)
 
+    @traced()
     def save_model(self, request, obj, form, change):
 
-        Dinggroupid = DingtalkChat.objects.filter(
-            chat_name="实验钉钉群-BMS").first().chat_id
+        Dinggroupid = get_chat_id("lab")
 
         sub_number = obj.seqSubmit.subProject.sub_number
 
@@ -1189,16 +1208,17 @@ class SeqExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
             #     "</th><th>测序数据量</th><th>结论(测序)</th><th>备注(测序)</th><th>选择是否重测序</th>"
             #     "</tr>".format(msg_dingding), ]
 
-            for i in qs.filter(is_rebuild=0):
-                # msg_email.append(("<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td><td>{5}</td><td>{6}</td><td>{7}</td><td>{8}</td>"
-                #                      .format(i.sample_number, i.sample_name, i.seq_code, i.seq_index, i.data_request,
-                #                              i.seq_data,
-                #                              i.Seq_result[i.seq_result-1][1], i.seq_note,
-                #                              i.Rebulid[i.is_rebuild][1])))
-
-                SampleInfo.objects.filter(
-                    unique_code=i.unique_code).update(
-                    color_code="__{}__已测序".format(sub_number))
+            with span("lims.seq.mark_samples"):
+                for i in qs.filter(is_rebuild=0):
+                    # msg_email.append(("<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td><td>{5}</td><td>{6}</td><td>{7}</td><td>{8}</td>"
+                    #                      .format(i.sample_number, i.sample_name, i.seq_code, i.seq_index, i.data_request,
+                    #                              i.seq_data,
+                    #                              i.Seq_result[i.seq_result-1][1], i.seq_note,
+                    #                              i.Rebulid[i.is_rebuild][1])))
+
+                    SampleInfo.objects.filter(
+                        unique_code=i.unique_code).update(
+                        color_code="__{}__已测序".format(sub_number))
             # 建立重测序任务单
             if qs.filter(is_rebuild=1).count() > 0:
                 seq = SeqSubmit()
@@ -1290,13 +1310,14 @@ class SeqExecuteAdmin(ImportExportActionModelAdmin, NotificationMixin):
                                     fail_silently=False)
                 except:
                     self.message_user(request, "邮箱发送失败")
-            dingdingid = DingtalkChat.objects.get(chat_name="项目管理钉钉群-BMS")
-            self.send_group_message(msg_dingding, dingdingid.chat_id)
+            dingdingid = get_chat_id("pm")
+            self.send_group_message(msg_dingding, dingdingid)
             self.message_user(request, "测序实验结果已导入")
         else:
             pass
 
-        super().save_model(request, obj, form, change)
+        with span("super.save_model"):
+            super().save_model(request, obj, form, change)
 
 
 # 样品池管理
@@ -6,6 +6,10 @@ from django.contrib.admin import ModelAdmin
 from django.contrib.auth.hashers import make_password, check_password
 from BMS.notice_mixin import NotificationMixin
 from BMS.admin_bms import BMS_admin_site
+from BMS.paginator import ApproximateCountMixin
+from BMS.tracing import traced
+from BMS import roles
+from BMS.roles import get_roles
 from .models import Invoice, Contract, InvoiceTitle, BzContract, \
     Contract_execute, OutSourceContract
 from fm.models import Invoice as fm_Invoice
@@ -19,6 +23,8 @@ from django.contrib.admin.views.main import ChangeList
 from django.db.models import Sum
 from django.contrib.auth.models import User, Group
 from import_export import resources
+from BMS.metrics import ResourceMetricsMixin
+from BMS.routers import ReplicaExportMixin, use_replica
 from import_export.admin import ImportExportActionModelAdmin, \
     ExportActionModelAdmin
 from import_export import fields
@@ -27,7 +33,7 @@ from functools import partial
 from django.utils import formats
 from BMS.settings import DINGTALK_APPKEY, DINGTALK_SECRET, DINGTALK_AGENT_ID
 from em.models import Employees
-from nm.models import DingtalkChat
+from nm.chats import get_chat_id
 import re
 from django.db.models import Q
 
@@ -166,7 +172,8 @@ class ContractExecuteAdmin(ExportActionModelAdmin, NotificationMixin):
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == "saler":
-            saler_ = User.objects.filter(Q(groups__id=3) | Q(groups__id=6))
+            saler_ = User.objects.filter(
+                Q(groups__id=roles.SALES) | Q(groups__id=roles.COMPANY))
             kwargs["queryset"] = saler_
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
@@ -181,10 +188,10 @@ class ContractExecuteAdmin(ExportActionModelAdmin, NotificationMixin):
             return self.readonly_fields
 
     def get_queryset(self, request):
-        haved_perm = False
-        for group in request.user.groups.all():
-            if group.id == 7 or group.id == 2 or group.id == 12 or group.id == 15:  # 市场部总监，项目管理，销售总监
-                haved_perm = True
+        # 市场部总监，项目管理，销售总监
+        haved_perm = get_roles(request).has_id(
+            roles.SALES_DIRECTOR, roles.PM, roles.MARKET_DIRECTOR,
+            roles.MARKET_PROJECT)
         qs = super(ContractExecuteAdmin, self).get_queryset(request)
 
         if request.user.is_superuser or request.user.has_perm(
@@ -273,8 +280,7 @@ class InvoiceAdmin(admin.ModelAdmin, NotificationMixin):
                 #     obj.contract.is_status = 2   #提交第一个发票申请的状态,改为：已申请开票。合同就不能在修改了
                 #     obj.contract.save()
                 # 新的开票申请 通知财务部5
-                fm_chat_id = DingtalkChat.objects.get(
-                    chat_name="财务钉钉群-BMS").chat_id  # TODO改为财务的钉钉群
+                fm_chat_id = get_chat_id("finance")
                 content = "【上海锐翌生物科技有限公司-BMS系统通知】" + " 合同名称：%s 款期： %s  金额：%s  提交了开票申请" % (
                 obj.contract.name, obj.period, obj.amount)
                 self.send_group_message(content, fm_chat_id)
@@ -301,10 +307,10 @@ class InvoiceAdmin(admin.ModelAdmin, NotificationMixin):
     #         super().get_form(request, obj=obj, change=change, **kwargs)
     def get_actions(self, request):
         actions = super().get_actions(request)
-        for group in request.user.groups.all():
-            if group.id == 7 or group.id == 12:  # 市场部总监，销售总监
-                if "make_invoice_submit" in actions:
-                    del actions["make_invoice_submit"]
+        # 市场部总监，销售总监
+        if get_roles(request).has_id(roles.SALES_DIRECTOR, roles.MARKET_DIRECTOR):
+            if "make_invoice_submit" in actions:
+                del actions["make_invoice_submit"]
         return actions
 
     # def change_view(self, request, object_id, form_url='', extra_context=None):
@@ -337,8 +343,7 @@ class InvoiceAdmin(admin.ModelAdmin, NotificationMixin):
             fm_Invoice.objects.create(invoice=obj, tax_amount=6)
             obj.submit = True
             obj.save()
-            fm_chat_id = DingtalkChat.objects.get(
-                chat_name="财务钉钉群-BMS").chat_id  # TODO改为财务的钉钉群
+            fm_chat_id = get_chat_id("finance")
             content = "【上海锐翌生物科技有限公司-BMS通知】" + " 合同名称：%s 款期： %s  金额：%s  提交了开票申请" % (
                 obj.contract.name, obj.period, obj.amount)
             self.send_group_message(content, fm_chat_id)
@@ -404,13 +409,14 @@ class ContractChangeList(ChangeList):
 
     def get_results(self, *args, **kwargs):
         super().get_results(*args, **kwargs)
-        fis_amount = self.result_list.aggregate(fis_sum=Sum('fis_amount'))
-        fin_amount = self.result_list.aggregate(fin_sum=Sum('fin_amount'))
-        all_amount = self.result_list.aggregate(all_sum=Sum('all_amount'))
-        fis_amount_in = self.result_list.aggregate(
-            fis_amount_in_sum=Sum('fis_amount_in'))
-        fin_amount_in = self.result_list.aggregate(
-            fin_amount_in_sum=Sum('fin_amount_in'))
+        with use_replica():
+            fis_amount = self.result_list.aggregate(fis_sum=Sum('fis_amount'))
+            fin_amount = self.result_list.aggregate(fin_sum=Sum('fin_amount'))
+            all_amount = self.result_list.aggregate(all_sum=Sum('all_amount'))
+            fis_amount_in = self.result_list.aggregate(
+                fis_amount_in_sum=Sum('fis_amount_in'))
+            fin_amount_in = self.result_list.aggregate(
+                fin_amount_in_sum=Sum('fin_amount_in'))
         self.amount = '%.2f' % ((fis_amount['fis_sum'] or 0) + (
                     fin_amount['fin_sum'] or 0))
         self.amount_input = '%.2f' % (all_amount['all_sum'] or 0)
@@ -425,8 +431,8 @@ class SaleListFilter(admin.SimpleListFilter):
     parameter_name = 'Sale'
 
     def lookups(self, request, model_admin):
-        qs_sale = User.objects.filter(groups__id=3)
-        qs_company = User.objects.filter(groups__id=6)
+        qs_sale = User.objects.filter(groups__id=roles.SALES)
+        qs_company = User.objects.filter(groups__id=roles.COMPANY)
         value = ['sale'] + list(qs_sale.values_list('username', flat=True)) + \
                 ['company'] + list(
             qs_company.values_list('username', flat=True))
@@ -438,17 +444,18 @@ class SaleListFilter(admin.SimpleListFilter):
     def queryset(self, request, queryset):
         if self.value() == 'sale':
             return queryset.filter(
-                salesman__in=list(User.objects.filter(groups__id=3)))
+                salesman__in=list(User.objects.filter(groups__id=roles.SALES)))
         if self.value() == 'company':
             return queryset.filter(
-                salesman__in=list(User.objects.filter(groups__id=6)))
-        qs = User.objects.filter(groups__in=[3, 6])
+                salesman__in=list(User.objects.filter(groups__id=roles.COMPANY)))
+        qs = User.objects.filter(groups__in=[roles.SALES, roles.COMPANY])
         for i in qs:
             if self.value() == i.username:
                 return queryset.filter(salesman=i)
 
 
-class ContractResource(resources.ModelResource):
+class ContractResource(ReplicaExportMixin, ResourceMetricsMixin,
+                       resources.ModelResource):
     """
     按照合同号导出
     """
@@ -546,7 +553,8 @@ class ContractResource(resources.ModelResource):
         contract.salesman.last_name, contract.salesman.first_name)
 
 
-class ContractAdmin(ExportActionModelAdmin, NotificationMixin):
+class ContractAdmin(ApproximateCountMixin, ExportActionModelAdmin,
+                    NotificationMixin):
     """
     合同中的Admin
     """
@@ -673,10 +681,10 @@ class ContractAdmin(ExportActionModelAdmin, NotificationMixin):
 
     def get_actions(self, request):
         actions = super().get_actions(request)
-        for group in request.user.groups.all():
-            if not group.id == 4:  # 除了市场部都没有登记所选合同的权限
-                if "make_receive" in actions:
-                    del actions["make_receive"]
+        # 除了市场部都没有登记所选合同的权限
+        if any(group.id != roles.MARKET for group in get_roles(request)):
+            if "make_receive" in actions:
+                del actions["make_receive"]
         return actions
 
     def get_formsets_with_inlines(self, request, obj=None):
@@ -687,10 +695,10 @@ class ContractAdmin(ExportActionModelAdmin, NotificationMixin):
 
     def get_queryset(self, request):
         # 只允许管理员,拥有该模型新增权限的人员，销售总监才能查看所有#TODO 给财务开通查询所有合同的权限，暂时先用
-        haved_perm = False
-        for group in request.user.groups.all():
-            if group.id == 7 or group.id == 2 or group.id == 12 or group.id == 15 or group.id == 11:  # 销售总监,项目管理，市场部总监，市场产品组
-                haved_perm = True
+        # 销售总监,项目管理，市场部总监，市场产品组
+        haved_perm = get_roles(request).has_id(
+            roles.SALES_DIRECTOR, roles.PM, roles.MARKET_DIRECTOR,
+            roles.MARKET_PROJECT, roles.MARKET_PRODUCT)
         qs = super(ContractAdmin, self).get_queryset(request)
 
         if request.user.is_superuser or request.user.has_perm(
@@ -712,10 +720,10 @@ class ContractAdmin(ExportActionModelAdmin, NotificationMixin):
 
     def get_list_filter(self, request):
         # 销售总监，admin，有新增权限的人可以看到salelistFilter
-        haved_perm = False
-        for group in request.user.groups.all():
-            if group.id == 7 or group.id == 2 or group.id == 12 or group.id == 15:  # 市场部总监，项目管理，销售总监
-                haved_perm = True
+        # 市场部总监，项目管理，销售总监
+        haved_perm = get_roles(request).has_id(
+            roles.SALES_DIRECTOR, roles.PM, roles.MARKET_DIRECTOR,
+            roles.MARKET_PROJECT)
         if request.user.is_superuser or request.user.has_perm(
                 'mm.add_contract') or haved_perm:
             return [SaleListFilter, 'type',
@@ -736,6 +744,7 @@ class ContractAdmin(ExportActionModelAdmin, NotificationMixin):
                         'contract_file', 'contact_note']
         return self.readonly_fields
 
+    @traced()
     def save_formset(self, request, form, formset, change):
         instances = formset.save(commit=False)
         for obj in formset.deleted_objects:
@@ -750,6 +759,7 @@ class ContractAdmin(ExportActionModelAdmin, NotificationMixin):
                 instance.save()
             formset.save_m2m()
 
+    @traced()
     def save_model(self, request, obj, form, change):
         # 新增合同的时候，合作伙伴的email就在用户表中同步新增好了，客户提交样品信息单的时候，登入系统使用 发钉钉通知
         content = ""
@@ -863,8 +873,7 @@ class ContractAdmin(ExportActionModelAdmin, NotificationMixin):
         elif not obj.tracking_number:
             obj.send_date = None
         if content != "":
-            self.send_group_message(content, DingtalkChat.objects.get(
-                chat_name="项目管理钉钉群-BMS").chat_id)
+            self.send_group_message(content, get_chat_id("pm"))
         obj.save()
 
     def get_changeform_initial_data(self, request):
@@ -878,7 +887,8 @@ class ContractAdmin(ExportActionModelAdmin, NotificationMixin):
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == "salesman":
             sales_users = User.objects.filter(
-                Q(groups__id=3) | Q(groups__id=7) | Q(groups__id=6)).distinct()
+                Q(groups__id=roles.SALES) | Q(groups__id=roles.SALES_DIRECTOR)
+                | Q(groups__id=roles.COMPANY)).distinct()
             kwargs["queryset"] = sales_users
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
@@ -897,10 +907,10 @@ class BzContractAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
 
-        haved_perm = False
-        for group in request.user.groups.all():
-            if group.id == 7 or group.id == 2 or group.id == 12 or group.id == 15:  # 市场部总监，项目管理，销售总监
-                haved_perm = True
+        # 市场部总监，项目管理，销售总监
+        haved_perm = get_roles(request).has_id(
+            roles.SALES_DIRECTOR, roles.PM, roles.MARKET_DIRECTOR,
+            roles.MARKET_PROJECT)
         qs = super(BzContractAdmin, self).get_queryset(request)
 
         if request.user.is_superuser or request.user.has_perm(
@@ -911,12 +921,12 @@ class BzContractAdmin(admin.ModelAdmin):
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == "salesman":
             sales_users = User.objects.filter(
-                Q(groups__id=3) | Q(groups__id=7))
+                Q(groups__id=roles.SALES) | Q(groups__id=roles.SALES_DIRECTOR))
             kwargs["queryset"] = sales_users
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
-class OutSourceContractResource(resources.ModelResource):
+class OutSourceContractResource(ResourceMetricsMixin, resources.ModelResource):
     """Provide OutSourceContract Export Resource"""
     contract_type = fields.Field(
         column_name='合同类型', attribute='contract_type', default=None
@@ -986,8 +996,7 @@ class OutSourceContractAdmin(ImportExportActionModelAdmin, NotificationMixin):
         obj.save()
         if obj.submit:
             content ="【上海锐翌生物科技有限公司-BMS通知】:新增外包合同操作，合同名称：{}，合同编号：{}".format(obj.contract_name, obj.contract_num)
-            self.send_group_message(content, DingtalkChat.objects.get(
-                                chat_name="项目管理钉钉群-BMS").chat_id)
+            self.send_group_message(content, get_chat_id("pm"))
             call_back = self.send_dingtalk_result
             message = "提交成功，已钉钉项目管理群" if call_back else "钉钉通知失败"
             self.message_user(request, message)
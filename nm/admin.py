@@ -1,5 +1,6 @@
 from django.contrib import admin
-from nm.models import DingtalkChat, ChatTemplates
+from django.utils import timezone
+from nm.models import DingtalkChat, ChatTemplates, NotificationOutbox
 from BMS.admin_bms import BMS_admin_site
 
 
@@ -41,5 +42,32 @@ class ChatTemplatesAdmin(admin.ModelAdmin):
     list_filter = ("is_valid", "sign")
 
 
+class NotificationOutboxAdmin(admin.ModelAdmin):
+    list_per_page = 30
+    list_display = (
+        "id", "channel", "status", "attempts", "created_at",
+        "next_attempt_at", "sent_at", "last_error"
+    )
+    list_filter = ("channel", "status")
+    readonly_fields = (
+        "channel", "payload", "idempotency_key", "attempts", "created_at",
+        "sent_at", "last_error"
+    )
+    actions = ("redeliver", )
+
+    def has_add_permission(self, request):
+        return False
+
+    def redeliver(self, request, queryset):
+        from nm.outbox import schedule_delivery
+        queryset.update(status=NotificationOutbox.STATUS_PENDING, attempts=0,
+                        next_attempt_at=timezone.now())
+        for pk in queryset.values_list("pk", flat=True):
+            schedule_delivery(pk)
+        self.message_user(request, "已重新加入发送队列")
+    redeliver.short_description = "重新发送"
+
+
+BMS_admin_site.register(NotificationOutbox, NotificationOutboxAdmin)
 BMS_admin_site.register(ChatTemplates, ChatTemplatesAdmin)
 BMS_admin_site.register(DingtalkChat, DingtalkChatAdmin)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class NmConfig(AppConfig):
     name = 'nm'
     verbose_name = "通知管理系统"
+
+    def ready(self):
+        # connect the signals that refresh the chat registry
+        import nm.chats
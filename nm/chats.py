@@ -0,0 +1,85 @@
+"""In-process registry of the dingtalk chats used by the admins.
+
+The admins ask for a chat by its symbolic role, e.g. get_chat_id("pm"), the
+role is mapped to a chat_name (settings.DINGTALK_CHAT_NAMES may override it)
+and the chat_name to a chat_id. The name -> chat_id table is loaded once per
+process; saving or deleting a DingtalkChat bumps a generation counter in the
+cache so that every process reloads it on its next lookup.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+
+from nm.models import DingtalkChat
+
+CHAT_NAMES = {
+    "lab": "实验钉钉群-BMS",
+    "pm": "项目管理钉钉群-BMS",
+    "finance": "财务钉钉群-BMS",
+    "bioinfo": "生信分析钉钉群-BMS",
+}
+GENERATION_KEY = "nm:chat_registry:generation"
+
+_registry = {"generation": None, "chats": None}
+
+
+def get_chat_names():
+    chat_names = dict(CHAT_NAMES)
+    chat_names.update(getattr(settings, "DINGTALK_CHAT_NAMES", {}))
+    return chat_names
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 1, None)
+        generation = cache.get(GENERATION_KEY, 1)
+    return generation
+
+
+def load_chats():
+    """chat_name -> chat_id, the oldest chat wins for duplicated names"""
+    chats = {}
+    queryset = DingtalkChat.objects.order_by("create_at", "pk").values_list(
+        "chat_name", "chat_id"
+    )
+    for chat_name, chat_id in queryset:
+        chats.setdefault(chat_name, chat_id)
+    return chats
+
+
+def get_chats():
+    generation = get_generation()
+    if _registry["chats"] is None or _registry["generation"] != generation:
+        _registry["chats"] = load_chats()
+        _registry["generation"] = generation
+    return _registry["chats"]
+
+
+def get_chat_id_by_name(chat_name):
+    try:
+        return get_chats()[chat_name]
+    except KeyError:
+        raise DingtalkChat.DoesNotExist(
+            "DingtalkChat named %s does not exist." % chat_name
+        )
+
+
+def get_chat_id(role):
+    """The chat_id of a role like "pm", "lab", "finance" or "bioinfo",
+    raise DingtalkChat.DoesNotExist as the former objects.get() did."""
+    return get_chat_id_by_name(get_chat_names().get(role, role))
+
+
+def invalidate(**kwargs):
+    _registry["chats"] = None
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, 1, None)
+
+
+post_save.connect(invalidate, sender=DingtalkChat,
+                  dispatch_uid="nm.chats.invalidate_save")
+post_delete.connect(invalidate, sender=DingtalkChat,
+                    dispatch_uid="nm.chats.invalidate_delete")
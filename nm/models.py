@@ -1,4 +1,7 @@
 from django.db import models
+from django.utils import timezone
+from jsonfield.fields import JSONField
+
 from em.models import Employees
 
 
@@ -8,7 +11,7 @@ class DingtalkChat(models.Model):
     )
     chat_name = models.CharField(
         verbose_name="群聊名称", max_length=32, null=True, blank=True,
-        default="内部群聊"
+        default="内部群聊", db_index=True
     )
     chat_owner = models.ForeignKey(
         Employees, related_name="chat_owner", verbose_name="群主",
@@ -65,3 +68,59 @@ class ChatTemplates(models.Model):
     
     def __str__(self):
         return '%s' % self.name
+
+
+class NotificationOutbox(models.Model):
+    """Notifications waiting to be delivered by celery, see nm.tasks"""
+    CHANNEL_CHOICES = (
+        ("email", "邮件"),
+        ("work_notice", "钉钉工作通知"),
+        ("group_message", "钉钉群消息"),
+    )
+    STATUS_PENDING = 0
+    STATUS_SENDING = 1
+    STATUS_SENT = 2
+    STATUS_FAILED = 3
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "待发送"),
+        (STATUS_SENDING, "发送中"),
+        (STATUS_SENT, "已发送"),
+        (STATUS_FAILED, "发送失败"),
+    )
+    channel = models.CharField(
+        verbose_name="渠道", max_length=16, choices=CHANNEL_CHOICES
+    )
+    payload = JSONField(verbose_name="内容")
+    coalesce_key = models.CharField(
+        verbose_name="合并键", max_length=64, null=True, blank=True,
+        db_index=True
+    )
+    idempotency_key = models.CharField(
+        verbose_name="幂等键", max_length=64, unique=True
+    )
+    status = models.SmallIntegerField(
+        verbose_name="状态", choices=STATUS_CHOICES, default=STATUS_PENDING
+    )
+    attempts = models.PositiveSmallIntegerField(
+        verbose_name="尝试次数", default=0
+    )
+    next_attempt_at = models.DateTimeField(
+        verbose_name="下次发送时间", default=timezone.now
+    )
+    last_error = models.TextField(
+        verbose_name="错误信息", null=True, blank=True
+    )
+    created_at = models.DateTimeField(
+        verbose_name="创建时间", auto_now_add=True
+    )
+    sent_at = models.DateTimeField(
+        verbose_name="发送时间", null=True, blank=True
+    )
+
+    class Meta:
+        verbose_name_plural = verbose_name = "通知发件箱"
+        ordering = ("-created_at", )
+        index_together = (("status", "next_attempt_at"), )
+
+    def __str__(self):
+        return '%s-%s' % (self.get_channel_display(), self.pk)
@@ -0,0 +1,294 @@
+"""Enqueue notifications into the outbox and deliver them.
+
+Admin requests only write an outbox row, celery delivers it after the
+transaction commits (nm.tasks), so slow dingtalk or smtp servers no longer
+block the request. Failed deliveries are retried with exponential backoff.
+
+Group messages wait NOTIFICATION_COALESCE_WINDOW seconds in the outbox, the
+messages queued meanwhile for the same chat are sent as one combined message
+and a chat never gets more than NOTIFICATION_GROUP_RATE_LIMIT per minute.
+
+The emails enqueued in an email_batch() block are not scheduled one by one,
+the block schedules a single task delivering them over one connection.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from BMS.notice_backends import (
+    build_email_message, get_dingtalk_backend, send_email_message,
+    send_email_messages
+)
+from nm.models import NotificationOutbox
+
+logger = logging.getLogger(__name__)
+
+
+def use_outbox():
+    return getattr(settings, "NOTIFICATION_USE_OUTBOX", True)
+
+
+def get_max_attempts():
+    return getattr(settings, "NOTIFICATION_OUTBOX_MAX_ATTEMPTS", 5)
+
+
+def get_retry_delay(attempts):
+    """Seconds to wait before the next attempt: 30s, 60s, 120s ..."""
+    base = getattr(settings, "NOTIFICATION_OUTBOX_RETRY_BASE", 30)
+    return min(base * 2 ** max(attempts - 1, 0), 3600)
+
+
+def make_idempotency_key(channel, payload, dedup_key=None):
+    """The same notification enqueued twice with the same dedup_key, e.g.
+    "pm.subproject:12:start" for the event of an object, is only delivered
+    once. Without a dedup_key every notification is delivered, two equal
+    messages can be two real events."""
+    if dedup_key is None:
+        return uuid.uuid4().hex
+    raw = json.dumps([channel, payload, dedup_key], sort_keys=True,
+                     default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def get_coalesce_window():
+    return getattr(settings, "NOTIFICATION_COALESCE_WINDOW", 10)
+
+
+def get_coalesce_key(channel, payload):
+    if channel == "group_message" and get_coalesce_window():
+        return payload["chat_id"]
+    return None
+
+
+def enqueue(channel, payload, idempotency_key=None, dedup_key=None,
+            schedule=True):
+    """Save the notification and schedule its delivery on commit, unless
+    schedule is False: the caller schedules it, see schedule_emails()"""
+    key = idempotency_key or make_idempotency_key(channel, payload,
+                                                  dedup_key)
+    coalesce_key = get_coalesce_key(channel, payload)
+    countdown = get_coalesce_window() if coalesce_key else None
+    next_attempt_at = timezone.now()
+    if countdown:
+        next_attempt_at += datetime.timedelta(seconds=countdown)
+    try:
+        with transaction.atomic():
+            outbox = NotificationOutbox.objects.create(
+                channel=channel, payload=payload, idempotency_key=key,
+                coalesce_key=coalesce_key, next_attempt_at=next_attempt_at
+            )
+    except IntegrityError:
+        return NotificationOutbox.objects.get(idempotency_key=key)
+    if schedule:
+        transaction.on_commit(
+            lambda: schedule_delivery(outbox.pk, countdown))
+    return outbox
+
+
+def schedule_delivery(pk, countdown=None):
+    from nm.tasks import deliver_notification
+    try:
+        deliver_notification.apply_async((pk, ), countdown=countdown)
+    except Exception:
+        # The broker is unreachable, do not lose the notification
+        logger.exception("Could not schedule outbox %s, deliver it now", pk)
+        deliver(pk)
+
+
+def schedule_emails(pks):
+    """Schedule the delivery of the email rows together on commit"""
+    pks = list(pks)
+    if pks:
+        transaction.on_commit(lambda: schedule_email_delivery(pks))
+
+
+def schedule_email_delivery(pks):
+    from nm.tasks import deliver_notification_emails
+    try:
+        deliver_notification_emails.apply_async((pks, ))
+    except Exception:
+        logger.exception("Could not schedule outbox %s, deliver them now",
+                         pks)
+        deliver_emails(pks)
+
+
+def claim(pk):
+    """Mark the row as sending, return None if someone else got it first.
+    A claim expires, so rows of a crashed worker are picked up again."""
+    now = timezone.now()
+    lock_until = now + datetime.timedelta(
+        seconds=getattr(settings, "NOTIFICATION_OUTBOX_LOCK_TIMEOUT", 300)
+    )
+    claimed = NotificationOutbox.objects.filter(
+        pk=pk,
+        status__in=(NotificationOutbox.STATUS_PENDING,
+                    NotificationOutbox.STATUS_SENDING),
+        next_attempt_at__lte=now,
+    ).update(status=NotificationOutbox.STATUS_SENDING,
+             next_attempt_at=lock_until)
+    if not claimed:
+        return None
+    return NotificationOutbox.objects.get(pk=pk)
+
+
+def send_payload(channel, payload):
+    if channel == "email":
+        send_email_message(
+            payload["subject"], payload["content"], payload["sender"],
+            payload["recipient_list"], payload.get("html_message"),
+        )
+    elif channel == "work_notice":
+        get_dingtalk_backend().send_work_notice(
+            payload["content"], payload["sender"], payload["recipient_list"]
+        )
+    elif channel == "group_message":
+        get_dingtalk_backend().send_group_message(
+            payload["content"], payload["chat_id"]
+        )
+    else:
+        raise ValueError("Unknown notification channel %s" % channel)
+
+
+def claim_batch(outbox):
+    """Claim the other pending messages of the same chat, oldest first"""
+    limit = getattr(settings, "NOTIFICATION_COALESCE_MAX_MESSAGES", 20)
+    lock_until = outbox.next_attempt_at
+    with transaction.atomic():
+        others = list(NotificationOutbox.objects.select_for_update().filter(
+            channel=outbox.channel, coalesce_key=outbox.coalesce_key,
+            status=NotificationOutbox.STATUS_PENDING,
+        ).exclude(pk=outbox.pk).order_by("created_at")[:limit - 1])
+        NotificationOutbox.objects.filter(
+            pk__in=[o.pk for o in others]
+        ).update(status=NotificationOutbox.STATUS_SENDING,
+                 next_attempt_at=lock_until)
+    return sorted([outbox] + others, key=lambda o: o.created_at)
+
+
+def acquire_rate_limit(chat_id):
+    """Count the message against the chat's per-minute budget, return the
+    seconds to wait if the budget is spent."""
+    limit = getattr(settings, "NOTIFICATION_GROUP_RATE_LIMIT", 20)
+    now = time.time()
+    key = "nm:outbox:rate:%s:%d" % (chat_id, now // 60)
+    cache.add(key, 0, 120)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        count = 1
+    if count > limit:
+        return int(60 - now % 60) + 1
+    return None
+
+
+def record_coalesced(messages):
+    """Metrics: how many messages were sent and how many were saved"""
+    for key, value in (("nm:outbox:coalesce:messages", messages),
+                       ("nm:outbox:coalesce:sent", 1)):
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            cache.set(key, value, None)
+    if messages > 1:
+        logger.info("Coalesced %s group messages into one", messages)
+
+
+def get_coalesce_stats():
+    messages = cache.get("nm:outbox:coalesce:messages", 0)
+    sent = cache.get("nm:outbox:coalesce:sent", 0)
+    return {"messages": messages, "sent": sent, "saved": messages - sent}
+
+
+def finish(rows, error=None, delay=None):
+    """Save the result of an attempt for every row in rows"""
+    now = timezone.now()
+    retry_delay = None
+    for outbox in rows:
+        if delay is not None:
+            # Postponed by the rate limit, that is not a failed attempt
+            outbox.status = NotificationOutbox.STATUS_PENDING
+            outbox.next_attempt_at = now + datetime.timedelta(seconds=delay)
+            retry_delay = delay
+        elif error is not None:
+            outbox.attempts += 1
+            outbox.last_error = "%s: %s" % (error.__class__.__name__, error)
+            if outbox.attempts >= get_max_attempts():
+                outbox.status = NotificationOutbox.STATUS_FAILED
+            else:
+                retry_delay = get_retry_delay(outbox.attempts)
+                outbox.status = NotificationOutbox.STATUS_PENDING
+                outbox.next_attempt_at = (
+                    now + datetime.timedelta(seconds=retry_delay)
+                )
+            logger.warning("Outbox %s attempt %s failed: %s",
+                           outbox.pk, outbox.attempts, outbox.last_error)
+        else:
+            outbox.attempts += 1
+            outbox.status = NotificationOutbox.STATUS_SENT
+            outbox.sent_at = now
+            outbox.last_error = None
+        outbox.save(update_fields=[
+            "status", "attempts", "next_attempt_at", "last_error", "sent_at"
+        ])
+    return retry_delay
+
+
+def deliver(pk):
+    """Deliver one outbox row. Return the seconds to wait before retrying,
+    or None if there is nothing more to do."""
+    outbox = claim(pk)
+    if outbox is None:
+        return None
+    if not outbox.coalesce_key:
+        try:
+            send_payload(outbox.channel, outbox.payload)
+        except Exception as e:
+            return finish([outbox], error=e)
+        return finish([outbox])
+
+    rows = claim_batch(outbox)
+    delay = acquire_rate_limit(outbox.coalesce_key)
+    if delay is not None:
+        return finish(rows, delay=delay)
+    payload = dict(outbox.payload)
+    payload["content"] = "\n".join(o.payload["content"] for o in rows)
+    try:
+        send_payload(outbox.channel, payload)
+    except Exception as e:
+        return finish(rows, error=e)
+    record_coalesced(len(rows))
+    return finish(rows)
+
+
+def deliver_emails(pks):
+    """Deliver email rows together over the pooled connection"""
+    rows = [outbox for outbox in map(claim, pks) if outbox is not None]
+    messages = [
+        build_email_message(
+            o.payload["subject"], o.payload["content"], o.payload["sender"],
+            o.payload["recipient_list"], o.payload.get("html_message"),
+        )
+        for o in rows
+    ]
+    results = send_email_messages(messages)
+    for outbox, (message, error) in zip(rows, results):
+        finish([outbox], error=error)
+    return len(rows)
+
+
+def get_due(limit):
+    """(pk, channel) of the rows to deliver now"""
+    return list(NotificationOutbox.objects.filter(
+        status__in=(NotificationOutbox.STATUS_PENDING,
+                    NotificationOutbox.STATUS_SENDING),
+        next_attempt_at__lte=timezone.now(),
+    ).order_by("next_attempt_at").values_list("pk", "channel")[:limit])
@@ -0,0 +1,38 @@
+from __future__ import absolute_import
+from celery import shared_task
+from django.conf import settings
+
+from nm import outbox
+
+
+@shared_task(bind=True, ignore_result=True, max_retries=None)
+def deliver_notification(self, pk):
+    """Deliver one outbox row, retry with exponential backoff on failure"""
+    delay = outbox.deliver(pk)
+    if delay is not None:
+        raise self.retry(countdown=delay)
+
+
+@shared_task(ignore_result=True)
+def deliver_notification_emails(pks):
+    """Deliver the emails of an email_batch() block over one connection, the
+    failed ones are retried by deliver_pending_notifications"""
+    return outbox.deliver_emails(pks)
+
+
+@shared_task(ignore_result=True)
+def deliver_pending_notifications(batch_size=None):
+    """Periodic sweep delivering due rows in batches, it also picks up the
+    rows whose task got lost, e.g. when the broker or a worker was down."""
+    batch_size = batch_size or getattr(
+        settings, "NOTIFICATION_OUTBOX_BATCH_SIZE", 100
+    )
+    due = outbox.get_due(batch_size)
+    delivered = outbox.deliver_emails(
+        [pk for pk, channel in due if channel == "email"]
+    )
+    for pk, channel in due:
+        if channel != "email":
+            outbox.deliver(pk)
+            delivered += 1
+    return delivered
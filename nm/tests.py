@@ -0,0 +1,265 @@
+import datetime
+from unittest import mock
+
+from django.core import mail
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from BMS.celery_queues import get_config
+from BMS.notice_backends import LocmemDingtalkBackend
+from BMS.notice_mixin import NotificationMixin, batch_emails
+from nm import outbox
+from nm.models import NotificationOutbox
+from nm.tasks import (
+    deliver_notification, deliver_notification_emails,
+    deliver_pending_notifications
+)
+
+
+@override_settings(
+    NOTIFICATION_USE_OUTBOX=True,
+    NOTIFICATION_COALESCE_WINDOW=0,
+    NOTIFICATION_OUTBOX_MAX_ATTEMPTS=3,
+    NOTIFICATION_OUTBOX_RETRY_BASE=30,
+    DINGTALK_BACKEND="BMS.notice_backends.LocmemDingtalkBackend",
+    EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+)
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        del LocmemDingtalkBackend.outbox[:]
+        self.original_schedule_delivery = outbox.schedule_delivery
+        # on_commit never runs inside TestCase, the tests deliver themselves
+        patcher = mock.patch("nm.outbox.schedule_delivery")
+        self.schedule_delivery = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def enqueue_group_message(self, content="hello", chat_id="chat1",
+                              **kwargs):
+        return outbox.enqueue(
+            "group_message", {"content": content, "chat_id": chat_id},
+            **kwargs)
+
+    def make_due(self, row):
+        NotificationOutbox.objects.filter(pk=row.pk).update(
+            next_attempt_at=timezone.now() - datetime.timedelta(seconds=1))
+
+    def reload(self, row):
+        return NotificationOutbox.objects.get(pk=row.pk)
+
+    def test_enqueue_claim_deliver(self):
+        row = self.enqueue_group_message()
+        self.assertEqual(row.status, NotificationOutbox.STATUS_PENDING)
+
+        claimed = outbox.claim(row.pk)
+        self.assertEqual(claimed.status, NotificationOutbox.STATUS_SENDING)
+        # Claimed rows are not handed out twice
+        self.assertIsNone(outbox.claim(row.pk))
+        self.make_due(row)
+
+        self.assertIsNone(outbox.deliver(row.pk))
+        row = self.reload(row)
+        self.assertEqual(row.status, NotificationOutbox.STATUS_SENT)
+        self.assertEqual(row.attempts, 1)
+        self.assertIsNotNone(row.sent_at)
+        self.assertEqual(LocmemDingtalkBackend.outbox, [{
+            "type": "group_message", "content": "hello", "chat_id": "chat1",
+        }])
+        # Nothing is sent again
+        self.assertIsNone(outbox.deliver(row.pk))
+        self.assertEqual(len(LocmemDingtalkBackend.outbox), 1)
+
+    def test_failure_and_retry(self):
+        row = self.enqueue_group_message()
+        with mock.patch.object(LocmemDingtalkBackend, "send_group_message",
+                               side_effect=RuntimeError("down")):
+            self.assertEqual(outbox.deliver(row.pk), 30)
+        row = self.reload(row)
+        self.assertEqual(row.status, NotificationOutbox.STATUS_PENDING)
+        self.assertEqual(row.attempts, 1)
+        self.assertEqual(row.last_error, "RuntimeError: down")
+        self.assertGreater(row.next_attempt_at, timezone.now())
+        # Not due before the backoff
+        self.assertIsNone(outbox.deliver(row.pk))
+        self.assertEqual(LocmemDingtalkBackend.outbox, [])
+
+        self.make_due(row)
+        self.assertIsNone(outbox.deliver(row.pk))
+        row = self.reload(row)
+        self.assertEqual(row.status, NotificationOutbox.STATUS_SENT)
+        self.assertEqual(row.attempts, 2)
+        self.assertIsNone(row.last_error)
+        self.assertEqual(len(LocmemDingtalkBackend.outbox), 1)
+
+    def test_gives_up_after_max_attempts(self):
+        row = self.enqueue_group_message()
+        delays = []
+        with mock.patch.object(LocmemDingtalkBackend, "send_group_message",
+                               side_effect=RuntimeError("down")):
+            for _ in range(3):
+                self.make_due(row)
+                delays.append(outbox.deliver(row.pk))
+        self.assertEqual(delays, [30, 60, None])
+        row = self.reload(row)
+        self.assertEqual(row.status, NotificationOutbox.STATUS_FAILED)
+        self.assertEqual(row.attempts, 3)
+
+    def test_equal_messages_are_all_delivered(self):
+        first = self.enqueue_group_message()
+        second = self.enqueue_group_message()
+        self.assertNotEqual(first.pk, second.pk)
+
+    def test_dedup_key(self):
+        first = self.enqueue_group_message(dedup_key="pm.subproject:1:start")
+        again = self.enqueue_group_message(dedup_key="pm.subproject:1:start")
+        other = self.enqueue_group_message(dedup_key="pm.subproject:2:start")
+        self.assertEqual(first.pk, again.pk)
+        self.assertNotEqual(first.pk, other.pk)
+        self.assertEqual(NotificationOutbox.objects.count(), 2)
+
+    def test_mixin_dedup_key(self):
+        admin = NotificationMixin()
+        for _ in range(2):
+            admin.send_group_message("hello", "chat1", dedup_key="event")
+            self.assertTrue(admin.send_dingtalk_result)
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+    def test_emails(self):
+        admin = NotificationMixin()
+        self.assertTrue(admin.send_email("content", "bms@example.com",
+                                         ["a@example.com"], subject="s"))
+        self.assertTrue(admin.send_email("content", "bms@example.com",
+                                         ["b@example.com"], subject="s"))
+        self.assertEqual(mail.outbox, [])
+
+        self.assertEqual(deliver_pending_notifications(), 2)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ["a@example.com", "b@example.com"])
+        self.assertEqual(NotificationOutbox.objects.filter(
+            status=NotificationOutbox.STATUS_SENT).count(), 2)
+
+    def send_batch(self):
+        """Two emails sent by an action decorated with batch_emails, the
+        on_commit callbacks run at once"""
+        class Admin(NotificationMixin):
+            @batch_emails
+            def action(self, request, queryset):
+                for to in queryset:
+                    self.send_email("content", "bms@example.com", [to],
+                                    subject="s")
+
+        with mock.patch("nm.outbox.transaction.on_commit",
+                        side_effect=lambda func: func()):
+            Admin().action(None, ["a@example.com", "b@example.com"])
+        self.schedule_delivery.assert_not_called()
+        return list(NotificationOutbox.objects.order_by("pk").values_list(
+            "pk", flat=True))
+
+    def test_email_batch(self):
+        with mock.patch.object(deliver_notification_emails,
+                               "apply_async") as apply_async:
+            pks = self.send_batch()
+        self.assertEqual(len(pks), 2)
+        apply_async.assert_called_once_with((pks, ))
+        self.assertEqual(mail.outbox, [])
+
+        self.assertEqual(deliver_notification_emails(pks), 2)
+        self.assertEqual([m.to for m in mail.outbox],
+                         [["a@example.com"], ["b@example.com"]])
+        self.assertEqual(NotificationOutbox.objects.filter(
+            status=NotificationOutbox.STATUS_SENT).count(), 2)
+
+    def test_email_batch_broker_failure(self):
+        with mock.patch.object(deliver_notification_emails, "apply_async",
+                               side_effect=OSError("broker down")):
+            with self.assertLogs("nm.outbox", "ERROR"):
+                self.send_batch()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(NotificationOutbox.objects.filter(
+            status=NotificationOutbox.STATUS_SENT).count(), 2)
+
+    def test_email_failure(self):
+        row = outbox.enqueue("email", {
+            "subject": "s", "content": "c", "sender": "bms@example.com",
+            "recipient_list": ["a@example.com"],
+        })
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend."
+                        "send_messages", side_effect=OSError("refused")):
+            self.assertEqual(outbox.deliver_emails([row.pk]), 1)
+        row = self.reload(row)
+        self.assertEqual(row.status, NotificationOutbox.STATUS_PENDING)
+        self.assertEqual(row.last_error, "OSError: refused")
+
+    @override_settings(NOTIFICATION_COALESCE_WINDOW=10)
+    def test_coalesce_group_messages(self):
+        rows = [self.enqueue_group_message(content)
+                for content in ("one", "two")]
+        rows.append(self.enqueue_group_message("other", chat_id="chat2"))
+        for row in rows:
+            self.make_due(row)
+
+        outbox.deliver(rows[0].pk)
+        self.assertEqual(LocmemDingtalkBackend.outbox, [{
+            "type": "group_message", "content": "one\ntwo",
+            "chat_id": "chat1",
+        }])
+        self.assertEqual(
+            [self.reload(row).status for row in rows],
+            [NotificationOutbox.STATUS_SENT, NotificationOutbox.STATUS_SENT,
+             NotificationOutbox.STATUS_PENDING])
+
+    @override_settings(NOTIFICATION_COALESCE_WINDOW=10,
+                       NOTIFICATION_GROUP_RATE_LIMIT=1)
+    def test_rate_limit_postpones(self):
+        first = self.enqueue_group_message("one")
+        self.make_due(first)
+        self.assertIsNone(outbox.deliver(first.pk))
+        second = self.enqueue_group_message("two")
+        self.make_due(second)
+        self.assertIsNotNone(outbox.deliver(second.pk))
+        second = self.reload(second)
+        self.assertEqual(second.status, NotificationOutbox.STATUS_PENDING)
+        # Postponing is not a failed attempt
+        self.assertEqual(second.attempts, 0)
+
+    def test_sweep_is_scheduled(self):
+        schedule = get_config()["CELERYBEAT_SCHEDULE"]
+        entries = [entry for entry in schedule.values()
+                   if entry["task"] == deliver_pending_notifications.name]
+        self.assertEqual(len(entries), 1)
+        self.assertLessEqual(entries[0]["schedule"],
+                             datetime.timedelta(minutes=1))
+
+    def test_sweep_recovers_stranded_sending(self):
+        row = self.enqueue_group_message()
+        # The worker claimed the row and died before sending it
+        outbox.claim(row.pk)
+        self.assertEqual(deliver_pending_notifications(), 0)
+        self.assertEqual(self.reload(row).status,
+                         NotificationOutbox.STATUS_SENDING)
+
+        # The claim expired
+        self.make_due(row)
+        self.assertEqual(deliver_pending_notifications(), 1)
+        row = self.reload(row)
+        self.assertEqual(row.status, NotificationOutbox.STATUS_SENT)
+        self.assertEqual(len(LocmemDingtalkBackend.outbox), 1)
+
+    @override_settings(NOTIFICATION_COALESCE_WINDOW=10)
+    def test_sweep_delivers_after_broker_failure(self):
+        row = self.enqueue_group_message()
+        with mock.patch.object(deliver_notification, "apply_async",
+                               side_effect=OSError("broker down")):
+            with self.assertLogs("nm.outbox", "ERROR"):
+                self.original_schedule_delivery(row.pk, 10)
+        # The synchronous fallback is too early for a coalesced message
+        self.assertEqual(self.reload(row).status,
+                         NotificationOutbox.STATUS_PENDING)
+        self.assertEqual(LocmemDingtalkBackend.outbox, [])
+
+        self.make_due(row)
+        self.assertEqual(deliver_pending_notifications(), 1)
+        self.assertEqual(self.reload(row).status,
+                         NotificationOutbox.STATUS_SENT)
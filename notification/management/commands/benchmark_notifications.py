@@ -0,0 +1,101 @@
+import datetime
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from BMS.instrumentation import percentile
+from notification.models import Notification
+from notification.utils import invalidate_unread
+
+BENCHMARK_VERB = '__benchmark__'
+BENCHMARK_USERNAME = '__benchmark_notifications_%s'
+
+
+class Command(BaseCommand):
+    help = ("Measure the unread-list latency on a table filled up to --rows "
+            "notifications. The rows go to --users inactive benchmark users, "
+            "the generated rows (verb %r) and users are removed afterwards "
+            "unless --keep." % BENCHMARK_VERB)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--users', type=int, default=50,
+                            help="Spread the rows over N benchmark users")
+        parser.add_argument('--unread-ratio', type=float, default=0.05)
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--fetch', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--keep', action='store_true',
+                            help="Keep the generated rows and users")
+
+    def handle(self, *args, **options):
+        users = self.get_users(max(options['users'], 1))
+        self.fill(users, options)
+        try:
+            self.measure(users, options)
+        finally:
+            if not options['keep']:
+                self.clean(users, options)
+
+    def get_users(self, count):
+        """Users of their own, nobody real gets the notifications"""
+        users = []
+        for i in range(count):
+            user, created = get_user_model().objects.get_or_create(
+                username=BENCHMARK_USERNAME % i, defaults={'is_active': False})
+            if created:
+                user.set_unusable_password()
+                user.save(update_fields=['password'])
+            users.append(user)
+        return users
+
+    def clean(self, users, options):
+        deleted = Notification.objects.filter(
+            verb=BENCHMARK_VERB).delete_in_batches(options['batch_size'])
+        self.stdout.write("Removed %s benchmark rows" % deleted)
+        get_user_model().objects.filter(
+            pk__in=[user.pk for user in users]).delete()
+
+    def fill(self, users, options):
+        missing = options['rows'] - Notification.objects.count()
+        if missing <= 0:
+            return
+        self.stdout.write("Inserting %s notifications ..." % missing)
+        content_type = ContentType.objects.get_for_model(users[0])
+        now = timezone.now()
+        batch = []
+        for i in range(missing):
+            batch.append(Notification(
+                recipient=random.choice(users),
+                actor_content_type=content_type,
+                actor_object_id=users[0].pk,
+                verb=BENCHMARK_VERB,
+                unread=random.random() < options['unread_ratio'],
+                timestamp=now - datetime.timedelta(minutes=i),
+            ))
+            if len(batch) >= options['batch_size']:
+                Notification.objects.bulk_create(batch)
+                batch = []
+        Notification.objects.bulk_create(batch)
+        # bulk_create sends no post_save
+        invalidate_unread(user.pk for user in users)
+
+    def measure(self, users, options):
+        timings = []
+        for _ in range(options['iterations']):
+            user = random.choice(users)
+            start = time.time()
+            list(user.notifications.unread()[:options['fetch']])
+            user.notifications.unread().count()
+            timings.append((time.time() - start) * 1000)
+        self.stdout.write(
+            "unread list+count over %s rows: p50 %.2f ms, p95 %.2f ms, "
+            "max %.2f ms" % (Notification.objects.count(),
+                             percentile(timings, 50), percentile(timings, 95),
+                             max(timings)))
+        self.stdout.write(
+            users[0].notifications.unread()[:options['fetch']].explain())
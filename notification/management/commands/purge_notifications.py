@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from notification.models import Notification
+from notification.tasks import get_retention_cutoff, purge_old_notifications
+
+
+class Command(BaseCommand):
+    help = "Purge the read notifications older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Default: NOTIFICATIONS_RETENTION_DAYS (90)")
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--max-batches', type=int, default=None)
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only count the notifications to purge")
+
+    def handle(self, *args, **options):
+        cutoff = get_retention_cutoff(options['days'])
+        if options['dry_run']:
+            count = Notification.objects.purgeable(cutoff).count()
+            self.stdout.write("%s notifications before %s would be purged"
+                              % (count, cutoff))
+            return
+        deleted = purge_old_notifications(
+            options['days'], options['batch_size'], options['max_batches'])
+        self.stdout.write(self.style.SUCCESS(
+            "Purged %s notifications before %s" % (deleted, cutoff)))
@@ -13,7 +13,7 @@ else:
 from django.db import models
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.six import text_type
-from .utils import id2slug
+from .utils import id2slug, invalidate_unread
 
 from .signals import notify
 
@@ -40,6 +40,18 @@ def assert_soft_delete():
 
 class NotificationQuerySet(models.query.QuerySet):
 
+    def _update_and_invalidate(self, recipient=None, **kwargs):
+        """Bulk update that also drops the cached unread counters"""
+        if recipient:
+            recipient_ids = [recipient.pk]
+        else:
+            recipient_ids = list(
+                self.values_list('recipient_id', flat=True).distinct())
+        updated = self.update(**kwargs)
+        if updated:
+            invalidate_unread(recipient_ids)
+        return updated
+
     def unread(self, include_deleted=False):
         """Return only unread items in the current queryset"""
         if is_soft_delete() and not include_deleted:
@@ -71,7 +83,7 @@ class NotificationQuerySet(models.query.QuerySet):
         if recipient:
             qs = qs.filter(recipient=recipient)
 
-        return qs.update(unread=False)
+        return qs._update_and_invalidate(recipient, unread=False)
 
     def mark_all_as_unread(self, recipient=None):
         """Mark as unread any read messages in the current queryset.
@@ -83,7 +95,35 @@ class NotificationQuerySet(models.query.QuerySet):
         if recipient:
             qs = qs.filter(recipient=recipient)
 
-        return qs.update(unread=True)
+        return qs._update_and_invalidate(recipient, unread=True)
+
+    def purgeable(self, before):
+        """The read (and soft deleted) notifications older than ``before``"""
+        qs = self.filter(timestamp__lt=before)
+        if is_soft_delete():
+            return qs.filter(models.Q(unread=False) | models.Q(deleted=True))
+        return qs.filter(unread=False)
+
+    def delete_in_batches(self, batch_size=1000, max_batches=None):
+        """Delete the current queryset in chunks of batch_size rows, so that
+        the table is never locked for long. The post_delete signal drops the
+        unread counters. Return the number of deleted rows."""
+        deleted = batches = 0
+        while max_batches is None or batches < max_batches:
+            pks = list(self.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            count, _ = self.model.objects.using(self.db).filter(
+                pk__in=pks).delete()
+            deleted += count
+            batches += 1
+        return deleted
+
+    def purge(self, before, batch_size=1000, max_batches=None):
+        """Delete the purgeable notifications older than ``before`` in
+        batches. Return the number of deleted rows."""
+        return self.purgeable(before).delete_in_batches(batch_size,
+                                                        max_batches)
 
     def deleted(self):
         """Return only deleted items in the current queryset"""
@@ -104,7 +144,7 @@ class NotificationQuerySet(models.query.QuerySet):
         if recipient:
             qs = qs.filter(recipient=recipient)
 
-        return qs.update(deleted=True)
+        return qs._update_and_invalidate(recipient, deleted=True)
 
     def mark_all_as_active(self, recipient=None):
         """Mark current queryset as active(un-deleted).
@@ -115,7 +155,7 @@ class NotificationQuerySet(models.query.QuerySet):
         if recipient:
             qs = qs.filter(recipient=recipient)
 
-        return qs.update(deleted=False)
+        return qs._update_and_invalidate(recipient, deleted=False)
 
 
 class Notification(models.Model):
@@ -182,6 +222,16 @@ class Notification(models.Model):
         ordering = ('-timestamp', )
         verbose_name = '通知管理'
         verbose_name_plural = '通知管理'
+        # Match NotificationQuerySet.unread()/read() with and without
+        # soft delete, and the retention purge of old read notifications
+        indexes = [
+            models.Index(fields=['recipient', 'unread', '-timestamp'],
+                         name='notify_recipient_unread_idx'),
+            models.Index(fields=['recipient', 'unread', 'deleted', '-timestamp'],
+                         name='notify_recip_unread_del_idx'),
+            models.Index(fields=['unread', 'timestamp'],
+                         name='notify_unread_timestamp_idx'),
+        ]
 
     def __unicode__(self):
         ctx = {
@@ -252,33 +302,51 @@ def notify_handler(verb, **kwargs):
     # Check if User or Group
     if isinstance(recipient, Group):
         recipients = recipient.user_set.all()
+    elif isinstance(recipient, (models.QuerySet, list, tuple, set)):
+        recipients = recipient
     else:
         recipients = [recipient]
 
-    for recipient in recipients:
-        newnotify = Notification(
+    # Resolve the content types once for all the recipients
+    actor_content_type = ContentType.objects.get_for_model(actor)
+    optional_fields = {}
+    for obj, opt in optional_objs:
+        if obj is not None:
+            optional_fields['%s_object_id' % opt] = obj.pk
+            optional_fields['%s_content_type' % opt] = \
+                ContentType.objects.get_for_model(obj)
+    data = kwargs if len(kwargs) and EXTRA_DATA else None
+
+    new_notifications = [
+        Notification(
             recipient=recipient,
-            actor_content_type=ContentType.objects.get_for_model(actor),
+            actor_content_type=actor_content_type,
             actor_object_id=actor.pk,
             verb=text_type(verb),
             public=public,
             description=description,
             timestamp=timestamp,
             level=level,
+            data=data,
+            **optional_fields
         )
+        for recipient in recipients
+    ]
+    batch_size = getattr(settings, 'NOTIFICATIONS_BULK_BATCH_SIZE', 500)
+    Notification.objects.bulk_create(new_notifications, batch_size=batch_size)
+    invalidate_unread(n.recipient_id for n in new_notifications)
+    return len(new_notifications)
 
-        # Set optional objects
-        for obj, opt in optional_objs:
-            if obj is not None:
-                setattr(newnotify, '%s_object_id' % opt, obj.pk)
-                setattr(newnotify, '%s_content_type' % opt,
-                        ContentType.objects.get_for_model(obj))
-
-        if len(kwargs) and EXTRA_DATA:
-            newnotify.data = kwargs
 
-        newnotify.save()
+def invalidate_unread_handler(sender, instance, **kwargs):
+    invalidate_unread([instance.recipient_id])
 
 
 # connect the signal
 notify.connect(notify_handler, dispatch_uid='notifications.models.notification')
+models.signals.post_save.connect(
+    invalidate_unread_handler, sender=Notification,
+    dispatch_uid='notifications.models.invalidate_unread_save')
+models.signals.post_delete.connect(
+    invalidate_unread_handler, sender=Notification,
+    dispatch_uid='notifications.models.invalidate_unread_delete')
@@ -0,0 +1,24 @@
+from __future__ import absolute_import
+import datetime
+
+from celery import shared_task
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Notification
+
+
+def get_retention_cutoff(days=None):
+    days = days or getattr(settings, 'NOTIFICATIONS_RETENTION_DAYS', 90)
+    return timezone.now() - datetime.timedelta(days=days)
+
+
+@shared_task(ignore_result=True)
+def purge_old_notifications(days=None, batch_size=None, max_batches=None):
+    """Retention policy: purge read notifications older than
+    NOTIFICATIONS_RETENTION_DAYS, schedule it daily in the celery beat."""
+    batch_size = batch_size or getattr(
+        settings, 'NOTIFICATIONS_PURGE_BATCH_SIZE', 1000)
+    return Notification.objects.purge(
+        get_retention_cutoff(days), batch_size=batch_size,
+        max_batches=max_batches)
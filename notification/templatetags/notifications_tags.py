@@ -3,6 +3,8 @@ from django.urls import reverse
 from django.template import Library
 from django.utils.html import format_html
 
+from notification.utils import get_unread_count
+
 register = Library()
 
 
@@ -11,7 +13,7 @@ def notifications_unread(context):
     user = user_context(context)
     if not user:
         return ''
-    return user.notifications.unread().count()
+    return get_unread_count(user)
 
 
 # Requires vanilla-js framework - http://vanilla-js.com/
@@ -62,7 +64,7 @@ def live_notify_badge(context, badge_id='live_notify_badge', classes=""):
         return ''
 
     html = "<span id='{badge_id}' class='{classes}'>{unread}</span>".format(
-        badge_id=badge_id, classes=classes, unread=user.notifications.unread().count()
+        badge_id=badge_id, classes=classes, unread=get_unread_count(user)
     )
     return format_html(html)
 
@@ -79,6 +81,6 @@ def user_context(context):
 
     request = context['request']
     user = request.user
-    if user.is_anonymous():
+    if user.is_anonymous:
         return None
     return user
@@ -1,3 +1,220 @@
-from django.test import TestCase
+import datetime
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from notification import models
+from notification.models import Notification
+from notification.signals import notify
+from notification.utils import get_unread_count, unread_count_key
+
+
+@override_settings(NOTIFICATIONS_SOFT_DELETE=True)
+class PurgeTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="purge")
+        self.old = timezone.now() - datetime.timedelta(days=100)
+        content_type = ContentType.objects.get_for_model(User)
+        for unread, deleted in ((True, False), (False, False), (True, True)):
+            Notification.objects.create(
+                recipient=self.user, actor_content_type=content_type,
+                actor_object_id=self.user.pk, verb="test", unread=unread,
+                deleted=deleted, timestamp=self.old)
+
+    def test_dry_run_counts_what_purge_deletes(self):
+        out = StringIO()
+        call_command("purge_notifications", "--days=90", "--dry-run",
+                     stdout=out)
+        self.assertTrue(out.getvalue().startswith("2 "))
+        cutoff = self.old + datetime.timedelta(days=1)
+        self.assertEqual(Notification.objects.purge(cutoff, batch_size=1), 2)
+        self.assertEqual(Notification.objects.count(), 1)
+
+    def test_purge_drops_the_unread_count(self):
+        get_unread_count(self.user)
+        self.assertIsNotNone(cache.get(unread_count_key(self.user.pk)))
+        Notification.objects.purge(self.old + datetime.timedelta(days=1))
+        self.assertIsNone(cache.get(unread_count_key(self.user.pk)))
+
+    def test_max_batches(self):
+        cutoff = self.old + datetime.timedelta(days=1)
+        self.assertEqual(
+            Notification.objects.purge(cutoff, batch_size=1, max_batches=1),
+            1)
+
+
+def notify_per_recipient(verb, **kwargs):
+    """notify_handler before the bulk insert, one save() per recipient"""
+    kwargs.pop('signal', None)
+    recipient = kwargs.pop('recipient')
+    actor = kwargs.pop('sender')
+    optional_objs = [
+        (kwargs.pop(opt, None), opt)
+        for opt in ('target', 'action_object')
+    ]
+    public = bool(kwargs.pop('public', True))
+    description = kwargs.pop('description', None)
+    timestamp = kwargs.pop('timestamp', timezone.now())
+    level = kwargs.pop('level', Notification.LEVELS.info)
+
+    if isinstance(recipient, Group):
+        recipients = recipient.user_set.all()
+    else:
+        recipients = [recipient]
+
+    count = 0
+    for recipient in recipients:
+        newnotify = Notification(
+            recipient=recipient,
+            actor_content_type=ContentType.objects.get_for_model(actor),
+            actor_object_id=actor.pk,
+            verb=str(verb),
+            public=public,
+            description=description,
+            timestamp=timestamp,
+            level=level,
+        )
+        for obj, opt in optional_objs:
+            if obj is not None:
+                setattr(newnotify, '%s_object_id' % opt, obj.pk)
+                setattr(newnotify, '%s_content_type' % opt,
+                        ContentType.objects.get_for_model(obj))
+        if len(kwargs) and models.EXTRA_DATA:
+            newnotify.data = kwargs
+        newnotify.save()
+        count += 1
+    return count
+
+
+@override_settings(NOTIFICATIONS_BULK_BATCH_SIZE=2)
+@mock.patch("notification.models.EXTRA_DATA", True)
+class NotifyHandlerTest(TestCase):
+    """The bulk notify_handler creates what a save() per recipient did"""
+
+    def setUp(self):
+        self.actor = User.objects.create(username="actor")
+        self.group = Group.objects.create(name="readers")
+        for i in range(5):
+            User.objects.create(username="reader%s" % i).groups.add(
+                self.group)
+        self.timestamp = timezone.now()
+
+    def rows(self):
+        return sorted(Notification.objects.values_list(
+            "recipient_id", "actor_content_type", "actor_object_id", "verb",
+            "public", "description", "timestamp", "level", "unread",
+            "target_content_type", "target_object_id",
+            "action_object_content_type", "action_object_object_id", "data",
+        ))
+
+    def compare(self, recipient, **kwargs):
+        kwargs.update(sender=self.actor, recipient=recipient,
+                      timestamp=self.timestamp)
+        expected_count = notify_per_recipient(**kwargs)
+        expected = self.rows()
+        Notification.objects.all().delete()
+        [(receiver, count)] = notify.send(**kwargs)
+        self.assertIs(receiver, models.notify_handler)
+        self.assertEqual(count, expected_count)
+        self.assertEqual(self.rows(), expected)
+        return count
+
+    def test_group(self):
+        self.assertEqual(self.compare(
+            self.group, verb="approved", description="d", level="warning",
+            target=self.group, action_object=self.actor, public=False,
+            extra="value"), 5)
+
+    def test_user(self):
+        self.assertEqual(self.compare(self.actor, verb="approved"), 1)
+
+    def test_empty_group(self):
+        self.assertEqual(
+            self.compare(Group.objects.create(name="empty"), verb="x"), 0)
+
+
+class UnreadCacheTest(TestCase):
+    """The ETag and the cached unread count follow the notifications"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="reader")
+        self.client.force_login(self.user)
+
+    def send(self):
+        notify.send(self.user, recipient=self.user, verb="test")
+        return self.user.notifications.latest("id")
+
+    def get(self, name="live_unread_notification_count", etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get(reverse("notifications:%s" % name), **headers)
+
+    def assertChanged(self, etag, unread_count,
+                      name="live_unread_notification_count"):
+        self.assertEqual(self.get(name, etag).status_code, 200)
+        response = self.get(name)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()["unread_count"], unread_count)
+        return response["ETag"]
+
+    def test_etag(self):
+        for name in ("live_unread_notification_count",
+                     "live_unread_notification_list"):
+            response = self.get(name)
+            etag = response["ETag"]
+            self.assertEqual(response.json()["unread_count"], 0)
+            self.assertEqual(self.get(name, etag).status_code, 304)
+            notification = self.send()
+            etag = self.assertChanged(etag, 1, name)
+            self.assertEqual(self.get(name, etag).status_code, 304)
+            notification.mark_as_read()
+            etag = self.assertChanged(etag, 0, name)
+            notification.mark_as_unread()
+            etag = self.assertChanged(etag, 1, name)
+            notification.delete()
+            self.assertChanged(etag, 0, name)
+
+    @override_settings(NOTIFICATIONS_SOFT_DELETE=True)
+    def test_soft_delete_view(self):
+        notification = self.send()
+        etag = self.get()["ETag"]
+        self.client.get(reverse("notifications:delete",
+                                args=[notification.slug]))
+        self.assertChanged(etag, 0)
+
+    def assertInvalidated(self, change):
+        key = unread_count_key(self.user.pk)
+        get_unread_count(self.user)
+        self.assertIsNotNone(cache.get(key))
+        change()
+        self.assertIsNone(cache.get(key))
+
+    def test_post_save(self):
+        self.assertInvalidated(self.send)
+        notification = self.user.notifications.get()
+        self.assertInvalidated(notification.mark_as_read)
+
+    def test_post_delete(self):
+        notification = self.send()
+        self.assertInvalidated(notification.delete)
+
+    def test_update_and_invalidate(self):
+        self.send()
+        self.send()
+        self.assertInvalidated(self.user.notifications.mark_all_as_read)
+        self.assertEqual(get_unread_count(self.user), 0)
+        self.assertInvalidated(
+            lambda: Notification.objects.mark_all_as_unread(self.user))
+        self.assertEqual(get_unread_count(self.user), 2)
+        # Nothing updated, the count stays cached
+        Notification.objects.mark_all_as_unread(self.user)
+        self.assertEqual(cache.get(unread_count_key(self.user.pk)), 2)
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from BMS.metrics import record_cache
+
 if sys.version > '3':
     long = int
 
@@ -11,3 +18,46 @@ def slug2id(slug):
 
 def id2slug(id):
     return id + 110909
+
+
+# Per-user unread counter and version kept in the cache, the counter is
+# dropped and the version changes every time the user's notifications do.
+def unread_count_key(user_id):
+    return 'notifications:unread_count:%s' % user_id
+
+
+def version_key(user_id):
+    return 'notifications:version:%s' % user_id
+
+
+def get_unread_count(user):
+    key = unread_count_key(user.pk)
+    count = cache.get(key)
+    record_cache('unread_count', count is not None)
+    if count is None:
+        count = user.notifications.unread().count()
+        timeout = getattr(settings, 'NOTIFICATIONS_UNREAD_CACHE_TIMEOUT', 3600)
+        cache.set(key, count, timeout)
+    return count
+
+
+def get_unread_version(user_id):
+    key = version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        # Keep the version of another process if it got there first
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def invalidate_unread(user_ids):
+    """Call it whenever the notifications of these users change"""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    cache.delete_many([unread_count_key(i) for i in user_ids])
+    cache.set_many(
+        dict((version_key(i), uuid.uuid4().hex) for i in user_ids), None
+    )
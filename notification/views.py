@@ -1,3 +1,5 @@
+from functools import wraps
+
 from django import get_version
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
@@ -7,8 +9,10 @@ from django.utils.decorators import method_decorator
 from django.views.generic import ListView
 from django.contrib.sites.shortcuts import get_current_site
 from django.utils.functional import SimpleLazyObject
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import etag
 
-from .utils import slug2id
+from .utils import get_unread_count, get_unread_version, slug2id
 from .models import Notification
 
 from distutils.version import StrictVersion
@@ -139,35 +143,68 @@ def delete(request, slug=None):
     return redirect('notifications:all')
 
 
+def _get_num_to_fetch(request):
+    try:
+        num_to_fetch = request.GET.get('max', 5)  # If they don't specify, make it 5.
+        num_to_fetch = int(num_to_fetch)
+        num_to_fetch = max(1, num_to_fetch)  # if num_to_fetch is negative, force at least one fetched notifications
+        num_to_fetch = min(num_to_fetch, 100)  # put a sane ceiling on the number retrievable
+    except ValueError:
+        num_to_fetch = 5  # If casting to an int fails, just make it 5.
+    return num_to_fetch
+
+
+def _count_etag(request):
+    if not request.user.is_authenticated:
+        return None
+    return get_unread_version(request.user.pk)
+
+
+def _list_etag(request):
+    if not request.user.is_authenticated:
+        return None
+    return '%s-%s' % (get_unread_version(request.user.pk), _get_num_to_fetch(request))
+
+
+def _revalidate(view):
+    """Let the browser cache the response but always revalidate it, so the
+    periodic polling gets a cheap 304 while nothing changed."""
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    return wraps(view)(wrapper)
+
+
+@_revalidate
+@etag(_count_etag)
 def live_unread_notification_count(request):
-    if not request.user.is_authenticated():
+    if not request.user.is_authenticated:
         data = {'unread_count':0}
     else:
         data = {
-            'unread_count': request.user.notifications.unread().count(),
+            'unread_count': get_unread_count(request.user),
         }
     return JsonResponse(data)
 
 
+@_revalidate
+@etag(_list_etag)
 def live_unread_notification_list(request):
-    if not request.user.is_authenticated():
+    if not request.user.is_authenticated:
         data = {
            'unread_count':0,
            'unread_list':[]
         }
         return JsonResponse(data)
 
-    try:
-        num_to_fetch = request.GET.get('max', 5)  # If they don't specify, make it 5.
-        num_to_fetch = int(num_to_fetch)
-        num_to_fetch = max(1, num_to_fetch)  # if num_to_fetch is negative, force at least one fetched notifications
-        num_to_fetch = min(num_to_fetch, 100)  # put a sane ceiling on the number retrievable
-    except ValueError:
-        num_to_fetch = 5  # If casting to an int fails, just make it 5.
+    num_to_fetch = _get_num_to_fetch(request)
 
     unread_list = []
 
-    for n in request.user.notifications.unread()[0:num_to_fetch]:
+    notifications = request.user.notifications.unread().prefetch_related(
+        'actor', 'target', 'action_object')
+    for n in notifications[0:num_to_fetch]:
         struct = model_to_dict(n)
         if n.actor:
             struct['actor'] = str(n.actor)
@@ -177,8 +214,7 @@ def live_unread_notification_list(request):
             struct['action_object'] = str(n.action_object)
         unread_list.append(struct)
     data = {
-        'unread_count': request.user.notifications.unread().count(),
+        'unread_count': get_unread_count(request.user),
         'unread_list': unread_list
     }
     return JsonResponse(data)
-
@@ -1,6 +1,8 @@
 from BMS import settings
+from BMS import roles
 from BMS.admin_bms import BMS_admin_site
-from nm.models import DingtalkChat
+from BMS.roles import get_roles
+from nm.chats import get_chat_id
 from .models import SubProject, ExtSubmit, LibSubmit, SeqSubmit,AnaSubmit
 from django.contrib import admin
 from sample.models import SampleInfoForm
@@ -9,7 +11,7 @@ from mm.models import Invoice as mm_Invoice
 from fm.models import Invoice as fm_Invoice
 from django.contrib import messages
 from sample.models import SampleInfo
-from django.contrib.auth.models import Group,User
+from django.contrib.auth.models import User
 from django import forms
 import datetime
 from lims.models import ExtExecute as lims_ExtExecute
@@ -20,11 +22,12 @@ from lims.models import SampleInfoExt as lims_SampleInfoExt
 from lims.models import SampleInfoLib as lims_SampleInfoLib
 from lims.models import SampleInfoSeq as lims_SampleInfoSeq
 from import_export import resources
+from BMS.metrics import ResourceMetricsMixin
 from import_export.admin import ImportExportActionModelAdmin
 from datetime import date
 from daterange_filter.filter import DateRangeFilter
 from BMS.settings import DINGTALK_APPKEY, DINGTALK_SECRET
-from BMS.notice_mixin import NotificationMixin
+from BMS.notice_mixin import NotificationMixin, batch_emails
 
 
 class SubProjectForm(forms.ModelForm):
@@ -130,7 +133,7 @@ def create_submit_table(request,obj, states):
             break
 
 
-class SubProject_Resource(resources.ModelResource):
+class SubProject_Resource(ResourceMetricsMixin, resources.ModelResource):
     class Meta:
         model = SubProject
         skip_unchanged = True
@@ -325,7 +328,7 @@ class SubProjectAdmin(ImportExportActionModelAdmin, NotificationMixin):
     def get_queryset(self, request):
         qs = super(SubProjectAdmin, self).get_queryset(request)
         # 普通项目管理只能看到自己的管理的子项目,其他的有权限的人可以看到所有的
-        groups = Group.objects.filter(user__id = request.user.id)
+        groups = get_roles(request).groups
         if len(groups) >= 1:
             for i in groups:
                 if i.name == "项目管理":
@@ -337,7 +340,7 @@ class SubProjectAdmin(ImportExportActionModelAdmin, NotificationMixin):
 
     def get_list_filter(self, request):
         #一般的项目管理只能有状态的过滤器，其他人员有所有的过滤器
-        groups = Group.objects.filter(user__id=request.user.id)
+        groups = get_roles(request).groups
         if len(groups) >= 1:
             for i in groups:
                 if i.name == "项目管理":
@@ -506,9 +509,9 @@ class SubProjectAdmin(ImportExportActionModelAdmin, NotificationMixin):
                     obj.save()
                     n = n + 1
                 # 新增立项的时候，给实验发钉钉通知
-                dingdingid = DingtalkChat.objects.get(chat_name="实验钉钉群-BMS")
+                dingdingid = get_chat_id("lab")
                 self.send_group_message("编号{0}的立项完成------，立项人员:{1}".format(obj.sub_number, obj.project_manager),
-                                        dingdingid.chat_id)
+                                        dingdingid)
                 print(self.send_dingtalk_result)
             else:
                 sn = sn + 1
@@ -524,14 +527,12 @@ class SubProjectAdmin(ImportExportActionModelAdmin, NotificationMixin):
 
     def get_actions(self, request):
         actions = super().get_actions(request)
-        for group in request.user.groups.all():
-            if group.id == 2:  # 项目管理组之外都不能启动中止项目
-                pass
-            else:
-                if "make_submit" in actions:
-                    del actions["make_submit"]
-                if "make_subProject_submit" in actions:
-                    del actions["make_subProject_submit"]
+        # 项目管理组之外都不能启动中止项目
+        if any(group.id != roles.PM for group in get_roles(request)):
+            if "make_submit" in actions:
+                del actions["make_submit"]
+            if "make_subProject_submit" in actions:
+                del actions["make_subProject_submit"]
         return actions
 
 
@@ -630,6 +631,7 @@ class ExtSubmitAdmin(admin.ModelAdmin,NotificationMixin):
     #
     #     return super(ExtSubmitAdmin, self).formfield_for_manytomany(db_field, request, **kwargs)
 
+    @batch_emails
     def make_ExtSubmit_submit(self, request, queryset):
         """
         提交提取的表单
@@ -672,9 +674,9 @@ class ExtSubmitAdmin(admin.ModelAdmin,NotificationMixin):
                                         fail_silently=False)
                 except:
                     self.message_user(request,"邮箱发送失败")
-                dingdingid = DingtalkChat.objects.get(chat_name="实验钉钉群-BMS")
+                dingdingid = get_chat_id("lab")
                 self.send_group_message("编号{0}的抽提下单完成------，抽提下单人员:{1}".format(obj.ext_number, obj.project_manager),
-                                        dingdingid.chat_id)
+                                        dingdingid)
         self.message_user(request, '您选中 %s个。其中 %s个已提交过了，不能再次提交。%s个提交了成功' % (queryset.count(), sn, n,), level=messages.ERROR)
         # # 新增抽提的时候，给实验发钉钉通知
         # self.send_group_message("编号{0}的抽提下单完成------，抽提下单人员:{1}".format(obj.ext_number, obj.project_manager),
@@ -699,7 +701,7 @@ class ExtSubmitAdmin(admin.ModelAdmin,NotificationMixin):
     def get_queryset(self, request):
         qs = super(ExtSubmitAdmin, self).get_queryset(request)
         # 普通项目管理只能看到自己的下任务,其他的有权限的人可以看到所有的任务
-        groups = Group.objects.filter(user__id = request.user.id)
+        groups = get_roles(request).groups
         if len(groups) >= 1:
             for i in groups:
                 if i.name == "项目管理":
@@ -711,7 +713,7 @@ class ExtSubmitAdmin(admin.ModelAdmin,NotificationMixin):
 
     def get_list_filter(self, request):
         # 过滤器，过滤时间
-        groups = Group.objects.filter(user__id=request.user.id)
+        groups = get_roles(request).groups
         # if len(groups) >= 1:
         return [('ext_start_date', DateRangeFilter), ]
 
@@ -839,6 +841,7 @@ class LibSubmitAdmin(admin.ModelAdmin,NotificationMixin):
     #             kwargs["queryset"] = SampleInfo.objects.filter(sampleinfoform=i)
     #     return super(LibSubmitAdmin, self).formfield_for_manytomany(db_field, request, **kwargs)
 
+    @batch_emails
     def make_LibSubmit_submit(self, request, queryset):
         """
         提交建库的表单
@@ -879,9 +882,9 @@ class LibSubmitAdmin(admin.ModelAdmin,NotificationMixin):
                                         fail_silently=False)
                 except:
                     self.message_user(request,"邮箱发送失败")
-                dingdingid = DingtalkChat.objects.get(chat_name="实验钉钉群-BMS")
+                dingdingid = get_chat_id("lab")
                 self.send_group_message("编号{0}的建库下单完成------，建库下单人员:{1}".format(obj.lib_number, obj.project_manager),
-                                        dingdingid.chat_id)
+                                        dingdingid)
         self.message_user(request, '您选中 %s个。其中 %s个已提交过了，不能再次提交。%s个提交了成功' % (queryset.count(), sn, n,),
                           level=messages.ERROR)
         # # 新增建库的时候，给实验发钉钉通知
@@ -905,7 +908,7 @@ class LibSubmitAdmin(admin.ModelAdmin,NotificationMixin):
     def get_queryset(self, request):
         qs = super(LibSubmitAdmin, self).get_queryset(request)
         # 普通项目管理只能看到自己的下任务,其他的有权限的人可以看到所有的任务
-        groups = Group.objects.filter(user__id = request.user.id)
+        groups = get_roles(request).groups
         if len(groups) >= 1:
             for i in groups:
                 if i.name == "项目管理":
@@ -917,7 +920,7 @@ class LibSubmitAdmin(admin.ModelAdmin,NotificationMixin):
 
     def get_list_filter(self, request):
         # 过滤器，过滤时间
-        groups = Group.objects.filter(user__id=request.user.id)
+        groups = get_roles(request).groups
         # if len(groups) >= 1:
         return [('lib_start_date', DateRangeFilter), ('customer_confirmation_time', DateRangeFilter), ]
 
@@ -1053,6 +1056,7 @@ class SeqSubmitAdmin(admin.ModelAdmin,NotificationMixin):
     #             kwargs["queryset"] = SampleInfo.objects.filter(sampleinfoform=i)
     #     return super(SeqSubmitAdmin, self).formfield_for_manytomany(db_field, request, **kwargs)
 
+    @batch_emails
     def make_SeqSubmit_submit(self, request, queryset):
         """
         提交测序的表单
@@ -1096,9 +1100,9 @@ class SeqSubmitAdmin(admin.ModelAdmin,NotificationMixin):
                                         fail_silently=False)
                     except:
                         self.message_user(request, "邮箱发送失败")
-                    dingdingid = DingtalkChat.objects.get(chat_name="实验钉钉群-BMS")
+                    dingdingid = get_chat_id("lab")
                     self.send_group_message("编号{0}的测序下单完成------，测序下单人员:{1}".format(obj.seq_number, obj.project_manager),
-                                            dingdingid.chat_id)
+                                            dingdingid)
         self.message_user(request, '您选中 %s个。其中 %s个已提交过了，不能再次提交。%s个提交了成功' % (queryset.count(), sn, n,),
                           level=messages.ERROR)
         # # 新增测序的时候，给实验发钉钉通知
@@ -1118,7 +1122,7 @@ class SeqSubmitAdmin(admin.ModelAdmin,NotificationMixin):
     def get_queryset(self, request):
         qs = super(SeqSubmitAdmin, self).get_queryset(request)
         # 普通项目管理只能看到自己的下任务,其他的有权限的人可以看到所有的任务
-        groups = Group.objects.filter(user__id = request.user.id)
+        groups = get_roles(request).groups
         if len(groups) >= 1:
             for i in groups:
                 if i.name == "项目管理":
@@ -1130,7 +1134,7 @@ class SeqSubmitAdmin(admin.ModelAdmin,NotificationMixin):
 
     def get_list_filter(self, request):
         # 过滤器过滤时间
-        groups = Group.objects.filter(user__id=request.user.id)
+        groups = get_roles(request).groups
         # if len(groups) >= 1:
         return [('seq_start_date', DateRangeFilter), ('customer_confirmation_time', DateRangeFilter), ]
 
@@ -1231,6 +1235,7 @@ class AnaSubmitAdmin(admin.ModelAdmin,NotificationMixin):
 
     actions = ['make_AnaSubmit_submit', ]
 
+    @batch_emails
     def make_AnaSubmit_submit(self, request, queryset):
         """
         提交分析的表单
@@ -1268,9 +1273,9 @@ class AnaSubmitAdmin(admin.ModelAdmin,NotificationMixin):
                 except:
                     self.message_user(request,"邮箱发送失败")
                 # 新增分析的时候，给实验发钉钉通知
-                dingdingid = DingtalkChat.objects.get(chat_name="生信分析钉钉群-BMS")
+                dingdingid = get_chat_id("bioinfo")
                 self.send_group_message("编号{0}的分析下单完成------，分析下单人员:{1}".format(obj.ana_number, obj.project_manager),
-                                        dingdingid.chat_id)
+                                        dingdingid)
         self.message_user(request, '您选中 %s个。其中 %s个已提交过了，不能再次提交。%s个提交了成功' % (queryset.count(), sn, n,),
                           level=messages.ERROR)
         # # 新增分析的时候，给实验发钉钉通知
@@ -1290,7 +1295,7 @@ class AnaSubmitAdmin(admin.ModelAdmin,NotificationMixin):
     def get_queryset(self, request):
         qs = super(AnaSubmitAdmin, self).get_queryset(request)
         # 普通项目管理只能看到自己的下任务,其他的有权限的人可以看到所有的任务
-        groups = Group.objects.filter(user__id = request.user.id)
+        groups = get_roles(request).groups
         if len(groups) >= 1:
             for i in groups:
                 if i.name == "项目管理":
@@ -1302,7 +1307,7 @@ class AnaSubmitAdmin(admin.ModelAdmin,NotificationMixin):
 
     def get_list_filter(self, request):
         # 过滤器过滤时间
-        groups = Group.objects.filter(user__id=request.user.id)
+        groups = get_roles(request).groups
         # if len(groups) >= 1:
         return [('ana_start_date', DateRangeFilter), ]
 
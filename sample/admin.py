@@ -3,29 +3,32 @@ from email.mime.image import MIMEImage
 
 from django.contrib import admin
 from django.core.exceptions import PermissionDenied
-from django.template.response import TemplateResponse
-from django.contrib.auth.models import Group, User
+from django.contrib.auth.models import User
 from django.utils.html import format_html
 from import_export import resources
+from BMS import roles
+from BMS.exports import StreamingExportMixin
+from BMS.imports import BulkImportMixin, ImportProgressMixin, \
+    StreamingImportMixin
+from BMS.metrics import ResourceMetricsMixin
+from BMS.routers import ReplicaExportMixin
 from import_export.admin import ImportExportActionModelAdmin, \
     ExportActionModelAdmin
-from import_export.forms import ConfirmImportForm, ImportForm
-from django.utils.translation import ugettext_lazy as _
+from import_export.forms import ImportForm
 
 from BMS.admin_bms import BMS_admin_site
+from BMS.paginator import ApproximateCountMixin
+from BMS.roles import get_roles
 from BMS.notice_mixin import NotificationMixin
-from nm.models import DingtalkChat
+from nm.chats import get_chat_id
 from pm.models import SubProject
 
-try:
-    from django.utils.encoding import force_text
-except ImportError:
-    from django.utils.encoding import force_unicode as force_text
-from sample.models import SampleInfoForm, SampleInfo
+from sample.import_jobs import ImportJobMixin
+from sample.models import SampleInfoForm, SampleInfo, SampleSequence, \
+    ImportJob
 import datetime
 from django.conf import settings
 from django.core.mail import send_mail
-from django.http import HttpResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_POST
 
@@ -87,6 +90,20 @@ Monthchoose = {1: "A", 2: "B", 3: "C", 4: "D", 5: "E", 6: "F", 7: "G", 8: "H",
                9: "I", 10: "G", 11: "K", 12: "L", }
 
 
+def clean_sample_name(name):
+    """Excel reads a name like 1001 as the float 1001.0"""
+    if isinstance(name, float) and name - int(name) == 0.0:
+        return str(int(name))
+    return name
+
+
+def get_sample_codes(number):
+    """The sample_number and unique_code of the sample numbered ``number``"""
+    now = datetime.datetime.now()
+    return (str(now.year) + Monthchoose[now.month] + str(number),
+            'RY_Sample_' + str(number))
+
+
 class Sampleadmin(ExportActionModelAdmin):
     search_fields = ["sample_type", ]
     list_display = ["sampleinfoform", "sample_name", "unique_code"]
@@ -95,7 +112,7 @@ class Sampleadmin(ExportActionModelAdmin):
     def get_queryset(self, request):
         qs = super().get_queryset(request)
         try:
-            current_group_set = Group.objects.filter(user=request.user)
+            current_group_set = get_roles(request).groups
             if len(current_group_set) == 1:
                 if current_group_set[0].name == "实验部":
                     return qs
@@ -130,7 +147,7 @@ class SampleInline(admin.TabularInline):
                            'sample_receiver_name', 'tube_number', 'is_extract',
                            'remarks', 'data_request', 'sample_type']
         try:
-            current_group_set = Group.objects.filter(user=request.user)
+            current_group_set = get_roles(request).groups
             names = [i.name for i in current_group_set]
             if "实验部" in names:
                 return ["", ]
@@ -158,7 +175,15 @@ class SampleInline(admin.TabularInline):
 
 
 # 上传管理器
-class SampleInfoResource(resources.ModelResource):
+class SampleInfoResource(ReplicaExportMixin, ResourceMetricsMixin,
+                         ImportProgressMixin, BulkImportMixin,
+                         resources.ModelResource):
+    bulk_update_fields = ('sampleinfoform', 'sample_name',
+                          'sample_receiver_name', 'sample_type',
+                          'tube_number', 'is_extract', 'remarks',
+                          'data_request', 'sample_species')
+    bulk_lookup_field = 'unique_code'
+
     class Meta:
         model = SampleInfo
         skip_unchanged = True
@@ -180,87 +205,100 @@ class SampleInfoResource(resources.ModelResource):
         return ["id", "概要信息编号", "样品名", "实际收到样品名", "物种(没有写无)", "样品类型(没有写无)",
                 "管数", "是否需要提取(0-不需要，1-需要)", "备注", "数据量要求"]
 
-    def get_or_init_instance(self, instance_loader, row):
-        """
-        Either fetches an already existing instance or initializes a new one.
-        """
-        instance = self.get_instance(instance_loader, row)
-        if instance:
-            instance.sampleinfoform = SampleInfoForm.objects.get(
-                sampleinfoformid=row['概要信息编号'])
-            instance.sample_name = row['样品名']
-            instance.sample_receiver_name = row['实际收到样品名']
-            instance.sample_type = row['样品类型(没有写无)']
-            instance.tube_number = int(row['管数'])
-            instance.is_extract = row['是否需要提取(0-不需要，1-需要)']
-            instance.remarks = row['备注']
-            instance.data_request = row['数据量要求']
-            instance.sample_species = row["物种(没有写无)"]
-            instance.save()
-            return (instance, False)
-        else:
-            return (self.init_instance(row), True)
-
-    def init_instance(self, row=None):
-        if not row:
-            row = {}
-        instance = self._meta.model()
-        for attr, value in row.items():
-            setattr(instance, attr, value)
-        if SampleInfo.objects.all().count() == 0:
-            instance.id = "1"
-        else:
-            instance.id = str(int(SampleInfo.objects.latest('id').id) + 1)
-        instance.sampleinfoform = SampleInfoForm.objects.get(
-            sampleinfoformid=row['概要信息编号'])
-        # print(type(row["样品名"]))
-        # print(type(row["实际收到样品名"]))
-        # print(str(row["样品名"])+ "-----------" + str(type(row["样品名"])))
-        # print(str(row["实际收到样品名"])+ "-----------" + str(type(row["实际收到样品名"])))
-        if isinstance(row["样品名"], float):
-            if row["样品名"] - int(row["样品名"]) == 0.0:
-                instance.sample_name = str(int(row['样品名']))
-            else:
-                instance.sample_name = row['样品名']
-        else:
-            instance.sample_name = row['样品名']
-        if isinstance(row["实际收到样品名"], float):
-            if row["实际收到样品名"] - int(row["实际收到样品名"]) == 0.0:
-                instance.sample_receiver_name = str(int(row['实际收到样品名']))
-            else:
-                instance.sample_receiver_name = row['实际收到样品名']
-        else:
-            instance.sample_receiver_name = row['实际收到样品名']
+    def import_obj(self, obj, data, dry_run):
+        """The row by row import, the same as import_bulk_row(): the columns
+        of the sheet are not the fields of the resource, and the id of a
+        new sample is never taken from the sheet"""
+        new = obj.pk is None
+        self.fill_instance(obj, data, SampleInfoForm.objects.get(
+            sampleinfoformid=data['概要信息编号']))
+        if new:
+            obj.sample_number, obj.unique_code = get_sample_codes(
+                self.next_number())
+
+    def skip_row(self, instance, original):
+        # A new sample is never unchanged
+        return instance.pk is not None and super().skip_row(instance,
+                                                            original)
+
+    def fill_instance(self, instance, row, sampleinfoform):
+        instance.sampleinfoform = sampleinfoform
+        instance.sample_name = clean_sample_name(row['样品名'])
+        instance.sample_receiver_name = clean_sample_name(row['实际收到样品名'])
         instance.sample_type = row['样品类型(没有写无)']
         instance.tube_number = int(row['管数'])
         instance.is_extract = row['是否需要提取(0-不需要，1-需要)']
         instance.remarks = row['备注']
         instance.data_request = row['数据量要求']
         instance.sample_species = row["物种(没有写无)"]
-        if SampleInfo.objects.all().count() == 0:
-            instance.sample_number = str(datetime.datetime.now().year) + \
-                                     Monthchoose[
-                                         datetime.datetime.now().month] + "1"
-            instance.unique_code = 'RY_Sample_1'
-        else:
-            instance.sample_number = str(datetime.datetime.now().year) + \
-                                     Monthchoose[
-                                         datetime.datetime.now().month] + str(
-                SampleInfo.objects.latest('id').id + 1)
-            instance.unique_code = 'RY_Sample_' + str(
-                SampleInfo.objects.latest('id').id + 1)
-        return instance
+
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        # One block of numbers for all the new samples of the file
+        new_rows = sum(1 for row in dataset.dict if not row.get("id"))
+        self._numbers = iter(SampleSequence.reserve(new_rows))
+
+    def next_number(self):
+        number = next(getattr(self, "_numbers", iter(())), None)
+        if number is None:
+            # A row with an unknown id, or no before_import
+            number = SampleSequence.reserve(1)[0]
+        return number
+
+    def prepare_bulk_import(self, dataset):
+        self._forms = {}
+        for form in SampleInfoForm.objects.filter(sampleinfoformid__in={
+                row['概要信息编号'] for row in dataset.dict}):
+            # None marks a sampleinfoformid used by several forms
+            self._forms[form.sampleinfoformid] = (
+                None if form.sampleinfoformid in self._forms else form)
+        ids = set()
+        for row in dataset.dict:
+            try:
+                ids.add(self.fields['id'].clean(row))
+            except ValueError:
+                pass
+        ids.discard(None)
+        self._existing = SampleInfo.objects.select_related(
+            'sampleinfoform').in_bulk(ids)
+
+    def get_bulk_form(self, row):
+        sampleinfoformid = row['概要信息编号']
+        if sampleinfoformid not in self._forms:
+            raise SampleInfoForm.DoesNotExist(
+                "SampleInfoForm matching query does not exist.")
+        form = self._forms[sampleinfoformid]
+        if form is None:
+            raise SampleInfoForm.MultipleObjectsReturned(
+                "get() returned more than one SampleInfoForm")
+        return form
+
+    def get_bulk_instance(self, row):
+        instance = self._existing.get(self.fields['id'].clean(row))
+        if instance is not None:
+            return (instance, False)
+        return (self._meta.model(), True)
+
+    def import_bulk_row(self, instance, row, new):
+        self.fill_instance(instance, row, self.get_bulk_form(row))
+        if new:
+            instance.sample_number, instance.unique_code = get_sample_codes(
+                self.next_number())
+
+    def prepare_export_queryset(self, queryset):
+        """The samples of the selected SampleInfoForms"""
+        return SampleInfo.objects.filter(
+            sampleinfoform__in=queryset).select_related('sampleinfoform')
 
     def export(self, queryset=None, *args, **kwargs):
-        queryset_result = SampleInfo.objects.filter(id=None)
-        for i in queryset:
-            queryset_result |= SampleInfo.objects.filter(sampleinfoform=i)
-            print(queryset_result)
-        return super().export(queryset=queryset_result, *args, **kwargs)
+        if queryset is not None:
+            queryset = self.prepare_export_queryset(queryset)
+        return super().export(queryset, *args, **kwargs)
 
 
 # 样品概要管理
-class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
+class SampleInfoFormAdmin(ApproximateCountMixin, ImportJobMixin,
+                          StreamingImportMixin, StreamingExportMixin,
+                          ImportExportActionModelAdmin, NotificationMixin):
     resource_class = SampleInfoResource
 
     inlines = [SampleInline]
@@ -373,7 +411,7 @@ class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
     def get_queryset(self, request):
         qs = super(SampleInfoFormAdmin, self).get_queryset(request)
         try:
-            current_group_set = Group.objects.filter(user=request.user)
+            current_group_set = get_roles(request).groups
             if len(current_group_set) == 1:
                 if current_group_set[0].name == "实验部":
                     return qs
@@ -447,78 +485,6 @@ class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
             return True
         return super().has_change_permission(request, obj=None)
 
-    def import_action(self, request, *args, **kwargs):
-
-        resource = self.get_import_resource_class()(
-            **self.get_import_resource_kwargs(request, *args, **kwargs))
-
-        context = self.get_import_context_data()
-
-        import_formats = self.get_import_formats()
-        form_type = self.get_import_form()
-        form = form_type(import_formats,
-                         request.POST or None,
-                         request.FILES or None)
-
-        if request.POST and form.is_valid():
-            input_format = import_formats[
-                int(form.cleaned_data['input_format'])
-            ]()
-            import_file = form.cleaned_data['import_file']
-            # first always write the uploaded file to disk as it may be a
-            # memory file or else based on settings upload handlers
-            tmp_storage = self.write_to_tmp_storage(import_file, input_format)
-
-            # then read the file, using the proper format-specific mode
-            # warning, big files may exceed memory
-            try:
-                data = tmp_storage.read(input_format.get_read_mode())
-                if not input_format.is_binary() and self.from_encoding:
-                    data = force_text(data, self.from_encoding)
-                dataset = input_format.create_dataset(data)
-            except UnicodeDecodeError as e:
-                return HttpResponse(
-                    _(u"<h1>Imported file has a wrong encoding: %s</h1>" % e))
-            except Exception as e:
-                return HttpResponse(
-                    _(
-                        u"<h1>%s encountered while trying to read file: %s</h1>" % (
-                        type(e).__name__, import_file.name)))
-            result = resource.import_data(dataset, dry_run=True,
-                                          raise_errors=False,
-                                          file_name=import_file.name,
-                                          user=request.user)
-
-            context['result'] = result
-
-            if not result.has_errors():
-                context['confirm_form'] = ConfirmImportForm(initial={
-                    'import_file_name': tmp_storage.name,
-                    'original_file_name': import_file.name,
-                    'input_format': form.cleaned_data['input_format'],
-                })
-
-        context.update(self.admin_site.each_context(request))
-
-        context['title'] = _("Import")
-        context['form'] = form
-        context['opts'] = self.model._meta
-        context['fields'] = [f.column_name for f in
-                             resource.get_user_visible_fields()]
-
-        request.current_app = self.admin_site.name
-        return TemplateResponse(request, [self.import_template_name],
-                                context)
-
-    def write_to_tmp_storage(self, import_file, input_format):
-        tmp_storage = self.get_tmp_storage_class()()
-        data = bytes()
-        for chunk in import_file.chunks():
-            data += chunk
-
-        tmp_storage.save(data, input_format.get_read_mode())
-        return tmp_storage
-
     def get_context_data(self, **kwargs):
         return {}
 
@@ -533,7 +499,7 @@ class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == "saler":
-            kwargs["queryset"] = User.objects.filter(groups__id=3)
+            kwargs["queryset"] = User.objects.filter(groups__id=roles.SALES)
         if db_field.name == "sample_receiver":
             kwargs["queryset"] = User.objects.filter(groups__name="实验部")
         if db_field.name == "sample_checker":
@@ -548,23 +514,22 @@ class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
         for obj in formset.deleted_objects:
             obj.delete()
         if instances:
+            unnumbered = [instance for instance in instances
+                          if not (instance.unique_code and
+                                  instance.sample_number)]
+            numbers = SampleSequence.reserve(len(unnumbered))
+            for instance, number in zip(unnumbered, numbers):
+                instance.sample_number, instance.unique_code = \
+                    get_sample_codes(number)
             for instance in instances:
-                if not (instance.unique_code and instance.sample_number):
-                    instance.unique_code = 'RY_Sample_' + str(
-                        SampleInfo.objects.latest('id').id + 1)
-                    instance.sample_number = str(
-                        datetime.datetime.now().year) + \
-                                             Monthchoose[
-                                                 datetime.datetime.now().month] + str(
-                        SampleInfo.objects.latest('id').id + 1)
                 instance.save()
-                formset.save_m2m()
+            formset.save_m2m()
 
     def save_model(self, request, obj, form, change):
         if not obj.time_to_upload:
             obj.time_to_upload = datetime.datetime.now()
         try:
-            current_group_set = Group.objects.filter(user=request.user)
+            current_group_set = get_roles(request).groups
             names = [i.name for i in current_group_set]
             if names[0] == "合作伙伴":
                 if not obj.sampleinfoformid:
@@ -604,8 +569,7 @@ class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
                             fail_silently=False)
                     except:
                         self.message_user(request, "邮箱发送失败")
-                    dingdingid = DingtalkChat.objects.get(
-                        chat_name="实验钉钉群-BMS")
+                    dingdingid = get_chat_id("lab")
                     self.send_group_message(msg, dingdingid)
                     # if not self.send_dingtalk_result:
                     #     self.message_user(request, "钉钉发送失败")
@@ -620,7 +584,7 @@ class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
     def get_actions(self, request):
         actions = super().get_actions(request)
         try:
-            current_group_set = Group.objects.filter(user=request.user)
+            current_group_set = get_roles(request).groups
             # names = [i.name for i in current_group_set]
             if current_group_set[0].name == "合作伙伴":
                 # del actions['export_admin_action']
@@ -697,7 +661,7 @@ class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
             return self.readonly_fields
         else:
             try:
-                current_group_set = Group.objects.filter(user=request.user)
+                current_group_set = get_roles(request).groups
                 names = [i.name for i in current_group_set]
                 if obj.sample_status == 2:
                     readonly_fields = (
@@ -792,7 +756,7 @@ class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
                 "sampleinfoformid", "time_to_upload"),
             }])
         try:
-            current_group_set = Group.objects.filter(user=request.user)
+            current_group_set = get_roles(request).groups
             names = [s.name for s in current_group_set]
             if current_group_set[0].name == "实验部" or "实验部" in names:
                 fieldsets = (
@@ -860,8 +824,27 @@ class SampleInfoFormAdmin(ImportExportActionModelAdmin, NotificationMixin):
     list_filter = ("sample_status", 'time_to_upload')
 
 
+class ImportJobAdmin(admin.ModelAdmin):
+    list_per_page = 30
+    list_display = (
+        "id", "original_file_name", "resource", "user", "status",
+        "total_rows", "created_at", "finished_at"
+    )
+    list_filter = ("status", "resource")
+    readonly_fields = (
+        "resource", "input_format", "encoding", "import_file",
+        "original_file_name", "user", "status", "total_rows", "error",
+        "created_at", "started_at", "finished_at"
+    )
+    exclude = ("result", )
+
+    def has_add_permission(self, request):
+        return False
+
+
 BMS_admin_site.register(SampleInfoForm, SampleInfoFormAdmin)
 BMS_admin_site.register(SampleInfo, Sampleadmin)
+BMS_admin_site.register(ImportJob, ImportJobAdmin)
 # admin.site.register(Realbio_User, UserAdmin)
 # 全站范围内禁用删权限
 # admin.site.disable_action('delete_selected')
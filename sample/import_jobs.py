@@ -0,0 +1,416 @@
+"""Imports run in the background by celery.
+
+A big sheet took longer than the gunicorn timeout to check and import in the
+request. With ImportJobMixin the admin only saves the upload as an ImportJob:
+celery (sample.tasks.run_import_job, imports queue) runs the dry run and
+stores its result, the user confirms on the job page, celery runs the import.
+The job page polls the progress view until the job is finished.
+
+Each step claims the job with an atomic status update (pending ->
+validating, confirmed -> importing), a redelivered task finds the job taken
+and does nothing. expire_jobs() (sample.tasks.expire_import_jobs, celery
+beat) fails the jobs whose worker died or whose task never ran, and drops the
+upload and the result of the checked jobs nobody confirmed.
+"""
+import datetime
+import logging
+import traceback
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.admin.models import ADDITION, CHANGE, DELETION, LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import Q
+from django.http import Http404, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.utils.module_loading import import_string
+from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.http import require_POST
+from import_export.results import Error, Result, RowResult
+from import_export.signals import post_import
+
+from BMS.celery_queues import get_time_limits
+from BMS.imports import read_dataset
+from sample.models import ImportJob
+
+try:
+    from django.utils.encoding import force_text
+except ImportError:
+    from django.utils.encoding import force_unicode as force_text
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_KEY = "bms:import_job:%s:rows"
+LOG_ACTIONS = {
+    RowResult.IMPORT_TYPE_NEW: ADDITION,
+    RowResult.IMPORT_TYPE_UPDATE: CHANGE,
+    RowResult.IMPORT_TYPE_DELETE: DELETION,
+}
+
+
+def get_running_timeout():
+    """Seconds after which a running job is taken for dead: the hard time
+    limit of its task and a minute for the worker to be killed"""
+    soft, hard = get_time_limits().get("sample.tasks.run_import_job",
+                                       (None, 1800))
+    return hard + 60
+
+
+def get_queued_timeout():
+    return getattr(settings, "BMS_IMPORT_JOB_QUEUED_TIMEOUT", 24 * 60 * 60)
+
+
+def get_confirm_timeout():
+    return getattr(settings, "BMS_IMPORT_JOB_CONFIRM_TIMEOUT", 24 * 60 * 60)
+
+
+def get_class_path(cls):
+    return "%s.%s" % (cls.__module__, cls.__name__)
+
+
+def set_progress(pk, rows):
+    cache.set(PROGRESS_KEY % pk, rows, 24 * 60 * 60)
+
+
+def get_progress(job):
+    if job.is_running:
+        rows = cache.get(PROGRESS_KEY % job.pk) or 0
+    else:
+        rows = job.total_rows
+    return {
+        "status": job.status,
+        "status_display": job.get_status_display(),
+        "running": job.is_running,
+        "rows": rows,
+        "total_rows": job.total_rows,
+    }
+
+
+def dump_error(error):
+    data = {"error": force_text(error.error),
+            "traceback": error.traceback or ""}
+    if error.row is not None:
+        data["row"] = [[force_text(key), force_text(value)]
+                       for key, value in error.row.items()]
+    return data
+
+
+def load_error(data):
+    row = data.get("row")
+    return Error(data["error"], data["traceback"],
+                 OrderedDict(row) if row is not None else None)
+
+
+def dump_result(result):
+    """The Result of import_data as JSON for ImportJob.result"""
+    return {
+        "diff_headers": [force_text(header)
+                         for header in result.diff_headers],
+        "total_rows": result.total_rows,
+        "totals": list(result.totals.items()),
+        "base_errors": [dump_error(error) for error in result.base_errors],
+        "rows": [{
+            "import_type": row.import_type,
+            "diff": [force_text(value) for value in row.diff or ()],
+            "object_id": force_text(getattr(row, "object_id", "") or ""),
+            "object_repr": force_text(getattr(row, "object_repr", "") or ""),
+            "errors": [dump_error(error) for error in row.errors],
+        } for row in result.rows],
+    }
+
+
+def load_result(data):
+    """A Result the import templates can render"""
+    result = Result()
+    result.diff_headers = data["diff_headers"]
+    result.total_rows = data["total_rows"]
+    result.totals = OrderedDict(data["totals"])
+    result.base_errors = [load_error(error) for error in data["base_errors"]]
+    for row_data in data["rows"]:
+        row = RowResult()
+        row.import_type = row_data["import_type"]
+        # The diffs were rendered to html by diff_match_patch
+        row.diff = [mark_safe(value) for value in row_data["diff"]]
+        row.object_id = row_data["object_id"]
+        row.object_repr = row_data["object_repr"]
+        row.errors = [load_error(error) for error in row_data["errors"]]
+        result.rows.append(row)
+    return result
+
+
+def start_job(resource_class, input_format, import_file, user,
+              encoding=None):
+    """Save the upload and schedule its dry run"""
+    job = ImportJob(
+        resource=get_class_path(resource_class),
+        input_format=get_class_path(type(input_format)),
+        encoding=encoding or "utf-8",
+        original_file_name=import_file.name,
+        user=user,
+        started_at=timezone.now(),
+    )
+    # Written to the storage chunk by chunk
+    job.import_file.save(import_file.name, import_file, save=False)
+    job.save()
+    transaction.on_commit(lambda: schedule(job.pk, dry_run=True))
+    return job
+
+
+def confirm_job(job):
+    """Schedule the import of a checked job, False if it is not waiting for
+    a confirmation (e.g. confirmed twice)"""
+    confirmed = ImportJob.objects.filter(
+        pk=job.pk, status=ImportJob.STATUS_VALIDATED
+    ).update(status=ImportJob.STATUS_CONFIRMED, started_at=timezone.now())
+    if confirmed:
+        set_progress(job.pk, 0)
+        transaction.on_commit(lambda: schedule(job.pk, dry_run=False))
+    return bool(confirmed)
+
+
+def schedule(pk, dry_run):
+    from sample.tasks import run_import_job
+    run_import_job.delay(pk, dry_run)
+
+
+def load_job_dataset(job, input_format):
+    try:
+        path = job.import_file.path
+    except NotImplementedError:
+        path = None
+    if path is not None:
+        dataset = read_dataset(path, input_format, job.encoding)
+        if dataset is not None:
+            return dataset
+    with job.import_file.open(input_format.get_read_mode()) as f:
+        data = f.read()
+    if not input_format.is_binary() and job.encoding:
+        data = force_text(data, job.encoding)
+    return input_format.create_dataset(data)
+
+
+def write_log_entries(job, model, result):
+    if job.user_id is None:
+        return
+    content_type_id = ContentType.objects.get_for_model(model).pk
+    LogEntry.objects.bulk_create([
+        LogEntry(
+            user_id=job.user_id,
+            content_type_id=content_type_id,
+            object_id=force_text(row.object_id),
+            object_repr=force_text(row.object_repr)[:200],
+            action_flag=LOG_ACTIONS[row.import_type],
+            change_message="%s through import_export" % row.import_type,
+        ) for row in result.rows if row.import_type in LOG_ACTIONS
+    ], batch_size=500)
+
+
+def delete_upload(job):
+    if job.import_file:
+        job.import_file.storage.delete(job.import_file.name)
+
+
+def run_job(pk, dry_run=True):
+    """The dry run or the import of a job, in a celery worker"""
+    if dry_run:
+        waiting, running = (ImportJob.STATUS_PENDING,
+                            ImportJob.STATUS_VALIDATING)
+    else:
+        waiting, running = (ImportJob.STATUS_CONFIRMED,
+                            ImportJob.STATUS_IMPORTING)
+    started = ImportJob.objects.filter(pk=pk, status=waiting).update(
+        status=running, started_at=timezone.now())
+    if not started:
+        logger.warning("Import job %s is not waiting to run", pk)
+        return
+    job = ImportJob.objects.get(pk=pk)
+    set_progress(pk, 0)
+    resource = import_string(job.resource)()
+    resource.on_progress = lambda rows: set_progress(pk, rows)
+    try:
+        dataset = load_job_dataset(job, import_string(job.input_format)())
+        job.total_rows = len(dataset)
+        job.save(update_fields=["total_rows"])
+        result = resource.import_data(
+            dataset, dry_run=dry_run, raise_errors=not dry_run,
+            file_name=job.original_file_name, user=job.user
+        )
+    except Exception:
+        logger.exception("Import job %s failed", pk)
+        job.status = (ImportJob.STATUS_INVALID if dry_run
+                      else ImportJob.STATUS_FAILED)
+        job.error = traceback.format_exc()
+    else:
+        job.result = dump_result(result)
+        if not dry_run:
+            job.status = ImportJob.STATUS_DONE
+            write_log_entries(job, resource._meta.model, result)
+            post_import.send(sender=None, model=resource._meta.model)
+        elif result.has_errors():
+            job.status = ImportJob.STATUS_INVALID
+        else:
+            job.status = ImportJob.STATUS_VALIDATED
+    job.finished_at = timezone.now()
+    job.save()
+    if job.status != ImportJob.STATUS_VALIDATED:
+        # Nothing will read the upload again
+        delete_upload(job)
+    cache.delete(PROGRESS_KEY % pk)
+
+
+def expire_job(job, status, error, **fields):
+    """Move the job out of its status, False if it changed meanwhile"""
+    changed = ImportJob.objects.filter(pk=job.pk, status=job.status).update(
+        status=status, error=error, finished_at=timezone.now(), **fields)
+    if changed:
+        logger.warning("Import job %s expired: %s", job.pk, error)
+        delete_upload(job)
+        cache.delete(PROGRESS_KEY % job.pk)
+    return bool(changed)
+
+
+def expire_jobs(jobs=None):
+    """Fail the jobs whose worker was killed (time limit, OOM, deploy) or
+    whose task never ran, expire the checked jobs nobody confirmed. Returns
+    the number of jobs changed."""
+    if jobs is None:
+        jobs = ImportJob.objects.all()
+    now = timezone.now()
+
+    def before(seconds):
+        return now - datetime.timedelta(seconds=seconds)
+
+    expired = 0
+    for job in jobs.filter(
+            Q(status__in=(ImportJob.STATUS_VALIDATING,
+                          ImportJob.STATUS_IMPORTING),
+              started_at__lt=before(get_running_timeout()))
+            | Q(status__in=(ImportJob.STATUS_PENDING,
+                            ImportJob.STATUS_CONFIRMED),
+                started_at__lt=before(get_queued_timeout()))):
+        expired += expire_job(job, ImportJob.STATUS_FAILED,
+                              "导入任务超时未完成，请重新上传")
+    for job in jobs.filter(status=ImportJob.STATUS_VALIDATED,
+                           finished_at__lt=before(get_confirm_timeout())):
+        expired += expire_job(job, ImportJob.STATUS_EXPIRED,
+                              "校验结果长时间未确认导入，已过期，请重新上传",
+                              result=None)
+    return expired
+
+
+class ImportJobMixin(object):
+    """ImportMixin (admin) mixin running the dry run and the import of the
+    uploads as ImportJobs. BMS_IMPORT_JOBS = False imports in the request."""
+    import_job_template_name = "admin/import_export/import_job.html"
+
+    def use_import_jobs(self):
+        return getattr(settings, "BMS_IMPORT_JOBS", True)
+
+    def get_urls(self):
+        info = self.get_model_info()
+        return [
+            path("import_job/<int:pk>/progress/",
+                 self.admin_site.admin_view(self.import_job_progress_view),
+                 name="%s_%s_import_job_progress" % info),
+        ] + super().get_urls()
+
+    def get_import_job(self, request, pk):
+        if not force_text(pk or "").isdigit():
+            raise Http404
+        jobs = ImportJob.objects.filter(
+            resource=get_class_path(self.get_import_resource_class()))
+        if not request.user.is_superuser:
+            jobs = jobs.filter(user=request.user)
+        job = get_object_or_404(jobs, pk=pk)
+        # The page stops polling a dead job without waiting for celery beat
+        if expire_jobs(jobs.filter(pk=job.pk)):
+            job.refresh_from_db()
+        return job
+
+    def get_import_job_url(self, job):
+        return "%s?job=%s" % (
+            reverse("admin:%s_%s_import" % self.get_model_info(),
+                    current_app=self.admin_site.name),
+            job.pk
+        )
+
+    def import_action(self, request, *args, **kwargs):
+        if not self.use_import_jobs():
+            return super().import_action(request, *args, **kwargs)
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+        if "job" in request.GET:
+            return self.import_job_view(request, request.GET["job"])
+
+        resource = self.get_import_resource_class()(
+            **self.get_import_resource_kwargs(request, *args, **kwargs))
+        import_formats = self.get_import_formats()
+        form_type = self.get_import_form()
+        form = form_type(import_formats,
+                         request.POST or None,
+                         request.FILES or None)
+
+        if request.POST and form.is_valid():
+            input_format = import_formats[
+                int(form.cleaned_data['input_format'])
+            ]()
+            job = start_job(self.get_import_resource_class(), input_format,
+                            form.cleaned_data['import_file'], request.user,
+                            self.from_encoding)
+            return HttpResponseRedirect(self.get_import_job_url(job))
+
+        context = self.get_import_context_data()
+        context.update(self.admin_site.each_context(request))
+        context['title'] = _("Import")
+        context['form'] = form
+        context['opts'] = self.model._meta
+        context['fields'] = [f.column_name for f in
+                             resource.get_user_visible_fields()]
+
+        request.current_app = self.admin_site.name
+        return TemplateResponse(request, [self.import_template_name],
+                                context)
+
+    def import_job_view(self, request, pk):
+        job = self.get_import_job(request, pk)
+        context = self.get_import_context_data()
+        context.update(self.admin_site.each_context(request))
+        context.update({
+            "title": _("Import"),
+            "opts": self.model._meta,
+            "job": job,
+            "progress": get_progress(job),
+            "progress_url": reverse(
+                "admin:%s_%s_import_job_progress" % self.get_model_info(),
+                args=(job.pk, ), current_app=self.admin_site.name),
+            "result": load_result(job.result) if job.result else None,
+            "can_confirm": job.status == ImportJob.STATUS_VALIDATED,
+            "is_done": job.status == ImportJob.STATUS_DONE,
+        })
+        request.current_app = self.admin_site.name
+        return TemplateResponse(request, [self.import_job_template_name],
+                                context)
+
+    def import_job_progress_view(self, request, pk):
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+        return JsonResponse(get_progress(self.get_import_job(request, pk)))
+
+    @method_decorator(require_POST)
+    def process_import(self, request, *args, **kwargs):
+        if not self.use_import_jobs():
+            return super().process_import(request, *args, **kwargs)
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+        job = self.get_import_job(request, request.POST.get("job"))
+        if confirm_job(job):
+            self.message_user(request, "导入任务已提交，完成后本页会自动刷新")
+        return HttpResponseRedirect(self.get_import_job_url(job))
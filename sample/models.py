@@ -1,4 +1,6 @@
-from django.db import models
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import IntegrityError, connections, models, router, transaction
 from django.contrib.auth import admin
 from django.contrib.auth.models import User
 from django.contrib.auth.models import AbstractUser
@@ -16,6 +18,7 @@ from django.contrib.auth.models import AbstractUser
 #     def __str__(self):
 #         return self.username
 from django.utils.html import format_html
+from jsonfield.fields import JSONField
 
 from BMS.settings import MEDIA_ROOT
 import datetime
@@ -267,3 +270,131 @@ class SampleInfo(models.Model):
     class Meta:
         verbose_name = "样品信息"
         verbose_name_plural = "样品信息"
+
+
+class SampleSequence(models.Model):
+    """Counters numbering the samples, see reserve()"""
+    name = models.CharField(max_length=32, verbose_name="名称", unique=True)
+    last_value = models.BigIntegerField(verbose_name="最后编号", default=0)
+
+    class Meta:
+        verbose_name = "样品编号序列"
+        verbose_name_plural = "样品编号序列"
+
+    def __str__(self):
+        return "%s: %s" % (self.name, self.last_value)
+
+    @classmethod
+    def reserve(cls, count, name="sample"):
+        """Reserve ``count`` consecutive numbers and return them as a range.
+
+        The numbers are taken in a short transaction of their own, which
+        locks the row of the sequence so concurrent imports and saves never
+        get the same numbers. Inside an atomic block (an import, the admin
+        save) that transaction runs on a connection of its own, the lock
+        does not last until the surrounding transaction ends. The numbers of
+        a rolled back transaction (dry run import) are not given back, the
+        sample numbers may have gaps. A new sequence continues after the
+        highest SampleInfo id, which numbered the samples before.
+        """
+        if count <= 0:
+            return range(0)
+        connection = connections[router.db_for_write(cls)]
+        if (connection.in_atomic_block
+                and connection.features.has_select_for_update):
+            # Another thread gets another connection (SQLite has no row
+            # locks, it locks the whole database for the outer transaction
+            # anyway)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                return executor.submit(
+                    cls._reserve_on_own_connection, count, name).result()
+        return cls._reserve(count, name)
+
+    @classmethod
+    def _reserve_on_own_connection(cls, count, name):
+        try:
+            return cls._reserve(count, name)
+        finally:
+            connections.close_all()
+
+    @classmethod
+    def _reserve(cls, count, name):
+        with transaction.atomic():
+            sequence = cls.objects.select_for_update().filter(
+                name=name).first()
+            if sequence is None:
+                start = SampleInfo.objects.aggregate(
+                    last=models.Max("id"))["last"] or 0
+                try:
+                    with transaction.atomic():
+                        sequence = cls.objects.create(
+                            name=name, last_value=start)
+                except IntegrityError:
+                    # Created by a concurrent transaction meanwhile
+                    sequence = cls.objects.select_for_update().get(name=name)
+            first = sequence.last_value + 1
+            sequence.last_value += count
+            sequence.save(update_fields=["last_value"])
+        return range(first, first + count)
+
+
+class ImportJob(models.Model):
+    """An import run in the background by celery, see sample.import_jobs"""
+    STATUS_PENDING = 0
+    STATUS_VALIDATING = 1
+    STATUS_VALIDATED = 2
+    STATUS_INVALID = 3
+    STATUS_IMPORTING = 4
+    STATUS_DONE = 5
+    STATUS_FAILED = 6
+    STATUS_CONFIRMED = 7
+    STATUS_EXPIRED = 8
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "等待校验"),
+        (STATUS_VALIDATING, "校验中"),
+        (STATUS_VALIDATED, "待确认导入"),
+        (STATUS_CONFIRMED, "等待导入"),
+        (STATUS_INVALID, "校验未通过"),
+        (STATUS_IMPORTING, "导入中"),
+        (STATUS_DONE, "导入完成"),
+        (STATUS_FAILED, "导入失败"),
+        (STATUS_EXPIRED, "已过期"),
+    )
+    RUNNING_STATUSES = (STATUS_PENDING, STATUS_VALIDATING, STATUS_CONFIRMED,
+                        STATUS_IMPORTING)
+
+    resource = models.CharField(max_length=200, verbose_name="导入资源")
+    input_format = models.CharField(max_length=200, verbose_name="文件格式")
+    encoding = models.CharField(max_length=32, verbose_name="编码",
+                                default="utf-8")
+    import_file = models.FileField(upload_to="import_jobs/%Y/%m",
+                                   verbose_name="导入文件")
+    original_file_name = models.CharField(max_length=255,
+                                          verbose_name="文件名")
+    user = models.ForeignKey(User, verbose_name="导入人", null=True,
+                             blank=True, on_delete=models.SET_NULL)
+    status = models.SmallIntegerField(choices=STATUS_CHOICES,
+                                      verbose_name="状态",
+                                      default=STATUS_PENDING)
+    total_rows = models.PositiveIntegerField(verbose_name="行数", default=0)
+    result = JSONField(verbose_name="导入结果", null=True, blank=True)
+    error = models.TextField(verbose_name="错误信息", null=True, blank=True)
+    created_at = models.DateTimeField(verbose_name="创建时间",
+                                      auto_now_add=True)
+    # When the job was queued or started running, for expire_jobs()
+    started_at = models.DateTimeField(verbose_name="开始时间", null=True,
+                                      blank=True)
+    finished_at = models.DateTimeField(verbose_name="完成时间", null=True,
+                                       blank=True)
+
+    class Meta:
+        verbose_name = "导入任务"
+        verbose_name_plural = "导入任务"
+        ordering = ("-created_at", )
+
+    def __str__(self):
+        return "%s-%s" % (self.original_file_name, self.pk)
+
+    @property
+    def is_running(self):
+        return self.status in self.RUNNING_STATUSES
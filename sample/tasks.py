@@ -0,0 +1,16 @@
+from __future__ import absolute_import
+from celery import shared_task
+
+from sample import import_jobs
+
+
+@shared_task(ignore_result=True)
+def run_import_job(pk, dry_run=True):
+    """The dry run or the import of an ImportJob"""
+    import_jobs.run_job(pk, dry_run)
+
+
+@shared_task(ignore_result=True)
+def expire_import_jobs():
+    """Fail the dead ImportJobs, expire the unconfirmed ones"""
+    return import_jobs.expire_jobs()
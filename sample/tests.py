@@ -1,13 +1,427 @@
-from django.test import TestCase
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+import openpyxl
+import tablib
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import (
+    RequestFactory, TestCase, TransactionTestCase, override_settings
+)
 from django.conf import settings
 from django.core.mail import send_mail
 from django.http import HttpResponse
+from django.utils import timezone
+from import_export.formats.base_formats import CSV, XLSX
+
+from BMS.admin_bms import BMS_admin_site
+from BMS.exports import StreamingExportMixin, iter_queryset
+from sample import import_jobs
+from sample.admin import SampleInfoResource
+from sample.models import ImportJob, SampleInfo, SampleInfoForm, \
+    SampleSequence
+
+
 def send(request):
     msg='<a href="哈哈哈" target="_blank">点击激活</a>'
     send_mail('标题','内容',settings.EMAIL_FROM,
                '目标邮箱',
                html_message=msg)
     return HttpResponse('ok')
+
+
+class SampleSequenceTest(TransactionTestCase):
+    # Outside of TestCase's transaction reserve() uses the test connection
+
+    def test_first_use_continues_after_the_samples(self):
+        SampleInfo.objects.create(id=41)
+        self.assertEqual(list(SampleSequence.reserve(2)), [42, 43])
+        self.assertEqual(
+            SampleSequence.objects.get(name="sample").last_value, 43)
+
+    def test_first_use_without_samples(self):
+        self.assertEqual(list(SampleSequence.reserve(1)), [1])
+
+    def test_blocks_are_contiguous(self):
+        first = SampleSequence.reserve(3)
+        second = SampleSequence.reserve(2)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(list(second), [first[-1] + 1, first[-1] + 2])
+        # Samples created meanwhile do not move an existing sequence
+        SampleInfo.objects.create(id=1000)
+        self.assertEqual(list(SampleSequence.reserve(1)), [second[-1] + 1])
+
+    def test_sequences_are_independent(self):
+        self.assertEqual(list(SampleSequence.reserve(2, name="a")), [1, 2])
+        self.assertEqual(list(SampleSequence.reserve(1, name="b")), [1])
+
+    def test_nothing_to_reserve(self):
+        self.assertEqual(list(SampleSequence.reserve(0)), [])
+        self.assertFalse(SampleSequence.objects.exists())
+
+    def test_own_connection_inside_transactions(self):
+        threads = []
+
+        def reserve(count, name):
+            threads.append(threading.get_ident())
+            return range(1, count + 1)
+
+        with mock.patch.object(SampleSequence, "_reserve",
+                               side_effect=reserve), \
+                mock.patch.object(connection.features,
+                                  "has_select_for_update", True):
+            with transaction.atomic():
+                self.assertEqual(list(SampleSequence.reserve(2)), [1, 2])
+        self.assertNotEqual(threads, [threading.get_ident()])
+
+
+class SampleInfoResourceNumbersTest(TransactionTestCase):
+
+    def test_new_rows_share_a_block(self):
+        resource = SampleInfoResource()
+        dataset = tablib.Dataset(["", "a"], ["", "b"], [7, "c"],
+                                 headers=["id", "样品名"])
+        resource.before_import(dataset, True, False)
+        numbers = [resource.next_number(), resource.next_number()]
+        self.assertEqual(numbers[1], numbers[0] + 1)
+        self.assertEqual(
+            SampleSequence.objects.get(name="sample").last_value, numbers[1])
+
+    def test_unknown_id_falls_back_to_reserve(self):
+        resource = SampleInfoResource()
+        dataset = tablib.Dataset(["", "a"], headers=["id", "样品名"])
+        resource.before_import(dataset, True, False)
+        first = resource.next_number()
+        # A row whose id matched no sample, not counted by before_import
+        self.assertEqual(resource.next_number(), first + 1)
+        self.assertEqual(
+            SampleSequence.objects.get(name="sample").last_value, first + 1)
+
+    def test_without_before_import(self):
+        self.assertEqual(SampleInfoResource().next_number(), 1)
+
+
+class BulkImportTest(TestCase):
+    """The bulk import gives the results of the row by row import"""
+    headers = ["id", "概要信息编号", "样品名", "实际收到样品名", "物种(没有写无)",
+               "样品类型(没有写无)", "管数", "是否需要提取(0-不需要，1-需要)", "备注",
+               "数据量要求"]
+
+    def setUp(self):
+        self.form = SampleInfoForm.objects.create(
+            sampleinfoformid="F1", transform_number="1",
+            transform_phone="1", partner_company="c", partner_phone=1,
+            sample_num=5)
+        self.changed = SampleInfo.objects.create(
+            id=10, sampleinfoform=self.form, sample_name="s10",
+            sample_receiver_name="s10", sample_type="DNA", tube_number=1,
+            unique_code="RY_Sample_10", sample_number="X10")
+        self.unchanged = SampleInfo.objects.create(
+            id=11, sampleinfoform=self.form, sample_name="s11",
+            sample_receiver_name="s11", sample_type="DNA", tube_number=1,
+            is_extract=False, remarks="", data_request="", sample_species="",
+            unique_code="RY_Sample_11", sample_number="X11")
+
+    def row(self, id, name, form="F1"):
+        return [id, form, name, name, "", "DNA", 2, 0, "", ""]
+
+    def get_dataset(self, with_errors):
+        rows = [
+            self.row("", "new1"),
+            self.row(10, "s10-changed"),
+            self.row("", 1001.0),
+            [11, "F1", "s11", "s11", "", "DNA", 1, 0, "", ""],
+            self.row(9999, "unknown-id"),
+            self.row("", "new3"),
+        ]
+        if with_errors:
+            rows.insert(2, self.row("", "no-form", form="nope"))
+        return tablib.Dataset(*rows, headers=self.headers)
+
+    def run_import(self, bulk, dry_run=False, with_errors=False):
+        with override_settings(BMS_BULK_IMPORT=bulk):
+            result = SampleInfoResource().import_data(
+                self.get_dataset(with_errors), dry_run=dry_run)
+        errors = [(line, [str(error.error) for error in row_errors])
+                  for line, row_errors in result.row_errors()]
+        samples = list(SampleInfo.objects.order_by("unique_code").values_list(
+            "sample_name", "unique_code", "sample_number", "tube_number"))
+        return dict(result.totals), errors, samples
+
+    def compare(self, **kwargs):
+        sid = transaction.savepoint()
+        row_by_row = self.run_import(False, **kwargs)
+        transaction.savepoint_rollback(sid)
+        bulk = self.run_import(True, **kwargs)
+        self.assertEqual(bulk, row_by_row)
+        return bulk
+
+    def test_import(self):
+        totals, errors, samples = self.compare()
+        self.assertEqual(totals["new"], 4)
+        self.assertEqual(totals["update"], 1)
+        self.assertEqual(totals["skip"], 1)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(samples), 6)
+        self.assertIn(("s10-changed", "RY_Sample_10", "X10", 2), samples)
+        names = dict((name, code) for name, code, number, tubes in samples)
+        # Numbered in the order of the sheet after the highest id
+        self.assertEqual(
+            [names["new1"], names["1001"], names["unknown-id"], names["new3"]],
+            ["RY_Sample_12", "RY_Sample_13", "RY_Sample_14", "RY_Sample_15"])
+
+    def test_dry_run(self):
+        totals, errors, samples = self.compare(dry_run=True)
+        self.assertEqual(totals["new"], 4)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(samples), 2)
+
+    def test_errors(self):
+        totals, errors, samples = self.compare(with_errors=True)
+        self.assertEqual(totals["error"], 1)
+        self.assertEqual(
+            errors,
+            [(3, ["SampleInfoForm matching query does not exist."])])
+        # Nothing is imported from a sheet with errors
+        self.assertEqual(len(samples), 2)
+
+
+@override_settings(BMS_BULK_IMPORT=False)
+class ImportJobTest(TestCase):
+    headers = BulkImportTest.headers
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        # on_commit never runs inside TestCase, the tests run the jobs
+        patcher = mock.patch("sample.import_jobs.schedule")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username="importer")
+        SampleInfoForm.objects.create(
+            sampleinfoformid="F1", transform_number="1",
+            transform_phone="1", partner_company="c", partner_phone=1,
+            sample_num=2)
+
+    def get_dataset(self, *names, form="F1"):
+        return tablib.Dataset(*[
+            ["", form, name, name, "", "DNA", 1, 0, "", ""] for name in names
+        ], headers=self.headers)
+
+    def start(self, *names, **kwargs):
+        upload = SimpleUploadedFile(
+            "samples.csv",
+            self.get_dataset(*names, **kwargs).csv.encode("utf-8"))
+        return import_jobs.start_job(SampleInfoResource, CSV(), upload,
+                                     self.user)
+
+    def reload(self, job):
+        return ImportJob.objects.get(pk=job.pk)
+
+    def set_status(self, job, status, seconds_ago=0, **fields):
+        ImportJob.objects.filter(pk=job.pk).update(
+            status=status, started_at=timezone.now() - datetime.timedelta(
+                seconds=seconds_ago), **fields)
+        return self.reload(job)
+
+    def test_dry_run_confirm_import(self):
+        job = self.start("a", "b")
+        path = job.import_file.path
+        self.assertEqual(job.status, ImportJob.STATUS_PENDING)
+
+        import_jobs.run_job(job.pk, dry_run=True)
+        job = self.reload(job)
+        self.assertEqual(job.status, ImportJob.STATUS_VALIDATED)
+        self.assertEqual(dict(job.result["totals"])["new"], 2)
+        self.assertEqual(SampleInfo.objects.count(), 0)
+        self.assertTrue(os.path.exists(path))
+
+        with self.assertLogs("sample.import_jobs", "WARNING"):
+            # A redelivered dry run, an import before the confirmation
+            import_jobs.run_job(job.pk, dry_run=True)
+            import_jobs.run_job(job.pk, dry_run=False)
+        self.assertEqual(self.reload(job).status,
+                         ImportJob.STATUS_VALIDATED)
+
+        self.assertTrue(import_jobs.confirm_job(job))
+        self.assertFalse(import_jobs.confirm_job(job))
+        job = self.reload(job)
+        self.assertEqual(job.status, ImportJob.STATUS_CONFIRMED)
+        self.assertTrue(job.is_running)
+
+        import_jobs.run_job(job.pk, dry_run=False)
+        job = self.reload(job)
+        self.assertEqual(job.status, ImportJob.STATUS_DONE)
+        self.assertEqual(SampleInfo.objects.count(), 2)
+        self.assertFalse(os.path.exists(path))
+
+        # A redelivered import task does not import the sheet again
+        with self.assertLogs("sample.import_jobs", "WARNING"):
+            import_jobs.run_job(job.pk, dry_run=False)
+        self.assertEqual(SampleInfo.objects.count(), 2)
+
+    def test_invalid_sheet(self):
+        job = self.start("a", form="nope")
+        path = job.import_file.path
+        import_jobs.run_job(job.pk, dry_run=True)
+        job = self.reload(job)
+        self.assertEqual(job.status, ImportJob.STATUS_INVALID)
+        self.assertFalse(import_jobs.confirm_job(job))
+        self.assertFalse(os.path.exists(path))
+
+    def test_expire_dead_jobs(self):
+        timeout = import_jobs.get_running_timeout()
+        dead = self.set_status(self.start("a"), ImportJob.STATUS_IMPORTING,
+                               timeout + 1)
+        path = dead.import_file.path
+        running = self.set_status(self.start("b"),
+                                  ImportJob.STATUS_VALIDATING, timeout - 60)
+        lost = self.set_status(self.start("c"), ImportJob.STATUS_CONFIRMED,
+                               import_jobs.get_queued_timeout() + 1)
+        queued = self.start("d")
+
+        self.assertEqual(import_jobs.expire_jobs(), 2)
+        dead = self.reload(dead)
+        self.assertEqual(dead.status, ImportJob.STATUS_FAILED)
+        self.assertFalse(dead.is_running)
+        self.assertTrue(dead.error)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.reload(lost).status, ImportJob.STATUS_FAILED)
+        self.assertEqual(self.reload(running).status,
+                         ImportJob.STATUS_VALIDATING)
+        self.assertEqual(self.reload(queued).status,
+                         ImportJob.STATUS_PENDING)
+
+        # The late task of a failed job does nothing
+        with self.assertLogs("sample.import_jobs", "WARNING"):
+            import_jobs.run_job(dead.pk, dry_run=False)
+        self.assertEqual(SampleInfo.objects.count(), 0)
+
+    def test_expire_unconfirmed_jobs(self):
+        job = self.start("a")
+        path = job.import_file.path
+        import_jobs.run_job(job.pk, dry_run=True)
+        self.assertEqual(import_jobs.expire_jobs(), 0)
+
+        ImportJob.objects.filter(pk=job.pk).update(
+            finished_at=timezone.now() - datetime.timedelta(
+                seconds=import_jobs.get_confirm_timeout() + 1))
+        self.assertEqual(import_jobs.expire_jobs(), 1)
+        job = self.reload(job)
+        self.assertEqual(job.status, ImportJob.STATUS_EXPIRED)
+        self.assertIsNone(job.result)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(import_jobs.confirm_job(job))
+
+    def test_result_round_trip(self):
+        dataset = self.get_dataset("a")
+        dataset.append(["", "nope", "b", "b", "", "DNA", 1, 0, "", ""])
+        result = SampleInfoResource().import_data(dataset, dry_run=True)
+        loaded = import_jobs.load_result(
+            json.loads(json.dumps(import_jobs.dump_result(result))))
+
+        self.assertEqual(loaded.diff_headers, result.diff_headers)
+        self.assertEqual(loaded.total_rows, result.total_rows)
+        self.assertEqual(dict(loaded.totals), dict(result.totals))
+        self.assertTrue(loaded.has_errors())
+        self.assertEqual(
+            [(row.import_type, row.diff, row.object_repr)
+             for row in loaded.rows],
+            [(row.import_type, row.diff or [],
+              getattr(row, "object_repr", None) or "")
+             for row in result.rows])
+        [(line, errors)] = loaded.row_errors()
+        [(expected_line, expected_errors)] = result.row_errors()
+        self.assertEqual(line, expected_line)
+        self.assertEqual(str(errors[0].error),
+                         str(expected_errors[0].error))
+        self.assertEqual(errors[0].traceback, expected_errors[0].traceback)
+        self.assertEqual(
+            list(errors[0].row.items()),
+            [(str(key), str(value))
+             for key, value in expected_errors[0].row.items()])
+
+
+class StreamingExportTest(TestCase):
+    """The streamed CSV and XLSX hold the rows of SampleInfoResource.export()"""
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            "admin", "admin@example.com", "admin")
+        self.admin = BMS_admin_site._registry[SampleInfoForm]
+        for form_id, samples in (("F1", 5), ("F2", 2), ("F3", 4)):
+            form = SampleInfoForm.objects.create(
+                sampleinfoformid=form_id, transform_number="1",
+                transform_phone="1", partner_company="c", partner_phone=1,
+                sample_num=samples)
+            for i in range(samples):
+                SampleInfo.objects.create(
+                    sampleinfoform=form, sample_name="%s-%s" % (form_id, i),
+                    sample_receiver_name="样品%s" % i, sample_type="DNA",
+                    tube_number=i, is_extract=bool(i % 2),
+                    remarks='a "quoted", remark' if i == 1 else "")
+        self.queryset = SampleInfoForm.objects.filter(
+            sampleinfoformid__in=["F1", "F3"])
+
+    def export(self, format_class):
+        formats = self.admin.get_export_formats()
+        request = RequestFactory().post("/", {
+            "file_format": formats.index(format_class)})
+        request.user = self.user
+        response = self.admin.export_admin_action(request, self.queryset)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content)
+
+    def expected(self):
+        dataset = SampleInfoResource().export(self.queryset)
+        self.assertEqual(len(dataset), 9)
+        return [dataset.headers] + [list(row) for row in dataset]
+
+    @override_settings(BMS_EXPORT_CHUNK_ROWS=4)
+    def test_csv(self):
+        content = self.export(CSV).decode("utf-8")
+        self.assertEqual(
+            list(csv.reader(io.StringIO(content))),
+            [[str(value) for value in row] for row in self.expected()])
+
+    @override_settings(BMS_EXPORT_CHUNK_ROWS=4)
+    def test_xlsx(self):
+        workbook = openpyxl.load_workbook(io.BytesIO(self.export(XLSX)))
+        # An empty cell is read back as None
+        self.assertEqual(
+            [[cell.value for cell in row]
+             for row in workbook.worksheets[0].rows],
+            [[None if value == "" else value for value in row]
+             for row in self.expected()])
+
+    def test_chunks(self):
+        samples = SampleInfo.objects.filter(sampleinfoform__in=self.queryset)
+        pks = list(samples.order_by("pk").values_list("pk", flat=True))
+        for chunk_rows, queries in ((4, 3), (3, 4), (9, 2), (20, 1)):
+            with self.assertNumQueries(queries):
+                self.assertEqual(
+                    [obj.pk for obj in iter_queryset(samples, chunk_rows)],
+                    pks)
+
+    def test_registered_action(self):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        func, name, description = \
+            self.admin.get_actions(request)["export_admin_action"]
+        self.assertIs(func, StreamingExportMixin.export_admin_action)
+
+
 if __name__ == '__main__':
     a = 5.0
     print(str(a))
\ No newline at end of file
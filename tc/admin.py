@@ -1,5 +1,7 @@
 from django.contrib import admin
 from import_export import resources
+from BMS import roles
+from BMS.metrics import ResourceMetricsMixin
 from import_export.admin import ExportActionModelAdmin
 from tc.models import TrainingCourse
 from BMS.admin_bms import BMS_admin_site
@@ -7,7 +9,7 @@ from django.contrib.auth.models import User
 from django.db.models import Q
 
 
-class TrainingCourseResource(resources.ModelResource):
+class TrainingCourseResource(ResourceMetricsMixin, resources.ModelResource):
     class Meta:
         model = TrainingCourse
         skip_unchanged = True
@@ -50,7 +52,8 @@ class TrainingCourseAdmin(ExportActionModelAdmin):
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == "saler":
-            saler_ = User.objects.filter(Q(groups__id=3) | Q(groups__id=6))
+            saler_ = User.objects.filter(
+                Q(groups__id=roles.SALES) | Q(groups__id=roles.COMPANY))
             kwargs["queryset"] = saler_
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 